@@ -0,0 +1,292 @@
+"""
+Module containing finite-dimensional feature approximations of kernels, and
+the computation of the relative test statistics (and their variances) from
+the means and covariances of the approximate features.
+"""
+
+__author__ = 'wittawat'
+
+from builtins import object
+
+import autograd.numpy as np
+from kmod import util
+
+
+class FeatureMoments(object):
+    """
+    Sample size, mean and covariance (unbiased, i.e., normalized by n-1) of a
+    D-dimensional feature matrix Phi (n x D) computed on a sample. The moments
+    summarize the sample for all the computations in this module. They can be
+    computed once per sample (e.g., once per model) and reused.
+    """
+
+    def __init__(self, n, mean, cov):
+        self.n = n
+        self.mean = mean
+        self.cov = cov
+
+    @staticmethod
+    def compute(feature_map, X, block_size=10000):
+        """
+        Compute the moments of feature_map(X) by processing X (an array or a
+        memmap) in row blocks. Memory usage is O(block_size*D + D^2).
+
+        :param feature_map: a function mapping a b x d array to a b x D array
+        :param X: n x d array
+        :param block_size: number of rows of X to featurize at a time
+        """
+        sums = None
+        for (Xb, ) in util.iter_row_blocks(block_size, X):
+            sums = FeatureMoments.accumulate(feature_map, Xb, sums)
+        return FeatureMoments.from_sums(sums)
+
+    @staticmethod
+    def accumulate(feature_map, Xb, sums=None):
+        """
+        Add the sums of the features of the row block Xb to sums, a list
+        [n, sum of the features, sum of the outer products] (None to
+        start). Use from_sums() to get the moments after all the blocks.
+
+        :returns: the updated list
+        """
+        if sums is None:
+            sums = [0, 0.0, 0.0]
+        Phi = feature_map(Xb)
+        return [sums[0] + Xb.shape[0], sums[1] + np.sum(Phi, 0),
+                sums[2] + np.dot(Phi.T, Phi)]
+
+    @staticmethod
+    def from_sums(sums):
+        """
+        Return the FeatureMoments given the sums accumulated by accumulate().
+        """
+        n = 0 if sums is None else sums[0]
+        if n <= 1:
+            raise ValueError('Need at least 2 points. Was {}'.format(n))
+        s, M = sums[1], sums[2]
+        mean = s/float(n)
+        cov = (M - n*np.outer(mean, mean))/float(n-1)
+        return FeatureMoments(n, mean, cov)
+
+# end of class FeatureMoments
+
+
+class GaussRFF(object):
+    """
+    Random Fourier features (Rahimi & Recht, 2007) of the Gaussian kernel
+    kmod.kernel.KGauss(sigma2), i.e., k(x, y) = exp(-||x-y||^2/(2*sigma2)) is
+    approximated by phi(x).dot(phi(y)) where
+        phi(x) = sqrt(2/D)*[cos(W x), sin(W x)],
+    and the D/2 rows of W are drawn from N(0, I/sigma2).
+    """
+
+    def __init__(self, sigma2, d, D=500, seed=1):
+        """
+        :param sigma2: squared Gaussian width
+        :param d: input dimension
+        :param D: number of features. Must be even.
+        :param seed: random seed for drawing the frequencies W
+        """
+        if not util.is_real_num(sigma2) or sigma2 <= 0:
+            raise ValueError('sigma2 must be positive real. Was {}'.format(sigma2))
+        if D <= 0 or D % 2 != 0:
+            raise ValueError('D must be a positive even integer. Was {}'.format(D))
+        self.sigma2 = sigma2
+        self.D = D
+        with util.NumpySeedContext(seed=seed):
+            self.W = np.random.randn(D//2, d)/np.sqrt(sigma2)
+
+    def features(self, X):
+        """
+        Return the n x D matrix of random features of X (n x d).
+        """
+        XW = np.dot(X, self.W.T)
+        return np.hstack((np.cos(XW), np.sin(XW)))*np.sqrt(2.0/self.D)
+
+    def moments(self, X, block_size=10000):
+        """
+        Return the FeatureMoments of the features of X.
+        """
+        return FeatureMoments.compute(self.features, X, block_size=block_size)
+
+    def eval(self, X, Y):
+        """
+        Approximate Gram matrix phi(X) phi(Y)'.
+        """
+        return np.dot(self.features(X), self.features(Y).T)
+
+# end of class GaussRFF
+
+
+class NystromFeatures(object):
+    """
+    Nystrom features (Williams & Seeger, 2001) of any positive definite
+    kernel k given m landmarks L. With the eigendecomposition
+    k(L, L) = U diag(lambda) U',
+        phi(x) = k(x, L) U diag(lambda)^(-1/2),
+    so that phi(X) phi(Y)' = k(X, L) k(L, L)^+ k(L, Y) approximates k(X, Y).
+    Eigenvalues smaller than eig_tol*max(lambda) are dropped. So, the
+    feature dimension can be smaller than m if k(L, L) is (nearly) singular,
+    e.g., for a polynomial kernel.
+    """
+
+    def __init__(self, k, L, eig_tol=1e-10):
+        """
+        :param k: a kernel object with eval(X1, X2)
+        :param L: m x d numpy array of landmarks
+        :param eig_tol: relative threshold for dropping small eigenvalues of
+            k(L, L)
+        """
+        self.k = k
+        self.L = L
+        K_LL = k.eval(L, L)
+        # symmetrize to remove rounding errors
+        evals, U = np.linalg.eigh(0.5*(K_LL + K_LL.T))
+        keep = evals > eig_tol*np.max(evals)
+        # m x D projection
+        self.proj = U[:, keep]/np.sqrt(evals[keep])
+        self.D = self.proj.shape[1]
+
+    @staticmethod
+    def select_landmarks(XYZ, m, method='uniform', k=None, seed=1):
+        """
+        Select m landmarks from the rows of XYZ (e.g., the pooled samples).
+
+        :param XYZ: N x d numpy array
+        :param m: number of landmarks
+        :param method: 'uniform' to draw m rows uniformly at random without
+            replacement. 'kmeans++' to draw sequentially with probability
+            proportional to the squared RKHS distance to the nearest landmark
+            chosen so far (needs k). 'kmeans++' spreads the landmarks better,
+            at the cost of O(N*m) kernel evaluations.
+        :param k: kernel. Needed only for method='kmeans++'.
+        :param seed: random seed
+
+        :returns: m x d numpy array
+        """
+        N = XYZ.shape[0]
+        m = min(m, N)
+        if method == 'uniform':
+            ind = util.subsample_ind(N, m, seed=seed)
+            return XYZ[ind, :]
+        elif method == 'kmeans++':
+            if k is None:
+                raise ValueError('k must be specified for method kmeans++.')
+            with util.NumpySeedContext(seed=seed):
+                # k(x, x) for all x
+                kxx = k.pair_eval(XYZ, XYZ)
+                ind = [np.random.randint(N)]
+                l = XYZ[[ind[0]], :]
+                dist2 = kxx + kxx[ind[0]] - 2.0*k.eval(XYZ, l)[:, 0]
+                for _ in range(1, m):
+                    prob = np.maximum(dist2, 0)
+                    if np.sum(prob) <= 0:
+                        break
+                    i = np.random.choice(N, p=prob/np.sum(prob))
+                    ind.append(i)
+                    l = XYZ[[i], :]
+                    dist2 = np.minimum(dist2, kxx + kxx[i] - 2.0*k.eval(XYZ, l)[:, 0])
+            return XYZ[ind, :]
+        else:
+            raise ValueError('Unknown landmark selection method: {}'.format(method))
+
+    def features(self, X):
+        """
+        Return the n x D matrix of Nystrom features of X (n x d).
+        """
+        return np.dot(self.k.eval(X, self.L), self.proj)
+
+    def moments(self, X, block_size=10000):
+        """
+        Return the FeatureMoments of the features of X.
+        """
+        return FeatureMoments.compute(self.features, X, block_size=block_size)
+
+# end of class NystromFeatures
+
+
+def rel_mean_variance(mom_x, mom_y, mom_z, A_p=None, A_q=None):
+    """
+    Mean and variance of the relative statistic
+        a'A_p a - b'A_q b,  where a = mu_x - mu_z, b = mu_y - mu_z,
+    and mu_x, mu_y, mu_z are the mean features of P, Q, R. X, Y, Z are
+    assumed to be independent samples.
+
+    * With A_p = A_q = I (None), a'a approximates MMD^2 of the kernel whose
+      features are used.
+    * With A_p = Phi_V'Phi_V/J where Phi_V (J x D) contains the features of
+      the J test locations, a'A_p a approximates UME^2(P, R).
+
+    The mean estimate is unbiased (tr(A Sigma)/n terms are subtracted). The
+    variance is computed with the delta method, and is the variance of
+    sqrt(n_z) times the statistic (same convention as
+    SC_MMD.get_H1_mean_variance()).
+
+    :param mom_x: FeatureMoments of the sample X from P
+    :param mom_y: FeatureMoments of the sample Y from Q
+    :param mom_z: FeatureMoments of the sample Z from R
+    :param A_p: D x D PSD matrix or None (identity)
+    :param A_q: D x D PSD matrix or None (identity)
+
+    :returns: (mean, variance)
+    """
+    D = mom_z.mean.shape[0]
+    if A_p is None:
+        A_p = np.eye(D)
+    if A_q is None:
+        A_q = np.eye(D)
+    nx, ny, nz = mom_x.n, mom_y.n, mom_z.n
+    a = mom_x.mean - mom_z.mean
+    b = mom_y.mean - mom_z.mean
+    Apa = np.dot(A_p, a)
+    Aqb = np.dot(A_q, b)
+    # remove the biases of the quadratic forms
+    bias_p = np.sum(A_p*mom_x.cov)/nx + np.sum(A_p*mom_z.cov)/nz
+    bias_q = np.sum(A_q*mom_y.cov)/ny + np.sum(A_q*mom_z.cov)/nz
+    mean_h1 = (np.dot(a, Apa) - bias_p) - (np.dot(b, Aqb) - bias_q)
+
+    # gradients of the statistic with respect to mu_x, mu_y, mu_z are
+    # 2A_p a, -2A_q b, 2(A_q b - A_p a)
+    gz = Aqb - Apa
+    var = 4.0*(np.dot(Apa, np.dot(mom_x.cov, Apa))/nx
+            + np.dot(Aqb, np.dot(mom_y.cov, Aqb))/ny
+            + np.dot(gz, np.dot(mom_z.cov, gz))/nz)
+    return mean_h1, nz*var
+
+
+def rel_influence_values(feature_map, X, Y, Z, mom_x, mom_y, mom_z,
+        A_p=None, A_q=None, block_size=10000):
+    """
+    First-order influence values (hx, hy, hz) of the points of X, Y, Z on the
+    relative statistic of rel_mean_variance(). The gradients of the
+    statistic with respect to mu_x, mu_y, mu_z are 2A_p a, -2A_q b and
+    2(A_q b - A_p a), so the influence value of a point is the inner product
+    of its feature vector with the gradient for its sample. The statistic is
+    linear in these up to O(1/n) terms, and
+    kmod.bootstrap.linear_draws([hx, hy, hz], n_z) simulates its null
+    distribution. The means of the influence values are irrelevant
+    (linear_draws() centers them).
+
+    :param feature_map: a function mapping a b x d array to a b x D array
+        (e.g., GaussRFF.features)
+    :param mom_x, mom_y, mom_z: FeatureMoments of feature_map on X, Y, Z
+    :param A_p, A_q: as in rel_mean_variance()
+    :param block_size: number of rows featurized at a time
+
+    :returns: (hx, hy, hz), numpy arrays of lengths n_x, n_y, n_z
+    """
+    D = mom_z.mean.shape[0]
+    if A_p is None:
+        A_p = np.eye(D)
+    if A_q is None:
+        A_q = np.eye(D)
+    Apa = np.dot(A_p, mom_x.mean - mom_z.mean)
+    Aqb = np.dot(A_q, mom_y.mean - mom_z.mean)
+
+    def project(A, g):
+        return np.hstack([np.dot(feature_map(Ab), g) for (Ab, ) in
+            util.iter_row_blocks(block_size, A)])
+    hx = 2.0*project(X, Apa)
+    hy = -2.0*project(Y, Aqb)
+    hz = 2.0*project(Z, Aqb - Apa)
+    return hx, hy, hz
@@ -0,0 +1,260 @@
+"""
+Module containing array backends for the relative tests in kmod.mctest. A
+backend provides the few array operations used to compute the statistics of
+SC_UME, SC_MMD and DC_FSSD. The same formulas (e.g.,
+kmod.mctest.rel_ustat_h1_mean_variance()) run on numpy arrays with plain
+numpy ('numpy', fastest, not differentiable), on numpy arrays with
+autograd.numpy ('autograd', differentiable with autograd), or on torch
+tensors ('torch', multithreaded CPU kernels, differentiable with
+torch.autograd). Use get() to obtain a backend.
+"""
+
+__author__ = 'wittawat'
+
+from builtins import object
+from future.utils import with_metaclass
+
+from abc import ABCMeta, abstractmethod
+
+import autograd.numpy as anp
+import numpy
+import torch
+from kmod import kernel
+
+
+class Backend(with_metaclass(ABCMeta, object)):
+    """
+    An abstract array backend. The statistics are written with the methods
+    here and the operators (+, *, **, slicing with np.newaxis) common to
+    numpy arrays and torch tensors.
+    """
+
+    name = None
+
+    @abstractmethod
+    def asarray(self, A):
+        """
+        Convert a numpy array to an array of this backend. An array of this
+        backend is returned unchanged.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def to_numpy(self, A):
+        """
+        Convert an array (or a scalar) of this backend to a numpy array (or
+        scalar).
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def sum(self, A, axis=None):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def mean(self, A, axis=None):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def dot(self, A, B):
+        """
+        Matrix product (as numpy.dot for 1d and 2d arrays).
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def sqrt(self, A):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def exp(self, A):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def reshape(self, A, shape):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def zero_diag(self, K):
+        """
+        Return a copy of the square matrix K with the diagonal set to 0.
+        """
+        raise NotImplementedError()
+
+    def gauss_gram(self, X, Y, sigma2):
+        """
+        Gram matrix of the Gaussian kernel with squared width sigma2. Same as
+        kernel.KGauss(sigma2).eval(X, Y).
+        """
+        sumx2 = self.reshape(self.sum(X**2, 1), (-1, 1))
+        sumy2 = self.reshape(self.sum(Y**2, 1), (1, -1))
+        D2 = sumx2 - 2*self.dot(X, Y.T) + sumy2
+        return self.exp(-D2/(2.0*sigma2))
+
+    def kernel_eval(self, k, X, Y):
+        """
+        Evaluate the kernel k on X, Y (arrays of this backend). The Gaussian
+        kernel (kernel.KGauss) is evaluated with the operations of this
+        backend. Other kernels are evaluated with k.eval() on numpy arrays.
+        """
+        if isinstance(k, kernel.KGauss):
+            return self.gauss_gram(X, Y, k.sigma2)
+        return self.asarray(k.eval(self.to_numpy(X), self.to_numpy(Y)))
+
+# end of class Backend
+
+
+class NumpyBackend(Backend):
+    """
+    Backend of numpy arrays with the operations of plain numpy. Every call
+    of an autograd.numpy function goes through autograd's dispatch (even
+    when nothing is differentiated), which dominates the cost of a test on a
+    small sample. Use this backend when no gradient is needed. The Gaussian
+    kernel is also evaluated with plain numpy (see Backend.kernel_eval()).
+    """
+
+    name = 'numpy'
+    # the numpy module of the operations
+    xp = numpy
+
+    def asarray(self, A):
+        # Leave autograd's boxed arrays as they are.
+        return A
+
+    def to_numpy(self, A):
+        return A
+
+    def sum(self, A, axis=None):
+        return self.xp.sum(A, axis)
+
+    def mean(self, A, axis=None):
+        return self.xp.mean(A, axis)
+
+    def dot(self, A, B):
+        return self.xp.dot(A, B)
+
+    def sqrt(self, A):
+        return self.xp.sqrt(A)
+
+    def exp(self, A):
+        return self.xp.exp(A)
+
+    def reshape(self, A, shape):
+        return self.xp.reshape(A, shape)
+
+    def zero_diag(self, K):
+        return K - self.xp.diag(self.xp.diag(K))
+
+# end of class NumpyBackend
+
+
+class AutogradBackend(NumpyBackend):
+    """
+    Backend of numpy arrays with the operations of autograd.numpy, so that
+    the statistics can be differentiated with autograd (e.g., in the
+    optimizers of the test locations).
+    """
+
+    name = 'autograd'
+    xp = anp
+
+    def kernel_eval(self, k, X, Y):
+        # The kernel may implement its own (e.g., differentiable) evaluation.
+        return k.eval(X, Y)
+
+# end of class AutogradBackend
+
+
+class TorchBackend(Backend):
+    """
+    Backend of torch tensors. The operations use torch's intra-op thread
+    pool, and can be differentiated with torch.autograd.
+    """
+
+    name = 'torch'
+
+    def __init__(self, dtype=torch.float64, device='cpu', n_threads=None):
+        """
+        :param dtype: torch dtype of the tensors converted from numpy arrays.
+            float64 gives the same results as NumpyBackend up to rounding.
+        :param device: torch device of the tensors converted from numpy
+            arrays
+        :param n_threads: if not None, set the number of threads of torch's
+            intra-op thread pool (torch.set_num_threads(), which applies to
+            the whole process)
+        """
+        self.dtype = dtype
+        self.device = torch.device(device)
+        if n_threads is not None:
+            torch.set_num_threads(n_threads)
+
+    def asarray(self, A):
+        if isinstance(A, torch.Tensor):
+            return A
+        return torch.as_tensor(A, dtype=self.dtype, device=self.device)
+
+    def to_numpy(self, A):
+        if isinstance(A, torch.Tensor):
+            return A.detach().cpu().numpy()
+        return A
+
+    def sum(self, A, axis=None):
+        if axis is None:
+            return torch.sum(A)
+        return torch.sum(A, dim=axis)
+
+    def mean(self, A, axis=None):
+        if axis is None:
+            return torch.mean(A)
+        return torch.mean(A, dim=axis)
+
+    def dot(self, A, B):
+        return torch.matmul(A, B)
+
+    def sqrt(self, A):
+        if isinstance(A, torch.Tensor):
+            return torch.sqrt(A)
+        return A**0.5
+
+    def exp(self, A):
+        return torch.exp(A)
+
+    def reshape(self, A, shape):
+        return torch.reshape(A, shape)
+
+    def zero_diag(self, K):
+        return K - torch.diag(torch.diag(K))
+
+    def kernel_eval(self, k, X, Y):
+        if isinstance(k, kernel.PTKGauss):
+            return k.eval(X, Y)
+        return super(TorchBackend, self).kernel_eval(k, X, Y)
+
+# end of class TorchBackend
+
+
+_backends = {}
+
+def get(backend=None):
+    """
+    Return a Backend.
+
+    :param backend: 'numpy' for NumpyBackend, None or 'autograd' for
+        AutogradBackend (works on plain and on autograd's boxed arrays),
+        'torch' for a TorchBackend with the default settings, or a Backend
+        (returned as is).
+    """
+    if isinstance(backend, Backend):
+        return backend
+    if backend is None:
+        backend = 'autograd'
+    if backend not in _backends:
+        if backend == 'numpy':
+            _backends[backend] = NumpyBackend()
+        elif backend == 'autograd':
+            _backends[backend] = AutogradBackend()
+        elif backend == 'torch':
+            _backends[backend] = TorchBackend()
+        else:
+            raise ValueError('backend must be "numpy", "autograd", "torch" or a Backend. Was {}'.format(backend))
+    return _backends[backend]
@@ -0,0 +1,108 @@
+"""
+Module containing vectorized multiplier (wild) bootstrap procedures for
+simulating the null distributions of the relative tests in kmod.mctest. All
+the bootstrap draws are computed with matrix products of a (chunk of) B x n
+matrix of Rademacher weights and the already computed feature matrices (or
+Gram row sums). There is no Python loop over the draws.
+"""
+
+__author__ = 'wittawat'
+
+from builtins import range
+
+import autograd.numpy as np
+from kmod import util
+
+
+def rademacher_weights(n_bootstrap, n, seed=1, max_entries=10**7):
+    """
+    Generate the n_bootstrap x n matrix of i.i.d. Rademacher (+1/-1) weights
+    in row chunks so that each chunk has at most about max_entries entries.
+
+    :returns: a list of b x n numpy arrays whose row counts sum to
+        n_bootstrap
+    """
+    if n_bootstrap <= 0:
+        raise ValueError('n_bootstrap must be positive. Was {}'.format(n_bootstrap))
+    chunk = max(1, min(n_bootstrap, max_entries//max(n, 1)))
+    chunks = []
+    with util.NumpySeedContext(seed=seed):
+        for i in range(0, n_bootstrap, chunk):
+            b = min(chunk, n_bootstrap - i)
+            chunks.append(2.0*np.random.randint(0, 2, size=(b, n)) - 1.0)
+    return chunks
+
+
+def ustat_diff_draws(fea_p, fea_q, n_bootstrap=1000, seed=1):
+    """
+    Bootstrap draws of sqrt(n)*(stat - E[stat]) where
+        stat = U(fea_p) - U(fea_q)
+    and U(F) is the unbiased estimate of ||E[f]||^2 given the n x D matrix F
+    whose rows f_i are i.i.d. This is the form of the statistics of SC_UME
+    (feature matrices of UME(P, R), UME(Q, R)) and DC_FSSD (the reshaped
+    Stein feature tensors). The two feature matrices are computed on the same
+    points, and are perturbed with the same weights w (b x n) to keep their
+    correlation. With the centered features F_c and mean f,
+        C = w F_c / n,
+        U* - U = 2 C f + ||C||^2 - sum_i ||f_i - f||^2 / n^2,
+    where the last term is E_w ||C||^2. The second-order term ||C||^2 makes
+    the draws more accurate than the normal approximation at small n.
+
+    :param fea_p: n x Dp numpy array
+    :param fea_q: n x Dq numpy array
+    :param n_bootstrap: number of bootstrap draws
+    :param seed: random seed for the weights
+
+    :returns: a numpy array of length n_bootstrap
+    """
+    n, Dp = fea_p.shape
+    if fea_q.shape[0] != n:
+        raise ValueError('fea_p and fea_q must have the same number of rows. Were {} and {}'.format(
+            n, fea_q.shape[0]))
+    mean_p = np.mean(fea_p, 0)
+    mean_q = np.mean(fea_q, 0)
+    Fc = np.hstack((fea_p - mean_p, fea_q - mean_q))
+    tr_p = np.sum(Fc[:, :Dp]**2)/float(n**2)
+    tr_q = np.sum(Fc[:, Dp:]**2)/float(n**2)
+
+    draws = []
+    for w in rademacher_weights(n_bootstrap, n, seed=seed):
+        C = np.dot(w, Fc)/float(n)
+        Cp = C[:, :Dp]
+        Cq = C[:, Dp:]
+        dp = 2.0*np.dot(Cp, mean_p) + np.sum(Cp**2, 1) - tr_p
+        dq = 2.0*np.dot(Cq, mean_q) + np.sum(Cq**2, 1) - tr_q
+        draws.append(dp - dq)
+    return (n**0.5)*np.hstack(draws)
+
+
+def linear_draws(list_h, n_scale, n_bootstrap=1000, seed=1):
+    """
+    Bootstrap draws of sqrt(n_scale)*(stat - E[stat]) where the statistic is
+    asymptotically linear in independent samples:
+        stat - E[stat] ~= sum_s mean(h_s)
+    and h_s (length n_s) contains the (first-order) influence values of the
+    points in sample s. The weights of different samples are independent.
+
+    :param list_h: a list of 1d numpy arrays
+    :param n_scale: the sample size n with which the statistic is scaled by
+        sqrt(n)
+
+    :returns: a numpy array of length n_bootstrap
+    """
+    draws = 0.0
+    for s, h in enumerate(list_h):
+        n_s = h.shape[0]
+        hc = h - np.mean(h)
+        # different seeds for different samples
+        chunks = rademacher_weights(n_bootstrap, n_s, seed=seed + 97*s)
+        draws = draws + np.hstack([np.dot(w, hc) for w in chunks])/float(n_s)
+    return (n_scale**0.5)*draws
+
+
+def pvalue(stat, draws):
+    """
+    p-value of a test rejecting for a large stat, given the bootstrap draws
+    of the null distribution.
+    """
+    return np.mean(draws > stat)
@@ -0,0 +1,69 @@
+"""
+Benchmark of the per-call time of perform_test() of the relative tests with
+the plain numpy backend (the default) and the autograd backend, on small
+samples as in the repeated trials of ex1. See kmod.backend. (SC_MMD is not
+included: with the autograd backend, it forms the full Gram matrices instead
+of summing them tile by tile, so the difference is not only the overhead.)
+
+Usage: python bench_backend.py [n_calls]
+"""
+
+__author__ = 'wittawat'
+
+import kmod
+from kmod import data, kernel, util
+import kmod.mctest as mct
+import kgof.density as density
+import numpy as np
+import sys
+import timeit
+
+
+def make_tests(n, d, J, seed=3):
+    """
+    Return a list of (name, function of backend returning a test) and the
+    data from R.
+    """
+    with util.NumpySeedContext(seed=seed):
+        X = np.random.randn(n, d) + 0.5
+        Y = np.random.randn(n, d)
+        Z = np.random.randn(n, d)
+        V = np.random.randn(J, d)
+    datap, dataq, datar = data.Data(X), data.Data(Y), data.Data(Z)
+    k = kernel.KGauss(float(d))
+    p = density.IsotropicNormal(np.zeros(d) + 0.5, 1.0)
+    q = density.IsotropicNormal(np.zeros(d), 1.0)
+    tests = [
+        ('SC_UME', lambda b: mct.SC_UME(datap, dataq, k, k, V, V, backend=b)),
+        ('DC_GaussFSSD', lambda b: mct.DC_GaussFSSD(p, q, float(d), float(d),
+            V, V, backend=b)),
+        ]
+    return tests, datar
+
+
+def per_call_secs(test, datar, n_calls):
+    # best of 5 repetitions
+    times = timeit.repeat(lambda: test.perform_test(datar), number=n_calls,
+            repeat=5)
+    return min(times)/n_calls
+
+
+def main():
+    if len(sys.argv) > 2:
+        print('Usage: %s [n_calls]'%sys.argv[0])
+        sys.exit(1)
+    n_calls = int(sys.argv[1]) if len(sys.argv) == 2 else 200
+    d = 2
+    J = 5
+    print('{:>14s} {:>6s} {:>14s} {:>14s} {:>8s}'.format('test', 'n',
+        'autograd (us)', 'numpy (us)', 'speedup'))
+    for n in [50, 100, 200]:
+        tests, datar = make_tests(n, d, J)
+        for name, make_test in tests:
+            t_ag = per_call_secs(make_test('autograd'), datar, n_calls)
+            t_np = per_call_secs(make_test('numpy'), datar, n_calls)
+            print('{:>14s} {:>6d} {:>14.1f} {:>14.1f} {:>8.2f}'.format(name, n,
+                1e6*t_ag, 1e6*t_np, t_ag/t_np))
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,8 @@ from kmod import mctest as mct
 import kmod.glo as glo
 import kmod.mctest as mct
 import kmod.model as model
+import kmod.median as median
+import kmod.warmstart as warmstart
 import kgof.density as density
 # goodness-of-fit test
 import kgof.goftest as gof
@@ -78,13 +80,13 @@ def sample_pqr(ds_p, ds_q, ds_r, n, r, only_from_r=False):
 
 #-------------------------------------------------------
 
-def met_gumeJ5_2sopt_tr20(P, Q, data_source, n, r):
-    return met_gumeJ1_2sopt_tr50(P, Q, data_source, n, r, J=5, tr_proportion=0.2)
+def met_gumeJ5_2sopt_tr20(P, Q, data_source, n, r, prob_label=None):
+    return met_gumeJ1_2sopt_tr50(P, Q, data_source, n, r, J=5, tr_proportion=0.2, prob_label=prob_label)
 
-def met_gumeJ1_2sopt_tr20(P, Q, data_source, n, r, J=1):
-    return met_gumeJ1_2sopt_tr50(P, Q, data_source, n, r, J=J, tr_proportion=0.2)
+def met_gumeJ1_2sopt_tr20(P, Q, data_source, n, r, J=1, prob_label=None):
+    return met_gumeJ1_2sopt_tr50(P, Q, data_source, n, r, J=J, tr_proportion=0.2, prob_label=prob_label)
 
-def met_gumeJ1_2sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
+def met_gumeJ1_2sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5, prob_label=None):
     """
     UME-based three-sample test
         * Use J=1 test location by default. 
@@ -112,8 +114,7 @@ def met_gumeJ1_2sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
 
         # initialize optimization parameters.
         # Initialize the Gaussian widths with the median heuristic
-        medxz = util.meddistance(np.vstack((Xtr, Ztr)), subsample=1000)
-        medyz = util.meddistance(np.vstack((Ytr, Ztr)), subsample=1000)
+        (medxz, medyz), _ = median.medians([Xtr, Ytr, Ztr], pools=[(0, 2), (1, 2)])
         gwidth0p = medxz**2
         gwidth0q = medyz**2
 
@@ -137,9 +138,13 @@ def met_gumeJ1_2sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
             'gwidth_ub': 10**2,
         }
 
+        ws = None
+        if use_warm_start and prob_label is not None:
+            ws = warm_start_cache.lookup_for('ex%d'%ex, prob_label,
+                    'gume_2sopt_tr%d'%(100*tr_proportion), J, Xtr, Ytr, Ztr)
         umep_params, umeq_params = mct.SC_GaussUME.optimize_2sets_locs_widths(
             datptr, datqtr, datrtr, V0, W0, gwidth0p, gwidth0q, 
-            **opt_options)
+            warm_start=ws, **opt_options)
         (V_opt, gw2p_opt, opt_infop) = umep_params
         (W_opt, gw2q_opt, opt_infoq) = umeq_params
         k_opt = kernel.KGauss(gw2p_opt)
@@ -156,13 +161,13 @@ def met_gumeJ1_2sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
             #'test':scume, 
             'test_result': scume_opt2_result, 'time_secs': t.secs}
 
-def met_gumeJ1_3sopt_tr20(P, Q, data_source, n, r, J=1):
-    return met_gumeJ1_3sopt_tr50(P, Q, data_source, n, r, J=J, tr_proportion=0.2)
+def met_gumeJ1_3sopt_tr20(P, Q, data_source, n, r, J=1, prob_label=None):
+    return met_gumeJ1_3sopt_tr50(P, Q, data_source, n, r, J=J, tr_proportion=0.2, prob_label=prob_label)
 
-def met_gumeJ5_3sopt_tr20(P, Q, data_source, n, r):
-    return met_gumeJ1_3sopt_tr50(P, Q, data_source, n, r, J=5, tr_proportion=0.2)
+def met_gumeJ5_3sopt_tr20(P, Q, data_source, n, r, prob_label=None):
+    return met_gumeJ1_3sopt_tr50(P, Q, data_source, n, r, J=5, tr_proportion=0.2, prob_label=prob_label)
 
-def met_gumeJ1_3sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
+def met_gumeJ1_3sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5, prob_label=None):
     """
     UME-based three-sample test
         * Use J=1 test location by default (in the set V=W). 
@@ -189,8 +194,7 @@ def met_gumeJ1_3sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
         Xyztr = np.vstack((Xtr, Ytr, Ztr))
         # initialize optimization parameters.
         # Initialize the Gaussian widths with the median heuristic
-        medxz = util.meddistance(np.vstack((Xtr, Ztr)), subsample=1000)
-        medyz = util.meddistance(np.vstack((Ztr, Ytr)), subsample=1000)
+        (medxz, medyz), _ = median.medians([Xtr, Ytr, Ztr], pools=[(0, 2), (2, 1)])
         gwidth0 = np.mean([medxz, medyz])**2
 
         # pick a subset of points in the training set for V, W
@@ -205,8 +209,12 @@ def met_gumeJ1_3sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
             'gwidth_lb': 0.1,
             'gwidth_ub': 6**2,
         }
+        ws = None
+        if use_warm_start and prob_label is not None:
+            ws = warm_start_cache.lookup_for('ex%d'%ex, prob_label,
+                    'gume_3sopt_tr%d'%(100*tr_proportion), J, Xtr, Ytr, Ztr)
         V_opt, gw2_opt, opt_result = mct.SC_GaussUME.optimize_3sample_criterion(
-            datptr, datqtr, datrtr, V0, gwidth0, **opt_options)    
+            datptr, datqtr, datrtr, V0, gwidth0, warm_start=ws, **opt_options)    
         k_opt = kernel.KGauss(gw2_opt)
 
         # construct a UME test
@@ -221,10 +229,10 @@ def met_gumeJ1_3sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
             'test_result': scume_opt3_result, 'time_secs': t.secs}
 
 
-def met_gumeJ1_1V_rand(P, Q, data_source, n, r, J=1):
-    return met_gumeJ1_2V_rand(P, Q, data_source, n, r, J=1, use_1set_locs=True)
+def met_gumeJ1_1V_rand(P, Q, data_source, n, r, J=1, prob_label=None):
+    return met_gumeJ1_2V_rand(P, Q, data_source, n, r, J=1, use_1set_locs=True, prob_label=prob_label)
 
-def met_gumeJ1_2V_rand(P, Q, data_source, n, r, J=1, use_1set_locs=False):
+def met_gumeJ1_2V_rand(P, Q, data_source, n, r, J=1, use_1set_locs=False, prob_label=None):
     """
     UME-based three-sample test. 
         * Use J=1 test location by default. 
@@ -273,8 +281,7 @@ def met_gumeJ1_2V_rand(P, Q, data_source, n, r, J=1, use_1set_locs=False):
             pool3J = np.random.randn(3*J, d)*2
 
         # median heuristic to set the Gaussian widths
-        medxz = util.meddistance(np.vstack((X, Z)), subsample=1000)
-        medyz = util.meddistance(np.vstack((Z, Y)), subsample=1000)
+        (medxz, medyz), _ = median.medians([X, Y, Z], pools=[(0, 2), (2, 1)])
         if use_1set_locs:
             # randomly select J points from the pool3J for the J test locations
             #V = util.subsample_rows(pool3J, J, r)
@@ -303,13 +310,13 @@ def met_gumeJ1_2V_rand(P, Q, data_source, n, r, J=1, use_1set_locs=False):
             #'test':scume, 
             'test_result': scume_rand_result, 'time_secs': t.secs}
 
-def met_gfssdJ1_3sopt_tr20(P, Q, data_source, n, r, J=1):
-    return met_gfssdJ1_3sopt_tr50(P, Q, data_source, n, r, J=J, tr_proportion=0.2)
+def met_gfssdJ1_3sopt_tr20(P, Q, data_source, n, r, J=1, prob_label=None):
+    return met_gfssdJ1_3sopt_tr50(P, Q, data_source, n, r, J=J, tr_proportion=0.2, prob_label=prob_label)
 
-def met_gfssdJ5_3sopt_tr20(P, Q, data_source, n, r):
-    return met_gfssdJ1_3sopt_tr50(P, Q, data_source, n, r, J=5, tr_proportion=0.2)
+def met_gfssdJ5_3sopt_tr20(P, Q, data_source, n, r, prob_label=None):
+    return met_gfssdJ1_3sopt_tr50(P, Q, data_source, n, r, J=5, tr_proportion=0.2, prob_label=prob_label)
 
-def met_gfssdJ1_3sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
+def met_gfssdJ1_3sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5, prob_label=None):
     """
     FSSD-based model comparison test
         * Use J=1 test location by default (in the set V=W). 
@@ -335,7 +342,7 @@ def met_gfssdJ1_3sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
         Ztr = datrtr.data()
 
         # median heuristic to set the Gaussian widths
-        medz = util.meddistance(Ztr, subsample=1000)
+        medz = median.meddistance(Ztr)
         gwidth0 = medz**2
         # pick a subset of points in the training set for V, W
         V0 = util.subsample_rows(Ztr, J, seed=r+2)
@@ -350,7 +357,12 @@ def met_gfssdJ1_3sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
             'gwidth_ub': 10**2,
         }
 
-        V_opt, gw_opt, opt_info = mct.DC_GaussFSSD.optimize_power_criterion(p, q, datrtr, V0, gwidth0, **opt_options)
+        ws = None
+        if use_warm_start and prob_label is not None:
+            ws = warm_start_cache.lookup_for('ex%d'%ex, prob_label,
+                    'gfssd_3sopt_tr%d'%(100*tr_proportion), J, Ztr)
+        V_opt, gw_opt, opt_info = mct.DC_GaussFSSD.optimize_power_criterion(p,
+                q, datrtr, V0, gwidth0, warm_start=ws, **opt_options)
 
         dcfssd_opt = mct.DC_GaussFSSD(p, q, gw_opt, gw_opt, V_opt, V_opt, alpha=alpha)
         dcfssd_opt_result = dcfssd_opt.perform_test(datrte)
@@ -361,7 +373,7 @@ def met_gfssdJ1_3sopt_tr50(P, Q, data_source, n, r, J=1, tr_proportion=0.5):
             #'test':dcfssd_opt, 
             'test_result': dcfssd_opt_result, 'time_secs': t.secs}
 
-def met_gmmd_med(P, Q, data_source, n, r):
+def met_gmmd_med(P, Q, data_source, n, r, prob_label=None):
     """
     Use met_gmmd_med_bounliphone(). It uses the median heuristic following
     Bounliphone et al., 2016.
@@ -387,8 +399,7 @@ def met_gmmd_med(P, Q, data_source, n, r):
         X, Y, Z = datp.data(), datq.data(), datr.data()
 
         # hyperparameters of the test
-        medxz = util.meddistance(np.vstack((X, Z)), subsample=1000)
-        medyz = util.meddistance(np.vstack((Y, Z)), subsample=1000)
+        (medxz, medyz), _ = median.medians([X, Y, Z], pools=[(0, 2), (1, 2)])
         medxyz = np.mean([medxz, medyz])
         k = kernel.KGauss(sigma2=medxyz**2)
 
@@ -400,7 +411,7 @@ def met_gmmd_med(P, Q, data_source, n, r):
             #'test': scmmd, 
             'test_result': scmmd_result, 'time_secs': t.secs}
 
-def met_gmmd_med_bounliphone(P, Q, data_source, n, r):
+def met_gmmd_med_bounliphone(P, Q, data_source, n, r, prob_label=None):
     """
     Bounliphone et al., 2016's MMD-based 3-sample test.
     * Gaussian kernel. 
@@ -467,7 +478,8 @@ class Ex1Job(IndependentJob):
         logger.info("computing. %s. prob=%s, r=%d,\
                 n=%d"%(met_func.__name__, prob_label, r, n))
         with util.ContextTimer() as t:
-            job_result = met_func(P, Q, data_source, n, r)
+            job_result = met_func(P, Q, data_source, n, r,
+                    prob_label=prob_label)
 
             # create ScalarResult instance
             result = SingleResult(job_result)
@@ -531,6 +543,19 @@ method_funcs = [
 # If is_rerun==False, do not rerun the experiment if a result file for the current
 # setting already exists.
 is_rerun = False
+
+# If True, start the optimization of the test locations and Gaussian widths
+# from the optimum of a previous run (e.g., a previous trial or sample size)
+# of the same problem (prob_label). The optima are stored in a
+# kmod.warmstart.WarmStartCache under expr_configs['scratch_path']. Note that a
+# stored optimum may come from samples overlapping the current test set (e.g.,
+# the same trial with a different n).
+use_warm_start = False
+# maximum number of stored optima. Least recently used ones are removed.
+warm_start_max_entries = 2000
+# store of the optima. None if use_warm_start is False.
+warm_start_cache = (warmstart.WarmStartCache(max_entries=warm_start_max_entries)
+        if use_warm_start else None)
 #---------------------------
 
 def make_gmm_blobs_d2(distance_factor=5.0, ):
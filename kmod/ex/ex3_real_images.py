@@ -5,6 +5,9 @@ import os
 import sys
 from kmod import util, data, kernel
 from kmod.mctest import SC_MMD
+from kmod.mctest import SC_LinearMMD
+from kmod.mctest import SC_BlockMMD
+from kmod.mctest import SC_NystromMMD
 from kmod.mctest import SC_GaussUME
 import kmod.glo as glo
 from kmod.ex import exdata
@@ -128,6 +131,21 @@ def met_kid_mmd(mix_ratios, data_loader, n, r):
     return scmmd.perform_test(data.Data(Z))
 
 
+def met_kid_mmd_nystrom(mix_ratios, data_loader, n, r, n_landmarks=500):
+    """
+    Same as met_kid_mmd, but the Gram matrices are approximated with a
+    Nystrom factorization on n_landmarks landmarks (SC_NystromMMD).
+    """
+
+    sample_size = [n] * 3
+    X, Y, Z, _ = sample_data_mixing(mix_ratios, data_loader, sample_size, r)
+
+    k = kernel.KKID()
+    scmmd = SC_NystromMMD(data.Data(X), data.Data(Y), k, alpha,
+            n_landmarks=n_landmarks, seed=r+7)
+    return scmmd.perform_test(data.Data(Z))
+
+
 def met_kid(mix_ratios, data_loader, n, r):
     """
     Compute MMD with the KID kernel. Note that this is not a test.
@@ -264,6 +282,44 @@ def met_gmmd_med(mix_ratios, data_loader, n, r):
     return test_result
 
 
+def met_gmmd_med_lin(mix_ratios, data_loader, n, r):
+    """
+    Linear-time version of met_gmmd_med (SC_LinearMMD). Runs in O(n) time
+    and memory.
+    * Gaussian kernel.
+    * Gaussian width chosen as in SC_MMD.median_heuristic_bounliphone().
+    """
+
+    sample_size = [n] * 3
+    X, Y, Z, _ = sample_data_mixing(mix_ratios, data_loader, sample_size, r)
+    with util.ContextTimer() as t:
+        med2 = SC_MMD.median_heuristic_bounliphone(X, Y, Z, subsample=1000)
+        k = kernel.KGauss(med2)
+        sclmmd = SC_LinearMMD(data.Data(X), data.Data(Y), k, alpha)
+        test_result = sclmmd.perform_test(data.Data(Z))
+    test_result['time_secs'] = t.secs
+    return test_result
+
+
+def met_gmmd_med_block(mix_ratios, data_loader, n, r):
+    """
+    Block version of met_gmmd_med (SC_BlockMMD) with block size sqrt(n). Runs
+    in O(n^1.5) time and O(n) memory.
+    * Gaussian kernel.
+    * Gaussian width chosen as in SC_MMD.median_heuristic_bounliphone().
+    """
+
+    sample_size = [n] * 3
+    X, Y, Z, _ = sample_data_mixing(mix_ratios, data_loader, sample_size, r)
+    with util.ContextTimer() as t:
+        med2 = SC_MMD.median_heuristic_bounliphone(X, Y, Z, subsample=1000)
+        k = kernel.KGauss(med2)
+        scbmmd = SC_BlockMMD(data.Data(X), data.Data(Y), k, alpha)
+        test_result = scbmmd.perform_test(data.Data(Z))
+    test_result['time_secs'] = t.secs
+    return test_result
+
+
 def met_gume_J_1_v_dog_ci10(mix_ratios, data_loader, n, r, J=1):
     sample_size = [n] * 3 + [J]
 
@@ -727,7 +783,10 @@ class Ex3Job(IndependentJob):
 from kmod.ex.ex3_real_images import Ex3Job
 from kmod.ex.ex3_real_images import met_fid
 from kmod.ex.ex3_real_images import met_kid_mmd
+from kmod.ex.ex3_real_images import met_kid_mmd_nystrom
 from kmod.ex.ex3_real_images import met_gmmd_med
+from kmod.ex.ex3_real_images import met_gmmd_med_lin
+from kmod.ex.ex3_real_images import met_gmmd_med_block
 from kmod.ex.ex3_real_images import met_gume_J_10_v_nonsmile_celeba
 from kmod.ex.ex3_real_images import met_gume_J_10_v_smile_celeba
 from kmod.ex.ex3_real_images import met_gume_J_5_v_nonsmile_celeba
@@ -784,6 +843,8 @@ reps = 1
 # tests to try
 method_funcs = [
     met_gmmd_med,
+    # met_gmmd_med_lin,
+    # met_gmmd_med_block,
     # met_gume_J_5_v_smile_celeba,
     # met_gume_J_5_v_nonsmile_celeba,
     # met_gume_J_10_v_smile_celeba,
@@ -798,6 +859,7 @@ method_funcs = [
     # met_fid,
     # met_kid,
     met_kid_mmd,
+    # met_kid_mmd_nystrom,
     # met_fid_perm,
     # met_fid_nbstrp,
     met_gume_J_10_v_mix_celeba,
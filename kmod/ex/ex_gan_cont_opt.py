@@ -1,7 +1,7 @@
 # coding: utf-8
 import kmod
 # submodules
-from kmod import data, util
+from kmod import data, median, util
 from kmod import gan_ume_opt as go
 from kmod import torch_models as tm
 
@@ -102,8 +102,7 @@ def run_optimization(args, gp, gq, img_data, model_name, J=10):
 
     Zp0 = np.random.uniform(-1, 1, (J, gp.z_size))
     Zq0 = np.random.uniform(-1, 1, (J, gq.z_size))
-    XYZ = np.vstack((datap.data(), dataq.data(), datar.data()))
-    med2 = util.meddistance(XYZ, subsample=1000)**2
+    med2 = median.meddistance(datap.data(), dataq.data(), datar.data())**2
 
     if args.exp == 2:
         gp = gq
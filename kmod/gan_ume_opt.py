@@ -2,17 +2,19 @@ import autograd
 import autograd.numpy as np
 
 import scipy
-from numpy.core.umath_tests import inner1d
 import torch
 import torch.nn as nn
 from torch import optim
 from torch.autograd import Variable
-from torch.autograd.gradcheck import zero_gradients
-from kmod import data, kernel, util
+from kmod import data, kernel, median, util
 from kmod import ptkernel
 from kmod.mctest import SC_UME
+import kmod.mctest as mct
 from kmod import log
 
+import concurrent.futures
+import heapq
+import os
 import types
 import functools
 
@@ -21,7 +23,9 @@ gpu_mode = True
 gpu_id = 2
 image_size = 64
 model_input_size = 299
-batch_size = 128
+# batch size of extract_feats(). None to choose it from the available memory
+# (see auto_batch_size()).
+batch_size = None
 
 
 def set_gpu_mode(is_gpu):
@@ -93,8 +97,6 @@ def optimize_3sample_criterion(datap, dataq, datar, gen_p, gen_q, model, Zp0,
     X, Y, Z = datap.data(), dataq.data(), datar.data()
     n, dp = X.shape
 
-    global image_size
-
     def flatten(gwidth, V):
         return np.hstack((gwidth, V.reshape(-1)))
 
@@ -103,103 +105,14 @@ def optimize_3sample_criterion(datap, dataq, datar, gen_p, gen_q, model, Zp0,
         V = np.reshape(x[1:], (2*J, -1))
         return sqrt_gwidth, V
 
-    # Parameterize the Gaussian width with its square root (then square later)
-    # to automatically enforce the positivity.
-    def obj_feat_space(sqrt_gwidth, V):
-        k = kernel.KGauss(sqrt_gwidth**2)
-        return -SC_UME.power_criterion(datap, dataq, datar, k, k, V, V,
-                                       reg=reg)
-
-    def flat_obj_feat(x):
-        sqrt_gwidth, V = unflatten(x)
-        return obj_feat_space(sqrt_gwidth, V)
-
-    def obj_noise_space(sqrt_gwidth, z):
-        zp = z[:J]
-        zq = z[J:]
-        torch_zp = to_torch_variable(zp, shape=(-1, zp.shape[1], 1, 1))
-        torch_zq = to_torch_variable(zq, shape=(-1, zq.shape[1], 1, 1))
-        # need preprocessing probably
-        global model_input_size
-        s = model_input_size
-        upsample = nn.Upsample(size=(s, s), mode='bilinear')
-        fp = model(upsample(gen_p(torch_zp))).cpu().data.numpy()
-        fp = fp.reshape((J, -1))
-        fq = model(upsample(gen_q(torch_zq))).cpu().data.numpy()
-        fq = fq.reshape((J, -1))
-        F = np.vstack([fp, fq])
-        return obj_feat_space(sqrt_gwidth, F)
-
-    def flat_obj_noise(x):
-        sqrt_gwidth, z = unflatten(x)
-        return obj_noise_space(sqrt_gwidth, z)
-
-    def grad_power_noise(x):
-        """
-        Compute the gradient of the power criterion with respect to the width of Gaussian
-        RBF kernel and the noise vector.
-
-        Args:
-            x: 1 + 2J*d_n vector
-        Returns:
-            the gradient of the power criterion with respect to kernel width/latent vector
-        """
-
-        with util.ContextTimer() as t:
-            width, z = unflatten(x)
-            zp = z[:J]
-            zq = z[J:]
-
-            # Compute the Jacobian of the generators with respect to noise vector
-            torch_zp = to_torch_variable(zp, shape=(-1, zp.shape[1], 1, 1),
-                                         requires_grad=True)
-            torch_zq = to_torch_variable(zq, shape=(-1, zq.shape[1], 1, 1),
-                                         requires_grad=True)
-            gp_grad = compute_jacobian(torch_zp, gen_p(torch_zp).view(J, -1))  # J x d_pix x d_noise x 1 x 1
-            gq_grad = compute_jacobian(torch_zq, gen_q(torch_zq).view(J, -1))  # J x d_pix x d_noise x 1 x 1
-            v_grad_z = np.vstack([gp_grad, gq_grad])
-            v_grad_z = np.squeeze(v_grad_z, [3, 4])  # 2J x d_pix x d_noise
-            
-            # Compute the Jacobian of the feature extractor with respect to noise vector
-            vp_flatten = to_torch_variable(
-                gen_p(torch_zp).view(J, -1).cpu().data.numpy(),
-                shape=(J, 3, image_size, image_size),
-                requires_grad=True
-            )
-            vq_flatten = to_torch_variable(
-                gen_q(torch_zq).view(J, -1).cpu().data.numpy(),
-                shape=(J, 3, image_size, image_size),
-                requires_grad=True
-            )
-            size = (model_input_size, model_input_size)
-            upsample = nn.Upsample(size=size, mode='bilinear')
-            fp = model(upsample(vp_flatten))
-            fq = model(upsample(vq_flatten))
-            fp_grad = compute_jacobian(vp_flatten, fp.view(J, -1))  # J x d_nn x C x H x W
-            fq_grad = compute_jacobian(vq_flatten, fq.view(J, -1))  # J x d_nn x C x H x W
-            f_grad_v = np.vstack([fp_grad, fq_grad])
-            f_grad_v = f_grad_v.reshape((2*J, f_grad_v.shape[1], -1))  # 2J x d_nn x d_pix
-
-            # Compute the gradient of the objective function with respect to
-            # the gaussian width and test locations
-            F = np.vstack([fp.cpu().data.numpy(), fq.cpu().data.numpy()])
-            F = np.reshape(F, (2*J, -1))
-            grad_obj = autograd.elementwise_grad(flat_obj_feat)  # 1+(2J)*d_nn input
-            obj_grad_f = grad_obj(flatten(width, F))
-            obj_grad_width = obj_grad_f[0]
-            obj_grad_f = np.reshape(obj_grad_f[1:], [(2*J), -1])  # 2J x d_nn array
-
-            obj_grad_v = inner1d(obj_grad_f, np.transpose(f_grad_v, (2, 0, 1)))  # 2J x d_pix
-            obj_grad_z = inner1d(obj_grad_v.T, np.transpose(v_grad_z, (2, 0, 1))).flatten()
-
-        return np.concatenate([obj_grad_width.reshape([1]), obj_grad_z]) 
+    obj_grad_noise = noise_space_obj_grad(datap, dataq, datar, gen_p, gen_q,
+                                          model, J, reg=reg)
 
     # Initial point
     x0 = flatten(np.sqrt(gwidth0), Z0)
 
     # make sure that the optimized gwidth is not too small or too large.
-    XYZ = np.vstack((X, Y, Z))
-    med2 = util.meddistance(XYZ, subsample=1000)**2
+    med2 = median.meddistance(X, Y, Z)**2
     fac_min = 1e-2
     fac_max = 1e2
     if gwidth_lb is None:
@@ -228,14 +141,14 @@ def optimize_3sample_criterion(datap, dataq, datar, gen_p, gen_q, model, Zp0,
     # https://docs.scipy.org/doc/scipy/reference/optimize.minimize-lbfgsb.html
     with util.ContextTimer() as timer:
         opt_result = scipy.optimize.minimize(
-            flat_obj_noise, x0,
+            obj_grad_noise, x0,
             method='L-BFGS-B', bounds=x0_bounds,
             tol=tol_fun,
             options={
                 'maxiter': max_iter, 'ftol': tol_fun, 'disp': disp,
                 'gtol': 1.0e-08,
             },
-            jac=grad_power_noise
+            jac=True,
         )
 
     opt_result = dict(opt_result)
@@ -248,6 +161,100 @@ def optimize_3sample_criterion(datap, dataq, datar, gen_p, gen_q, model, Zp0,
     return Z_opt, gw_opt, opt_result
 
 
+def noise_space_obj_grad(datap, dataq, datar, gen_p, gen_q, model, J,
+                         reg=1e-3):
+    """
+    Return the objective function of optimize_3sample_criterion(). The
+    returned function maps x = [sqrt of the Gaussian width^2, noise vectors
+    of the J locations of gen_p, noise vectors of the J locations of gen_q
+    (flattened)] to (the negative power criterion of the UME three-sample
+    test with the features of the generated images as the test locations,
+    its gradient with respect to x). The images and the features are
+    computed once for both. The gradient is pulled back through the feature
+    extractor and the generators with one backward pass. The result at the
+    last evaluated point is memoized, since scipy may evaluate the same x
+    again.
+
+    Args:
+        - datap, dataq, datar: kgof.data.Data (features) from P, Q, R
+        - gen_p, gen_q: pytorch generators of the models P, Q
+        - model: a feature extractor applied to generated images
+        - J: the number of locations of each model
+        - reg: reg to add to the mean/sqrt(variance) criterion to become
+            mean/sqrt(variance + reg)
+    """
+    def flatten(gwidth, V):
+        return np.hstack((gwidth, V.reshape(-1)))
+
+    def unflatten(x):
+        sqrt_gwidth = x[0]
+        V = np.reshape(x[1:], (2*J, -1))
+        return sqrt_gwidth, V
+
+    # Parameterize the Gaussian width with its square root (then square later)
+    # to automatically enforce the positivity.
+    def flat_obj_feat(x):
+        sqrt_gwidth, V = unflatten(x)
+        k = kernel.KGauss(sqrt_gwidth**2)
+        return -SC_UME.power_criterion(datap, dataq, datar, k, k, V, V,
+                                       reg=reg)
+
+    size = (model_input_size, model_input_size)
+    upsample = nn.Upsample(size=size, mode='bilinear')
+    # the last evaluated point and its (objective, gradient)
+    last_eval = {}
+
+    def obj_grad_noise(x):
+        """
+        Args:
+            x: 1 + 2J*d_n vector
+        Returns:
+            (objective, gradient with respect to kernel width/latent vector)
+        """
+        if 'x' in last_eval and np.array_equal(last_eval['x'], x):
+            return last_eval['value'], last_eval['grad']
+
+        width, z = unflatten(x)
+        zp = z[:J]
+        zq = z[J:]
+        torch_zp = to_torch_variable(zp, shape=(-1, zp.shape[1], 1, 1),
+                                     requires_grad=True)
+        torch_zq = to_torch_variable(zq, shape=(-1, zq.shape[1], 1, 1),
+                                     requires_grad=True)
+        fp = model(upsample(gen_p(torch_zp))).view(J, -1)
+        fq = model(upsample(gen_q(torch_zq))).view(J, -1)
+
+        # Objective and its gradient with respect to the Gaussian width and
+        # the test locations in the feature space
+        F = np.vstack([fp.cpu().data.numpy(), fq.cpu().data.numpy()])
+        value, obj_grad_f = autograd.value_and_grad(flat_obj_feat)(
+            flatten(width, F))  # 1+(2J)*d_nn input
+        obj_grad_width = obj_grad_f[0]
+        obj_grad_f = np.reshape(obj_grad_f[1:], [(2*J), -1])  # 2J x d_nn array
+
+        # Pull the gradient back through the feature extractor and the
+        # generators with one backward pass (a vector-Jacobian product),
+        # instead of forming the Jacobians. Only the gradients with respect
+        # to the noise vectors are computed. The .grad of the parameters of
+        # the networks are not touched.
+        grad_fp = torch.from_numpy(obj_grad_f[:J]).to(fp)
+        grad_fq = torch.from_numpy(obj_grad_f[J:]).to(fq)
+        grad_zp, grad_zq = torch.autograd.grad([fp, fq], [torch_zp, torch_zq],
+                                               [grad_fp, grad_fq])
+        obj_grad_z = np.vstack([
+            grad_zp.cpu().data.numpy().reshape(J, -1),
+            grad_zq.cpu().data.numpy().reshape(J, -1),
+        ]).astype(np.float64).flatten()
+
+        grad = np.concatenate([obj_grad_width.reshape([1]), obj_grad_z])
+        last_eval['x'] = np.copy(x)
+        last_eval['value'] = value
+        last_eval['grad'] = grad
+        return value, grad
+
+    return obj_grad_noise
+
+
 def to_torch_variable(a, shape=None, requires_grad=False):
     """Convert array a to torch.autograd.Variable"""
     if shape is None:
@@ -257,8 +264,8 @@ def to_torch_variable(a, shape=None, requires_grad=False):
         v = Variable(torch.from_numpy(a).float().view(shape).cuda(gpu_id),
                      requires_grad=requires_grad)
     else:
-        v = Variable(torch.from_numpy(a), requires_grad=requires_grad)
-        v = v.float().view(shape)
+        v = Variable(torch.from_numpy(a).float().view(shape),
+                     requires_grad=requires_grad)
     return v
 
 
@@ -287,35 +294,6 @@ def apply_to_models(inputs, models, return_variable=False, requires_grad=False):
         return samples
 
 
-# modify this later
-def compute_jacobian(inputs, output):
-    """
-    :param inputs: Batch X Size (Torch)
-    :param output: Batch X Classes
-    :return: jacobian: Batch X Classes X Size, numpy array
-    """
-    assert inputs.requires_grad
-
-    num_classes = output.size()[1]
-
-    jacobian = np.zeros((num_classes,) + tuple(inputs.size()))
-    grad_output = torch.zeros(*output.size())
-    if inputs.is_cuda:
-        global gpu_id
-        grad_output = grad_output.cuda(gpu_id)
-
-    for i in range(num_classes):
-        zero_gradients(inputs)
-        grad_output.zero_()
-        grad_output[:, i] = 1
-        output.backward(grad_output, retain_graph=True)
-        jacobian[i] = inputs.grad.cpu().data.numpy()
-
-    # return torch.transpose(jacobian, dim0=0, dim1=1)
-    s = tuple(range(len(jacobian.shape)))
-    return np.transpose(jacobian, (1, 0,) + s[2:])
-
-
 def kernel_feat_decorator_with(model):
     """Add an extra feature extracion with the given torch model"""
 
@@ -370,42 +348,119 @@ def decorate_all_methods_with(decorator):
     return decorate_all_methods
 
 
-def extract_feats(X, model, upsample=False):
+def available_memory():
+    """
+    Return the number of bytes of memory currently available on the device
+    of the models (the GPU gpu_id if gpu_mode, else the host), or None if it
+    cannot be determined.
+    """
+    if gpu_mode:
+        free, _ = torch.cuda.mem_get_info(gpu_id)
+        return free
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def auto_batch_size(image_shape, mem_frac=0.25, act_factor=32, min_size=1,
+                    max_size=1024, default=128):
+    """
+    Choose the batch size of extract_feats() from the available memory
+    (available_memory()).
+
+    Args:
+        - image_shape: shape of one (upsampled) input image e.g. (3, 299, 299)
+        - mem_frac: fraction of the available memory that a batch may use
+        - act_factor: estimated memory used by the model for one image as a
+            multiple of the size of the float32 input image (activations of
+            the feature extractor)
+        - min_size, max_size: bounds on the batch size
+        - default: batch size used when the available memory is unknown
+    Returns:
+        - the batch size
+    """
+    avail = available_memory()
+    if avail is None:
+        return default
+    bytes_per_image = 4*act_factor*int(np.prod(image_shape))
+    size = int(mem_frac*avail // bytes_per_image)
+    return int(min(max(size, min_size), max_size))
+
+
+def extract_feats(X, model, upsample=False, out=None):
     """
     Extract features using model. 
+
+    The images are processed in batches of batch_size (see set_batch_size()
+    and auto_batch_size()) without recording the graph for autograd. A
+    background thread prepares (reads, converts to float32 and copies to the
+    device) the next batch while the model runs on the current one. The
+    features are written into one preallocated array.
+
     Args:
-        - X: an nxd numpy array representing a set of RGB images
+        - X: an nxd numpy array (or memmap) representing a set of RGB images
         - model: a pytorch model
+        - upsample: True to upsample the images to model_input_size x
+            model_input_size before applying the model
+        - out: None, or a preallocated nxd' numpy array (or memmap, e.g.,
+            from np.lib.format.open_memmap()) to write the features into
     Returns:
         - feat_X: an nxd' numpy array representing extracted features
-        of the dimenstionality d'
+        of the dimenstionality d'. This is out if out is not None.
     """
-    global batch_size
     n = X.shape[0]
-    width = int((X.size / (3 * n))**0.5)
+    width = int((int(np.prod(X.shape[1:])) / 3)**0.5)
     X = X.reshape((n, 3, width, width))
-    # print('X.shape: {}'.format(X.shape))
-    feat_X = []
-
-    for i in range(0, n, batch_size):
-        V = X[i: i+batch_size]
-        V_ = to_torch_variable(V)
-        if upsample:
-            global model_input_size
-            m = nn.Upsample((model_input_size, model_input_size),
-                            mode='bilinear')
-            V_ = m(V_)
-        fX = model(V_).cpu().data.numpy()
-        fX = fX.reshape((fX.shape[0], -1))
-        # print('fX.shape: {}'.format(fX.shape))
-        feat_X.append(fX)
-    feat_X = np.vstack(feat_X)
-    return feat_X
+    if n == 0 and out is not None:
+        return out
+    if upsample:
+        up = nn.Upsample((model_input_size, model_input_size), mode='bilinear')
+        input_shape = (3, model_input_size, model_input_size)
+    else:
+        input_shape = (3, width, width)
+    b = batch_size
+    if b is None:
+        b = auto_batch_size(input_shape)
+
+    def prepare(i):
+        V = np.ascontiguousarray(X[i: i+b], dtype=np.float32)
+        V_ = torch.from_numpy(V)
+        if gpu_mode:
+            V_ = V_.cuda(gpu_id, non_blocking=True)
+        return V_
+
+    if n == 0:
+        # Run the model on an empty batch for the feature dimension.
+        with torch.no_grad():
+            V_ = prepare(0)
+            if upsample:
+                V_ = up(V_)
+            fX = model(V_).cpu().numpy()
+        return np.empty((0, int(np.prod(fX.shape[1:]))), dtype=fX.dtype)
+
+    starts = list(range(0, n, b))
+    with torch.no_grad(), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        next_batch = pool.submit(prepare, starts[0])
+        for bi, i in enumerate(starts):
+            V_ = next_batch.result()
+            if bi + 1 < len(starts):
+                next_batch = pool.submit(prepare, starts[bi + 1])
+            if upsample:
+                V_ = up(V_)
+            fX = model(V_).cpu().numpy()
+            fX = fX.reshape((fX.shape[0], -1))
+            if out is None:
+                out = np.empty((n, fX.shape[1]), dtype=fX.dtype)
+            out[i: i+fX.shape[0]] = fX
+    return out
 
 
 def opt_greedy_3sample_criterion(datap, dataq, datar, locs,
                                  k, J, reg=1e-3, maximize=True,
-                                 featurizer=None):
+                                 featurizer=None, method='greedy', eps=0.1,
+                                 seed=1):
     """
     Obtains a set of J test locations by maximizing (or minimizing)
     the power criterion of the UME three-sample test.
@@ -425,6 +480,8 @@ def opt_greedy_3sample_criterion(datap, dataq, datar, locs,
         - maximize: if True, maximize the power criterion, otherwise minimize
         - featurizer: if given, the data is tranformed by the given feature
           extractor model
+        - method, eps, seed: the variant of the greedy selection. See
+          greedy_search_ume().
 
     Returns:
         A set of indices representing obtained locations
@@ -445,36 +502,168 @@ def opt_greedy_3sample_criterion(datap, dataq, datar, locs,
         dr = data.Data(dr)
         fV = featurizer(locs).cpu().data.numpy()
 
-    def obj(V):
-        if len(V.shape) < 2:
-            V = V.reshape((-1,) + V.shape)
-        if maximize:
-            return SC_UME.power_criterion(dp, dq, dr, k, k, V, V,
-                                          reg=reg)
-        else:
-            return -SC_UME.power_criterion(dp, dq, dr, k, k, V, V,
-                                           reg=reg)
+    return greedy_search_ume(dp.data(), dq.data(), dr.data(), fV, k, J,
+                             reg=reg, maximize=maximize, method=method,
+                             eps=eps, seed=seed)
+
+
+def greedy_search_ume(X, Y, Z, loc_pool, k, num_locs, reg=1e-3,
+                      maximize=True, method='greedy', eps=0.1, seed=1,
+                      return_info=False):
+    """
+    Greedy forward selection of num_locs test locations from loc_pool for
+    the power criterion SC_UME.power_criterion(.., k, k, V, V, reg) of the
+    UME three-sample test with the same locations V for UME(P, R) and
+    UME(Q, R).
+
+    The feature column k(X, v) - k(Z, v) (and k(Y, v) - k(Z, v)) of each
+    candidate v is computed once. The criterion of the chosen set plus a
+    candidate is a rank-one update of running sums of the chosen set, so
+    scoring a candidate costs O(n) instead of recomputing the features of
+    the chosen set. Memory usage is O(n*n_c) for n_c candidates.
+
+    Args:
+        - X, Y, Z: n x d numpy arrays. Samples from P, Q, R.
+        - loc_pool: an n_c x d numpy array of candidate locations
+        - k: a kernel object
+        - num_locs: the number of test locations to choose
+        - reg: reg to add to the mean/sqrt(variance) criterion to become
+            mean/sqrt(variance + reg)
+        - maximize: if True, maximize the power criterion, otherwise minimize
+        - method:
+            - 'greedy': score all the remaining candidates in each round.
+            - 'lazy': lazy greedy. Keep the marginal gains of the
+              candidates (computed in earlier rounds) in a priority queue,
+              and re-score only the head of the queue until it stays on top.
+              Same as 'greedy' if the marginal gains do not increase as the
+              chosen set grows (submodularity), which the power criterion
+              does not guarantee.
+            - 'stochastic': stochastic greedy. In each round, score only
+              a random subset of n_c/num_locs*log(1/eps) remaining
+              candidates.
+        - eps: parameter of the subset size of method 'stochastic'. Must be
+            in (0, 1).
+        - seed: random seed of method 'stochastic'
+        - return_info: if True, also return a dictionary with key n_evals
+            (the number of evaluated criteria of candidate sets)
 
-    def greedy_search(num_locs, loc_pool):
-        best_loc_idx = []
-        n = loc_pool.shape[0]
-        current_pool_idx_set = set(range(n))
+    Returns:
+        A list of num_locs indices of loc_pool in the order of selection
+        [and the dictionary if return_info]
+    """
+    if method not in ['greedy', 'lazy', 'stochastic']:
+        raise ValueError('method must be "greedy", "lazy" or "stochastic". Was {}'.format(method))
+    n = Z.shape[0]
+    n_c = loc_pool.shape[0]
+    if num_locs > n_c:
+        raise ValueError('num_locs must not exceed the number of candidates. Was {}'.format(num_locs))
+    if method == 'stochastic' and not 0 < eps < 1:
+        raise ValueError('eps must be in (0, 1). Was {}'.format(eps))
+    Kzv = k.eval(Z, loc_pool)
+    # n x n_c feature columns (not yet divided by sqrt(J)) of UME(P, R) and
+    # UME(Q, R)
+    A = k.eval(X, loc_pool) - Kzv
+    B = k.eval(Y, loc_pool) - Kzv
+    del Kzv
+    # per-candidate means and second moments
+    mu_a = np.mean(A, 0)
+    mu_b = np.mean(B, 0)
+    m_aa = np.mean(A**2, 0)
+    m_bb = np.mean(B**2, 0)
+    m_ab = np.mean(A*B, 0)
+
+    # Running sums of the chosen set S (as in ustat_h1_mean_variance() and
+    # rel_ustat_h1_mean_variance() of kmod.mctest):
+    # s_a = sum_{j in S} mu_a[j]^2, q_a = sum_{j in S} mean(A[:, j]**2),
+    # u_a = A[:, S].dot(mu_a[S]), and the same for B.
+    st = {'s_a': 0.0, 's_b': 0.0, 'q_a': 0.0, 'q_b': 0.0,
+          'u_a': np.zeros(n), 'u_b': np.zeros(n), 'm': 0, 'n_evals': 0}
+
+    def score(idx):
+        """
+        The objective (the power criterion, negated if not maximize) of S
+        plus each candidate in the index array idx. nan becomes -inf.
+        """
+        u_a, u_b = st['u_a'], st['u_b']
+        A_c, B_c = A[:, idx], B[:, idx]
+        ma, mb = mu_a[idx], mu_b[idx]
+        # mean(u_a*A[:, c]) etc.
+        ua_a = u_a.dot(A_c)/n
+        ub_b = u_b.dot(B_c)/n
+        ua_b = u_a.dot(B_c)/n
+        ub_a = u_b.dot(A_c)/n
+        # the sums after adding each candidate
+        s_a2 = st['s_a'] + ma**2
+        s_b2 = st['s_b'] + mb**2
+        # mean(u_a'**2), mean(u_b'**2), mean(u_a'*u_b') where
+        # u_a' = u_a + A[:, c]*mu_a[c]
+        uu_a = np.mean(u_a**2) + 2.0*ma*ua_a + ma**2*m_aa[idx]
+        uu_b = np.mean(u_b**2) + 2.0*mb*ub_b + mb**2*m_bb[idx]
+        uu_ab = (np.mean(u_a*u_b) + mb*ua_b + ma*ub_a
+                 + ma*mb*m_ab[idx])
+        # The features are divided by sqrt(m) for m locations.
+        m = st['m'] + 1
+        mean_p = (s_a2*n/float(n-1) - (st['q_a'] + m_aa[idx])/float(n-1))/m
+        mean_q = (s_b2*n/float(n-1) - (st['q_b'] + m_bb[idx])/float(n-1))/m
+        var_p = 4.0*(uu_a - s_a2**2)/m**2
+        var_q = 4.0*(uu_b - s_b2**2)/m**2
+        var_pq = 4.0*(uu_ab - s_a2*s_b2)/m**2
+        with np.errstate(invalid='ignore'):
+            scores = (mean_p - mean_q)/np.sqrt(var_p - 2.0*var_pq + var_q + reg)
+        if not maximize:
+            scores = -scores
+        st['n_evals'] += len(idx)
+        return np.where(np.isnan(scores), -np.inf, scores)
+
+    def add(c):
+        st['s_a'] += mu_a[c]**2
+        st['s_b'] += mu_b[c]**2
+        st['q_a'] += m_aa[c]
+        st['q_b'] += m_bb[c]
+        st['u_a'] = st['u_a'] + A[:, c]*mu_a[c]
+        st['u_b'] = st['u_b'] + B[:, c]*mu_b[c]
+        st['m'] += 1
+
+    chosen = []
+    available = np.ones(n_c, dtype=bool)
+    if method == 'lazy':
+        # The first round scores all the candidates. The objective of the
+        # empty set is taken to be 0.
+        gains = score(np.arange(n_c))
+        # min-heap of (-marginal gain, index)
+        heap = [(-g, c) for c, g in enumerate(gains)]
+        heapq.heapify(heap)
+        value = 0.0
+        while len(chosen) < num_locs:
+            _, c = heapq.heappop(heap)
+            if len(chosen) > 0:
+                gain = score(np.array([c]))[0] - value
+                if len(heap) > 0 and gain < -heap[0][0]:
+                    # no longer on top. Put back with the updated gain.
+                    heapq.heappush(heap, (-gain, c))
+                    continue
+            else:
+                gain = gains[c]
+            chosen.append(c)
+            value = value + gain
+            add(c)
+    else:
+        rng = np.random.RandomState(seed)
+        if method == 'stochastic':
+            subset_size = max(1, int(np.ceil(n_c/float(num_locs)*np.log(1.0/eps))))
+        else:
+            subset_size = n_c
         for _ in range(num_locs):
-            best_locs = loc_pool[best_loc_idx]
-            max_val = -np.inf
-            for k in current_pool_idx_set:
-                V = np.vstack([loc_pool[[k]], best_locs])
-                # evaluate the power criterion (score)
-                score = obj(V)
-                if score > max_val:
-                    max_val = score
-                    best_idx = k
-            best_loc_idx.append(best_idx)
-            current_pool_idx_set.remove(best_idx)
-            # print(best_loc_idx)
-        return best_loc_idx
-
-    return greedy_search(J, fV)
+            idx = np.flatnonzero(available)
+            if subset_size < len(idx):
+                idx = rng.choice(idx, subset_size, replace=False)
+            best = int(idx[np.argmax(score(idx))])
+            chosen.append(best)
+            available[best] = False
+            add(best)
+    if return_info:
+        return chosen, {'n_evals': st['n_evals']}
+    return chosen
 
 
 def ume_ustat_h1_mean_variance(feature_matrix, return_variance=True, 
@@ -495,15 +684,12 @@ def ume_ustat_h1_mean_variance(feature_matrix, return_variance=True,
     n = Z.size(0)
     assert n > 1, 'Need n > 1 to compute the mean of the statistic.'
     if use_unbiased:
-        # t1 = np.sum(np.mean(Z, axis=0)**2)*(n/float(n-1))
-        t1 = torch.sum(torch.mean(Z, dim=0)**2).mul(n).div(n-1)
-        # t2 = np.mean(np.sum(Z**2, axis=1))/float(n-1)
-        t2 = torch.mean(torch.sum(Z**2, dim=1)).div(n-1)
-        mean_h1 = t1 - t2
-    else:
-        # mean_h1 = np.sum(np.mean(Z, axis=0)**2)
-        mean_h1 = torch.sum(torch.mean(Z, dim=0)**2)
+        # same formulas as the numpy tests in kmod.mctest
+        return mct.ustat_h1_mean_variance(Z, return_variance=return_variance,
+                backend='torch')
 
+    # mean_h1 = np.sum(np.mean(Z, axis=0)**2)
+    mean_h1 = torch.sum(torch.mean(Z, dim=0)**2)
     if return_variance:
         # compute the variance 
         # mu = np.mean(Z, axis=0)  # length-J vector
@@ -528,26 +714,14 @@ def ume_feature_matrix(X, Y, V, k):
 def ume_power_criterion(X, Y, Z, Vp, Vq, k, reg):
     fea_pr = ume_feature_matrix(X, Z, Vp, k)  # n x Jp
     fea_qr = ume_feature_matrix(Y, Z, Vq, k)  # n x Jq
-    umehp, var_pr = ume_ustat_h1_mean_variance(fea_pr, return_variance=True,
-                                               use_unbiased=True)
-    umehq, var_qr = ume_ustat_h1_mean_variance(fea_qr, return_variance=True,
-                                               use_unbiased=True)
+    # same statistic as SC_UME with the torch backend
+    mean_h1, var_h1, var_pr, var_qr, _ = mct.rel_ustat_h1_mean_variance(
+        fea_pr, fea_qr, backend='torch')
 
     if (var_pr <= 0).any():
         log.l().warning('Non-positive var_pr detected. Was {}'.format(var_pr))
     if (var_qr <= 0).any():
         log.l().warning('Non-positive var_qr detected. War {}'.format(var_qr))
-    mean_h1 = umehp - umehq
-
-    # mean features
-    mean_pr = torch.mean(fea_pr, dim=0)
-    mean_qr = torch.mean(fea_qr, dim=0)
-    t1 = 4.0*torch.mean(torch.matmul(fea_pr, mean_pr)*torch.matmul(fea_qr, mean_qr))
-    t2 = 4.0*torch.sum(mean_pr**2)*torch.sum(mean_qr**2)
-
-    # compute the cross-covariance
-    var_pqr = t1 - t2
-    var_h1 = var_pr - 2.0*var_pqr + var_qr
 
     power_criterion = mean_h1 / torch.sqrt(var_h1 + reg)
     return power_criterion
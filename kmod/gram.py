@@ -0,0 +1,309 @@
+"""
+Module containing a tiled engine for accumulating the sums of Gram matrices
+needed by the MMD-based relative test (SC_MMD) without forming any n x n
+matrix.
+"""
+
+__author__ = 'wittawat'
+
+from builtins import object
+from builtins import range
+
+import concurrent.futures
+import os
+
+# The tiled engine only accumulates sums. Nothing is differentiated there.
+# (See RelMMDGramStats.from_grams() for differentiable statistics.)
+import numpy as np
+import kmod.backend as kbackend
+
+
+def tile_slices(n, tile_size):
+    """
+    Return a list of slices partitioning range(n) into consecutive tiles of
+    at most tile_size indices.
+    """
+    if tile_size <= 0:
+        raise ValueError('tile_size must be positive. Was {}'.format(tile_size))
+    return [slice(i, min(i+tile_size, n)) for i in range(0, n, tile_size)]
+
+
+def _zero_diag(K):
+    K = np.array(K, dtype=float)
+    np.fill_diagonal(K, 0.0)
+    return K
+
+
+class RelMMDGramStats(object):
+    """
+    Row sums, squared sums and cross sums of the Gram matrices Kxx, Kyy, Kzz,
+    Kxz, Kyz (all n x n) needed to compute
+        * the quadratic-time MMD^2 U-statistics MMD_u^2(X, Z), MMD_u^2(Y, Z)
+          and their variances (as in freqopttest.tst.QuadMMDTest.h1_mean_var),
+        * the covariance of the two U-statistics (Bounliphone et al., 2016),
+          as in kmod.mctest.SC_MMD.get_cross_covariance().
+
+    Only O(n) numbers are stored. Use RelMMDGramStats.compute() to construct.
+    All the samples must have the same sample size n.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        # row sums of the Gram matrices with the diagonal removed
+        self.rs_xx = np.zeros(n)
+        self.rs_yy = np.zeros(n)
+        self.rs_zz = np.zeros(n)
+        # rs_xz[i] = sum_j k(x_i, z_j). cs_xz[j] = sum_i k(x_i, z_j)
+        self.rs_xz = np.zeros(n)
+        self.cs_xz = np.zeros(n)
+        self.rs_yz = np.zeros(n)
+        self.cs_yz = np.zeros(n)
+        # sums of squared entries (diagonal removed for xx, yy, zz)
+        self.sq_xx = 0.0
+        self.sq_yy = 0.0
+        self.sq_zz = 0.0
+        self.sq_xz = 0.0
+        self.sq_yz = 0.0
+        # traces of Kxz and Kyz
+        self.tr_xz = 0.0
+        self.tr_yz = 0.0
+        # sum((Kxxd + Kzzd - Kxzd - Kxzd')**2) where *d means the diagonal
+        # is removed. Used in the second-order term of the variance.
+        self.so_xz = 0.0
+        self.so_yz = 0.0
+
+    @staticmethod
+    def compute(X, Y, Z, k, tile_size=512, n_threads=None, cache=None,
+            backend=None):
+        """
+        Evaluate the Gram matrices tile by tile and accumulate the sums. Each
+        kernel entry is evaluated at most once (Kxx, Kyy, Kzz only on the
+        upper-triangular tiles). Tiles are processed on a thread pool.
+
+        :param X: n x d numpy array (sample from P)
+        :param Y: n x d numpy array (sample from Q)
+        :param Z: n x d numpy array (sample from R)
+        :param k: a kernel object with eval(X1, X2)
+        :param tile_size: number of points in each tile. Peak memory is about
+            7*tile_size^2 floats per thread.
+        :param n_threads: number of threads. None to use the number of CPUs.
+        :param cache: a dictionary of precomputed full Gram matrices with
+            (optional) keys 'xx', 'yy', 'xz', 'yz' for k(X, X), k(Y, Y),
+            k(X, Z), k(Y, Z). The tiles of these are sliced instead of
+            evaluated. Useful when X, Y are fixed and Z varies.
+        :param backend: a numpy backend of kmod.backend ('numpy' or
+            'autograd') for evaluating the kernel on the tiles with
+            backend.kernel_eval(). None to call k.eval(). With 'numpy', the
+            Gaussian kernel is evaluated with plain numpy.
+
+        :returns: a RelMMDGramStats
+        """
+        n = X.shape[0]
+        if Y.shape[0] != n or Z.shape[0] != n:
+            raise ValueError('X, Y, Z must have the same sample size. Were {}, {}, {}'.format(
+                n, Y.shape[0], Z.shape[0]))
+        if n_threads is None:
+            n_threads = os.cpu_count() or 1
+        slices = tile_slices(n, tile_size)
+        T = len(slices)
+        tile_pairs = [(slices[a], slices[b]) for a in range(T) for b in range(a, T)]
+
+        if cache is None:
+            cache = {}
+        B = kbackend.get(backend)
+
+        def eval_tile(pair):
+            sa, sb = pair
+            return RelMMDGramStats._tile_sums(X, Y, Z, k, sa, sb, cache, B)
+
+        gs = RelMMDGramStats(n)
+        if n_threads <= 1 or len(tile_pairs) <= 1:
+            partials = map(eval_tile, tile_pairs)
+            for part in partials:
+                gs._add_tile(part)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as pool:
+                for part in pool.map(eval_tile, tile_pairs):
+                    gs._add_tile(part)
+        return gs
+
+    @staticmethod
+    def _tile_sums(X, Y, Z, k, sa, sb, cache, B):
+        """
+        Compute the contributions of the tile (sa, sb) (and its transpose if
+        sa != sb) to all the sums.
+        Return a list of (attribute name, slice or None, value) to add.
+        """
+        samples = {'x': X, 'y': Y, 'z': Z}
+
+        def gram_tile(name, s1, s2):
+            if name in cache:
+                return cache[name][s1, s2]
+            return B.kernel_eval(k, samples[name[0]][s1], samples[name[1]][s2])
+
+        is_diag = sa == sb
+        Kzz = gram_tile('zz', sa, sb)
+        Kxx = gram_tile('xx', sa, sb)
+        Kyy = gram_tile('yy', sa, sb)
+        Kxz = gram_tile('xz', sa, sb)
+        Kyz = gram_tile('yz', sa, sb)
+        out = []
+        if is_diag:
+            Kzz = _zero_diag(Kzz)
+            Kxx = _zero_diag(Kxx)
+            Kyy = _zero_diag(Kyy)
+            for name, K in [('zz', Kzz), ('xx', Kxx), ('yy', Kyy)]:
+                out.append(('rs_'+name, sa, np.sum(K, 1)))
+                out.append(('sq_'+name, None, np.sum(K**2)))
+            for name, K, Kaa in [('xz', Kxz, Kxx), ('yz', Kyz, Kyy)]:
+                out.append(('rs_'+name, sa, np.sum(K, 1)))
+                out.append(('cs_'+name, sa, np.sum(K, 0)))
+                out.append(('sq_'+name, None, np.sum(K**2)))
+                out.append(('tr_'+name, None, np.trace(K)))
+                Kd = _zero_diag(K)
+                M = Kaa + Kzz - Kd - Kd.T
+                out.append(('so_'+name, None, np.sum(M**2)))
+        else:
+            for name, K in [('zz', Kzz), ('xx', Kxx), ('yy', Kyy)]:
+                out.append(('rs_'+name, sa, np.sum(K, 1)))
+                out.append(('rs_'+name, sb, np.sum(K, 0)))
+                out.append(('sq_'+name, None, 2.0*np.sum(K**2)))
+            Kxz_ba = gram_tile('xz', sb, sa)
+            Kyz_ba = gram_tile('yz', sb, sa)
+            # K_ab = k(A_a, Z_b), K_ba = k(A_b, Z_a) where A is X or Y.
+            for name, K_ab, K_ba, Kaa in [('xz', Kxz, Kxz_ba, Kxx), ('yz', Kyz, Kyz_ba, Kyy)]:
+                out.append(('rs_'+name, sa, np.sum(K_ab, 1)))
+                out.append(('cs_'+name, sb, np.sum(K_ab, 0)))
+                out.append(('rs_'+name, sb, np.sum(K_ba, 1)))
+                out.append(('cs_'+name, sa, np.sum(K_ba, 0)))
+                out.append(('sq_'+name, None, np.sum(K_ab**2) + np.sum(K_ba**2)))
+                M = Kaa + Kzz - K_ab - K_ba.T
+                out.append(('so_'+name, None, 2.0*np.sum(M**2)))
+        return out
+
+    @staticmethod
+    def from_grams(Kxx, Kyy, Kzz, Kxz, Kyz, backend=None):
+        """
+        Compute the sums from the full n x n Gram matrices k(X, X), k(Y, Y),
+        k(Z, Z), k(X, Z), k(Y, Z), arrays of the given kmod.backend. The sums
+        (and the statistics of h1_mean_var(), cross_covariance()) are arrays
+        of the backend, e.g., torch tensors that can be differentiated.
+
+        :returns: a RelMMDGramStats
+        """
+        B = kbackend.get(backend)
+        gs = RelMMDGramStats(Kzz.shape[0])
+        Kxx = B.zero_diag(Kxx)
+        Kyy = B.zero_diag(Kyy)
+        Kzz = B.zero_diag(Kzz)
+        # same as the diagonal tile of _tile_sums() with one tile
+        for name, K in [('zz', Kzz), ('xx', Kxx), ('yy', Kyy)]:
+            setattr(gs, 'rs_'+name, B.sum(K, 1))
+            setattr(gs, 'sq_'+name, B.sum(K**2))
+        for name, K, Kaa in [('xz', Kxz, Kxx), ('yz', Kyz, Kyy)]:
+            Kd = B.zero_diag(K)
+            setattr(gs, 'rs_'+name, B.sum(K, 1))
+            setattr(gs, 'cs_'+name, B.sum(K, 0))
+            setattr(gs, 'sq_'+name, B.sum(K**2))
+            setattr(gs, 'tr_'+name, B.sum(K - Kd))
+            M = Kaa + Kzz - Kd - Kd.T
+            setattr(gs, 'so_'+name, B.sum(M**2))
+        return gs
+
+    def _add_tile(self, part):
+        for name, sl, value in part:
+            if sl is None:
+                setattr(self, name, getattr(self, name) + value)
+            else:
+                getattr(self, name)[sl] += value
+
+    def h1_mean_var(self, which, is_var_computed=True):
+        """
+        Same as freqopttest.tst.QuadMMDTest.h1_mean_var(A, Z, k,
+        is_var_computed, use_1sample_U=True) where A = X if which == 'x',
+        and A = Y if which == 'y'.
+
+        :returns: (mmd2, variance). variance is None if is_var_computed is
+            False.
+        """
+        if which not in ['x', 'y']:
+            raise ValueError('which must be "x" or "y". Was {}'.format(which))
+        a = which
+        rs_aa = getattr(self, 'rs_{0}{0}'.format(a))
+        sq_aa = getattr(self, 'sq_{0}{0}'.format(a))
+        rs_az = getattr(self, 'rs_{}z'.format(a))
+        cs_az = getattr(self, 'cs_{}z'.format(a))
+        sq_az = getattr(self, 'sq_{}z'.format(a))
+        tr_az = getattr(self, 'tr_{}z'.format(a))
+        so_az = getattr(self, 'so_{}z'.format(a))
+        rs_zz = self.rs_zz
+        sq_zz = self.sq_zz
+
+        # Only methods and operators common to numpy arrays and torch
+        # tensors are used (see from_grams()).
+        m = self.n
+        n = self.n
+        Kxd_sum = rs_aa.sum()
+        Kyd_sum = rs_zz.sum()
+        Kxy_sum = rs_az.sum()
+        xx = Kxd_sum/(m*(m-1))
+        yy = Kyd_sum/(n*(n-1))
+        xy = (Kxy_sum - tr_az)/(m*(n-1))
+        mmd2 = xx - 2*xy + yy
+        if not is_var_computed:
+            return mmd2, None
+
+        v = [
+            1.0/m/(m-1)/(m-2)*((rs_aa*rs_aa).sum() - sq_aa),
+            -(1.0/m/(m-1)*Kxd_sum)**2,
+            -2.0/m/(m-1)/n*(rs_aa*rs_az).sum(),
+            2.0/(m**2)/(m-1)/n*Kxd_sum*Kxy_sum,
+            1.0/n/(n-1)/(n-2)*((rs_zz*rs_zz).sum() - sq_zz),
+            -(1.0/n/(n-1)*Kyd_sum)**2,
+            -2.0/n/(n-1)/m*(rs_zz*cs_az).sum(),
+            2.0/(n**2)/(n-1)/m*Kyd_sum*Kxy_sum,
+            1.0/n/(n-1)/m*((rs_az*rs_az).sum() - sq_az),
+            -2.0*(1.0/n/m*Kxy_sum)**2,
+            1.0/m/(m-1)/n*((cs_az*cs_az).sum() - sq_az),
+            ]
+
+        # first order term (Eq. 13, Bounliphone et al., 2016)
+        var_est1 = 4.0*(m-2)/m/(m-1)*sum(v)
+        # second order term
+        var_est2 = 2.0/m/(m-1)*1.0/n/(n-1)*so_az
+        var_est = var_est1 + var_est2
+        # use only the second-order term if the estimate is negative
+        if var_est < 0:
+            var_est = var_est2
+        return mmd2, var_est
+
+    def cross_covariance(self):
+        """
+        Same as kmod.mctest.SC_MMD.get_cross_covariance(X, Y, Z, k). The
+        grand sums of the matrix products there are inner products of row
+        sums, e.g., sum(Kzznd.dot(Kzy)) = rs_zz.dot(Kzy.sum(1)).
+        """
+        nz = nx = ny = self.n
+        rs_zz = self.rs_zz
+        # row sums of Kzx and Kzy
+        rs_zx = self.cs_xz
+        rs_zy = self.cs_yz
+
+        u_zz = (1./(nz*(nz-1)))*rs_zz.sum()
+        u_zx = rs_zx.sum()/(nz*nx)
+        u_zy = rs_zy.sum()/(nz*ny)
+
+        ct1 = 1./(nz*(nz-1)**2)*(rs_zz*rs_zz).sum()
+        ct2 = u_zz**2
+        ct3 = 1./(nz*(nz-1)*ny)*(rs_zz*rs_zy).sum()
+        ct4 = u_zz*u_zy
+        ct5 = (1./(nz*(nz-1)*nx))*(rs_zz*rs_zx).sum()
+        ct6 = u_zz*u_zx
+        ct7 = (1./(nx*nz*ny))*(rs_zx*rs_zy).sum()
+        ct8 = u_zx*u_zy
+
+        zeta_1 = (ct1-ct2)-(ct3-ct4)-(ct5-ct6)+(ct7-ct8)
+        cov = (4.0*(nz-2))/(nz*(nz-1))*zeta_1
+        return cov
+
+# end of class RelMMDGramStats
@@ -45,9 +45,9 @@ class KKID(Kernel):
         return (np.dot(X1, X2.T)/d + 1.)**3
 
     def pair_eval(self, X, Y):
-        d = X1.shape[1]
+        d = X.shape[1]
         assert d == Y.shape[1]
-        return (np.sum(X1*X2, axis=1)/d + 1.)**3
+        return (np.sum(X*Y, axis=1)/d + 1.)**3
 
     def __str__(self):
         return 'KKID'
@@ -16,11 +16,67 @@ import kgof.goftest as gof
 import freqopttest.tst as tst
 import freqopttest.data as tstdata
 from kmod import data, density, kernel, util, log
+from kmod import approx, bootstrap, gram, median, stochopt, stream
+import kmod.backend as kbackend
 #import matplotlib.pyplot as plt
 
 import scipy
 import scipy.stats as stats
 
+
+def ustat_h1_mean_variance(F, return_variance=True, backend=None):
+    """
+    Return the mean [and the variance] under H1 of the U-statistic of the
+    UME (or FSSD) given its n x J feature matrix F. Same as
+    freqopttest.tst.UMETest.ustat_h1_mean_variance(F, return_variance,
+    use_unbiased=True), for the arrays of any kmod.backend.
+
+    :param backend: a kmod.backend.Backend or its name. None for autograd.
+    """
+    B = kbackend.get(backend)
+    n = F.shape[0]
+    assert n > 1, 'Need n > 1 to compute the mean of the statistic.'
+    mu = B.mean(F, 0)
+    t1 = B.sum(mu**2)*(n/float(n-1))
+    t2 = B.mean(B.sum(F**2, 1))/float(n-1)
+    mean_h1 = t1 - t2
+    if not return_variance:
+        return mean_h1
+    variance = 4.0*B.mean(B.dot(F, mu)**2) - 4.0*B.sum(mu**2)**2
+    return mean_h1, variance
+
+
+def rel_ustat_h1_mean_variance(fea_p, fea_q, return_variance=True,
+        backend=None):
+    """
+    Return (mean, variance, var_p, var_q, var_pq) under H1 of the difference
+    of the two correlated U-statistics with the n x Jp and n x Jq feature
+    matrices fea_p, fea_q (the rows are paired). The mean is the unbiased
+    estimate of the difference. The variance is that of the test statistic
+    divided by sqrt(n), i.e., var_p - 2*var_pq + var_q. This is shared by
+    SC_UME and DC_FSSD (on the reshaped Stein feature tensors).
+
+    If return_variance is False, return only the mean.
+
+    :param backend: a kmod.backend.Backend or its name. None for autograd.
+    """
+    B = kbackend.get(backend)
+    if not return_variance:
+        return (ustat_h1_mean_variance(fea_p, False, B)
+                - ustat_h1_mean_variance(fea_q, False, B))
+    stat_p, var_p = ustat_h1_mean_variance(fea_p, True, B)
+    stat_q, var_q = ustat_h1_mean_variance(fea_q, True, B)
+    mean_h1 = stat_p - stat_q
+    # cross-covariance
+    mu_p = B.mean(fea_p, 0)
+    mu_q = B.mean(fea_q, 0)
+    t1 = 4.0*B.mean(B.dot(fea_p, mu_p)*B.dot(fea_q, mu_q))
+    t2 = 4.0*B.sum(mu_p**2)*B.sum(mu_q**2)
+    var_pq = t1 - t2
+    var_h1 = var_p - 2.0*var_pq + var_q
+    return mean_h1, var_h1, var_p, var_q, var_pq
+
+
 class SCTest(with_metaclass(ABCMeta, object)):
     """
     An abstract class for a sample comparison (SC) test.
@@ -56,6 +112,27 @@ class SCTest(with_metaclass(ABCMeta, object)):
         """
         raise NotImplementedError()
 
+    def perform_test_many(self, list_dat):
+        """
+        Perform the test on each of the samples in list_dat. Return a list
+        of results dictionaries (as returned by perform_test()). Subclasses
+        may override this to share the computation across the samples. An
+        override must give the same results as perform_test(), and test the
+        samples that cannot share the computation (e.g., samples of a
+        different size) separately with perform_test().
+        """
+        return [self.perform_test(dat) for dat in list_dat]
+
+    def _has_stat_of(self, cls):
+        """
+        Return True if this test computes the same statistic as cls, i.e.,
+        type(self) does not override cls.get_H1_mean_variance(). A batched
+        perform_test_many() of cls is only valid for such a test. Subclasses
+        with an approximate statistic (e.g., SC_RFFUME, SC_LinearMMD) test
+        each sample separately.
+        """
+        return type(self).get_H1_mean_variance is cls.get_H1_mean_variance
+
     @abstractmethod
     def compute_stat(self, dat):
         """
@@ -97,6 +174,17 @@ class DCTest(with_metaclass(ABCMeta, object)):
         """
         raise NotImplementedError()
 
+    def perform_test_many(self, list_dat):
+        """
+        Perform the test on each of the samples in list_dat. Return a list
+        of results dictionaries (as returned by perform_test()). Subclasses
+        may override this to share the computation across the samples. An
+        override must give the same results as perform_test(), and test the
+        samples that cannot share the computation (e.g., samples of a
+        different size) separately with perform_test().
+        """
+        return [self.perform_test(dat) for dat in list_dat]
+
     @abstractmethod
     def compute_stat(self, dat):
         """
@@ -120,7 +208,7 @@ class DC_FSSD(DCTest):
     The statistic is the  \sqrt{n}*(FSSD^2(p, k, V) - FSSD^2(q, l, W)). 
     See the constructor for the meaning of each parameter.
     """
-    def __init__(self, p, q, k, l, V, W, alpha=0.01):
+    def __init__(self, p, q, k, l, V, W, alpha=0.01, backend='numpy'):
         """
         :param p: a kmod.density.UnnormalizedDensity (model 1)
         :param q: a kmod.density.UnnormalizedDensity (model 2)
@@ -129,29 +217,53 @@ class DC_FSSD(DCTest):
         :param V: Jp x d numpy array of Jp test locations used in FSSD(p, k, V)
         :param W: Jq x d numpy array of Jq test locations used in FSSD(q, l, W)
         :param alpha: significance level of the test
+        :param backend: a kmod.backend.Backend or its name ('numpy',
+            'autograd' or 'torch') for computing the Stein feature tensors
+            and the statistic in get_H1_mean_variance() and compute_stat().
+            'numpy' (plain numpy) is the fastest when no gradient is needed.
         """
         super(DC_FSSD, self).__init__(p, q, alpha)
         self.k = k
         self.l = l
         self.V = V
         self.W = W
+        self.backend = kbackend.get(backend)
         # Construct two FSSD objects
         self.fssdp = gof.FSSD(p=p, k=k, V=V, null_sim=None, alpha=alpha)
         self.fssdq = gof.FSSD(p=q, k=l, V=W, null_sim=None, alpha=alpha)
     
-    def perform_test(self, dat):
+    def perform_test(self, dat, block_size=None, null='asymptotic',
+            n_bootstrap=1000, seed=1):
         """
         :param dat: an instance of kmod.data.Data
+        :param block_size: if not None, compute the statistic from row blocks
+            of this size. See get_H1_mean_variance().
+        :param null: 'asymptotic' to use the asymptotic normal null
+            distribution. 'bootstrap' to simulate the null distribution with
+            a multiplier bootstrap (see bootstrap_null()). The bootstrap is
+            better calibrated at small n. block_size must be None.
+        :param n_bootstrap: number of bootstrap draws
+        :param seed: random seed for the bootstrap
         """
         with util.ContextTimer() as t:
             alpha = self.alpha
             X = dat.data()
             n = X.shape[0]
-            #mean and variance are not yet scaled by \sqrt{n}
-            mean, var = self.get_H1_mean_variance(dat)
-            stat = (n**0.5)*mean
-            # Assume the mean of the null distribution is 0
-            pval = stats.norm.sf(stat, loc=0, scale=var**0.5)
+            if null == 'asymptotic':
+                #mean and variance are not yet scaled by \sqrt{n}
+                mean, var = self.get_H1_mean_variance(dat, block_size=block_size)
+                mean = self.backend.to_numpy(mean)
+                var = self.backend.to_numpy(var)
+                stat = (n**0.5)*mean
+                pval = DC_FSSD._asymptotic_pvalue(stat, var)
+            elif null == 'bootstrap':
+                if block_size is not None:
+                    raise ValueError('block_size must be None with the bootstrap null.')
+                mean, draws = self.bootstrap_null(dat, n_bootstrap, seed)
+                stat = (n**0.5)*mean
+                pval = bootstrap.pvalue(stat, draws)
+            else:
+                raise ValueError('null must be "asymptotic" or "bootstrap". Was {}'.format(null))
 
         results = {'alpha': self.alpha, 'pvalue': pval, 'test_stat': stat,
                 'h0_rejected': pval < alpha, 'time_secs': t.secs, }
@@ -161,52 +273,213 @@ class DC_FSSD(DCTest):
         """Compute the test statistic"""
         X = dat.data()
         n = X.shape[0] # n = sample size
-        # This returns n*FSSD^2(p, k, V)
-        nfssdp2 = self.fssdp.compute_stat(dat)
-        nfssdq2 = self.fssdq.compute_stat(dat)
-        # want \sqrt{n}*(FSSD^2(p, k, V) - FSSD^2(q, l, W))
-        s = (nfssdp2-nfssdq2)/(n**0.5)
-        return s
-
-    def get_H1_mean_variance(self, dat):
+        # want \sqrt{n}*(FSSD^2(p, k, V) - FSSD^2(q, l, W)), the same as
+        # (n*FSSD^2(p, k, V) - n*FSSD^2(q, l, W))/\sqrt{n} with the
+        # statistics of gof.FSSD.compute_stat().
+        Xip, Xiq = self.feature_tensors(X, backend=self.backend)
+        mean_h1 = rel_ustat_h1_mean_variance(self.backend.reshape(Xip, [n, -1]),
+                self.backend.reshape(Xiq, [n, -1]), return_variance=False,
+                backend=self.backend)
+        return (n**0.5)*self.backend.to_numpy(mean_h1)
+
+    def get_H1_mean_variance(self, dat, block_size=None):
         """
         Return the mean and variance under H1 of the 
         test statistic = \sqrt{n}(FSSD(p)^2 - FSSD(q)^2).
         The estimator of the mean is unbiased (can be negative). The estimator
         of the variance is biased. The variance is also valid under H0.
 
-        :returns: (mean, variance)
+        If block_size is not None, the n x d x J Stein feature tensors are
+        never formed. See _blockwise_H1_mean_variance(). The block-wise
+        computation is always done with numpy.
+
+        :returns: (mean, variance). Scalars of the backend of this test (e.g.,
+            torch tensors that can be differentiated with respect to the test
+            locations).
         """
-        fssdp = self.fssdp
-        fssdq = self.fssdq
-        X = dat.data()
+        if block_size is not None:
+            return self._blockwise_H1_mean_variance(dat.data(), block_size)
+
+        # Feature tensors: n x d x Jp and n x d x Jq where n = sample size.
+        Xip, Xiq = self.feature_tensors(dat.data(), backend=self.backend)
+        return DC_FSSD._H1_mean_variance_tensors(Xip, Xiq,
+                backend=self.backend)
+
+    def feature_tensors(self, X, backend=None):
+        """
+        Return the Stein feature tensors (Xip, Xiq) of FSSD(p) and FSSD(q) on
+        X (n x d numpy array), as arrays of the given backend. The features
+        of a Gaussian kernel (kernel.KGauss) are computed with the operations
+        of the backend (see DC_GaussFSSD.stein_feature_tensor()). For other
+        kernels, they are computed with gof.FSSD.feature_tensor() and
+        converted.
+        """
+        B = kbackend.get(backend)
+        tensors = []
+        for model, kern, V, fssd in [(self.p, self.k, self.V, self.fssdp),
+                (self.q, self.l, self.W, self.fssdq)]:
+            if isinstance(kern, kernel.KGauss):
+                grad_log = B.asarray(model.grad_log(X))
+                tensors.append(DC_GaussFSSD.stein_feature_tensor(B.asarray(X),
+                    grad_log, B.asarray(V), kern.sigma2, backend=B))
+            else:
+                tensors.append(B.asarray(fssd.feature_tensor(X)))
+        return tuple(tensors)
+
+    @staticmethod
+    def _asymptotic_pvalue(stat, var):
+        """
+        p-value of the test statistic stat (scaled by \sqrt{n}) under the
+        asymptotic normal null distribution with variance var.
+        """
+        # Assume the mean of the null distribution is 0
+        return stats.norm.sf(stat, loc=0, scale=var**0.5)
 
-        # Feature tensor: n x d x Jp where n = sample size.
-        Xip = fssdp.feature_tensor(X)
+    @staticmethod
+    def _H1_mean_variance_tensors(Xip, Xiq, backend=None):
+        """
+        Same as get_H1_mean_variance() but given the Stein feature tensors
+        Xip (n x d x Jp) and Xiq (n x d x Jq) of FSSD(p) and FSSD(q), arrays
+        of the given backend.
+        """
+        B = kbackend.get(backend)
         n, d, Jp = Xip.shape
-        # Feature tensor: n x d x Jq where n = sample size.
-        Xiq = fssdq.feature_tensor(X)
         Jq = Xiq.shape[2]
         assert Xiq.shape[0] == n
         assert Xiq.shape[1] == d
 
-        statp, varp = gof.FSSD.ustat_h1_mean_variance(Xip, return_variance=True, use_unbiased=True)
+        # The FSSD U-statistic is that of the UME with the n x d*J feature
+        # matrix. (See gof.FSSD.ustat_h1_mean_variance().)
+        Taup = B.reshape(Xip, [n, d*Jp])
+        Tauq = B.reshape(Xiq, [n, d*Jq])
+        mean_h1, variance, varp, varq, _ = rel_ustat_h1_mean_variance(Taup,
+                Tauq, backend=B)
         if varp <= 0:
             log.l().warning('varp is not positive. Was {}'.format(varp))
-        statq, varq = gof.FSSD.ustat_h1_mean_variance(Xiq, return_variance=True, use_unbiased=True)
         if varq <= 0:
             log.l().warning('varq is not positive. Was {}'.format(varq))
+        if variance <= 0:
+            log.l().warning('variance of the stat is not positive. Was {}'.format(variance))
+        return mean_h1, variance
+
+    def perform_test_many(self, list_dat):
+        """
+        Perform the test on each of the samples in list_dat (e.g., one
+        sample of the data per day or per data slice). The Stein feature
+        tensors of all the samples are computed with one call on the stacked
+        data, i.e., the score functions of p, q and the kernels are evaluated
+        once on all the points.
+
+        :param list_dat: a list of kmod.data.Data
+        :returns: a list of results dictionaries (as returned by
+            perform_test()), one for each sample. time_secs in each is the
+            total time divided by the number of samples.
+        """
+        with util.ContextTimer() as t:
+            list_X = [dat.data() for dat in list_dat]
+            ends = np.cumsum([X.shape[0] for X in list_X])
+            starts = ends - np.array([X.shape[0] for X in list_X])
+            Xall = np.vstack(list_X)
+            Xip_all = self.fssdp.feature_tensor(Xall)
+            Xiq_all = self.fssdq.feature_tensor(Xall)
+            list_results = []
+            for s, e in zip(starts, ends):
+                n = e - s
+                mean, var = DC_FSSD._H1_mean_variance_tensors(Xip_all[s:e],
+                        Xiq_all[s:e])
+                stat = (n**0.5)*mean
+                pval = DC_FSSD._asymptotic_pvalue(stat, var)
+                list_results.append({'alpha': self.alpha, 'pvalue': pval,
+                    'test_stat': stat, 'h0_rejected': pval < self.alpha, })
+        for results in list_results:
+            results['time_secs'] = t.secs/len(list_results)
+        return list_results
+
+    def bootstrap_null(self, dat, n_bootstrap=1000, seed=1):
+        """
+        Simulate the null distribution of the test statistic with a
+        multiplier bootstrap on the Stein feature tensors (see
+        kmod.bootstrap.ustat_diff_draws()). The feature tensors are computed
+        only once.
+
+        :returns: (mean, draws) where mean is the same as the mean returned
+            by get_H1_mean_variance(), and draws is a numpy array of
+            n_bootstrap draws from the null distribution of the test
+            statistic.
+        """
+        X = dat.data()
+        n = X.shape[0]
+        Xip, Xiq = self.feature_tensors(X, backend='numpy')
+        Taup = np.reshape(Xip, [n, -1])
+        Tauq = np.reshape(Xiq, [n, -1])
+        mean_h1 = rel_ustat_h1_mean_variance(Taup, Tauq,
+                return_variance=False, backend='numpy')
+        draws = bootstrap.ustat_diff_draws(Taup, Tauq,
+                n_bootstrap=n_bootstrap, seed=seed)
+        return mean_h1, draws
+
+    def _blockwise_H1_mean_variance(self, X, block_size):
+        """
+        Same as get_H1_mean_variance() but compute the Stein feature tensors
+        on row blocks of X (a numpy array or memmap) of at most block_size
+        rows. Memory usage is O(block_size*d*J).
+
+        Two passes over X are made. The first accumulates the mean feature
+        vectors (length d*J) and the sums of squared features, which give
+        statp and statq. The second accumulates the sums of the products of
+        the projections onto the mean features, which give varp, varq and
+        varpq.
+        """
+        fssdp = self.fssdp
+        fssdq = self.fssdq
+        n = X.shape[0]
+        assert n > 1, 'Need n > 1 to compute the mean of the statistic.'
+
+        def feature_blocks():
+            for (Xb, ) in util.iter_row_blocks(block_size, X):
+                b = Xb.shape[0]
+                # b x d*Jp and b x d*Jq
+                Taup = np.reshape(fssdp.feature_tensor(Xb), [b, -1])
+                Tauq = np.reshape(fssdq.feature_tensor(Xb), [b, -1])
+                yield Taup, Tauq
+
+        # first pass
+        sump = 0.0
+        sumq = 0.0
+        sum_sqp = 0.0
+        sum_sqq = 0.0
+        for Taup, Tauq in feature_blocks():
+            sump = sump + np.sum(Taup, 0)
+            sumq = sumq + np.sum(Tauq, 0)
+            sum_sqp = sum_sqp + np.sum(Taup**2)
+            sum_sqq = sum_sqq + np.sum(Tauq**2)
+        mup = sump/float(n)
+        muq = sumq/float(n)
+        mup2 = np.sum(mup**2)
+        muq2 = np.sum(muq**2)
+        # same as in gof.FSSD.ustat_h1_mean_variance(.., use_unbiased=True)
+        statp = mup2*(n/float(n-1)) - sum_sqp/float(n)/float(n-1)
+        statq = muq2*(n/float(n-1)) - sum_sqq/float(n)/float(n-1)
         mean_h1 = statp - statq
 
-        # compute the cross covariance (i.e., diagonal entries of the
-        # covariance of the asymptotic joint normal).
-        # mu: d*J vector
-        Taup = np.reshape(Xip, [n, d*Jp])
-        Tauq = np.reshape(Xiq, [n, d*Jq])
-        # length-d*Jp vector
-        mup = np.mean(Taup, 0)
-        muq = np.mean(Tauq, 0)
-        varpq = 4.0*np.mean(np.dot(Taup, mup)*np.dot(Tauq, muq) ) - 4.0*np.sum(mup**2)*np.sum(muq**2)
+        # second pass
+        sum_pp = 0.0
+        sum_qq = 0.0
+        sum_pq = 0.0
+        for Taup, Tauq in feature_blocks():
+            taup_mu = np.dot(Taup, mup)
+            tauq_mu = np.dot(Tauq, muq)
+            sum_pp = sum_pp + np.sum(taup_mu**2)
+            sum_qq = sum_qq + np.sum(tauq_mu**2)
+            sum_pq = sum_pq + np.sum(taup_mu*tauq_mu)
+
+        varp = 4.0*sum_pp/n - 4.0*mup2**2
+        if varp <= 0:
+            log.l().warning('varp is not positive. Was {}'.format(varp))
+        varq = 4.0*sum_qq/n - 4.0*muq2**2
+        if varq <= 0:
+            log.l().warning('varq is not positive. Was {}'.format(varq))
+        varpq = 4.0*sum_pq/n - 4.0*mup2*muq2
         variance = varp - 2.0*varpq + varq
         if variance <= 0:
             log.l().warning('variance of the stat is not positive. Was {}'.format(variance))
@@ -222,19 +495,66 @@ class DC_FSSD(DCTest):
 
         """
         def power_cri(V):
-            # TODO: This is not efficient. Should be good enough for plotting
-            # purpose.
-            J = V.shape[0]
-            values = np.zeros(J)
-            for i, v in enumerate(V):
-                Vi = v.reshape([1, -1])
-                values[i] = DC_FSSD.power_criterion(p, q, datar,
-                        k, l, Vi, Vi, reg=reg)
-            return values
+            return DC_FSSD.single_loc_power_criteria(p, q, datar, k, l, V,
+                    reg=reg)
         return power_cri
 
     @staticmethod
-    def power_criterion(p, q, datar, k, l, V, W, reg=1e-3):
+    def single_loc_power_criteria(p, q, datar, k, l, C, reg=1e-7,
+            chunk_size=None):
+        """
+        Evaluate the power criterion with one test location (J=1, V=W=c)
+        for each of the m candidate locations c in C (m x d). Return a
+        length-m numpy array whose entry i is equal to
+        power_criterion(p, q, datar, k, l, C[[i]], C[[i]], reg).
+
+        The score functions of p, q are evaluated only once. The Stein
+        features of all candidates in a chunk are formed as one n x d x
+        chunk_size array with the gradients gradX_Y() of the kernels, so
+        there is no Python loop over the candidates.
+
+        :param chunk_size: number of candidates to process at a time. If
+            None, choose it so that each chunk has about 10^7 entries.
+        """
+        X = datar.data()
+        n, d = X.shape
+        m = C.shape[0]
+        if chunk_size is None:
+            chunk_size = max(1, 10**7//(n*d))
+        grad_logp = p.grad_log(X)
+        grad_logq = q.grad_log(X)
+
+        def stein_features(grad_log, kern, Cb):
+            # n x d x b. Same as FSSD.feature_tensor() with J=1 for each
+            # column.
+            K = kern.eval(X, Cb)
+            dK = np.stack([kern.gradX_Y(X, Cb, j) for j in range(d)], axis=1)
+            return (grad_log[:, :, np.newaxis]*K[:, np.newaxis, :] + dK)/np.sqrt(d)
+
+        values = []
+        for i in range(0, m, chunk_size):
+            Cb = C[i:i+chunk_size]
+            Xip = stein_features(grad_logp, k, Cb)
+            Xiq = stein_features(grad_logq, l, Cb)
+            # d x b
+            mup = np.mean(Xip, 0)
+            muq = np.mean(Xiq, 0)
+            mup2 = np.sum(mup**2, 0)
+            muq2 = np.sum(muq**2, 0)
+            statp = mup2*(n/float(n-1)) - np.sum(Xip**2, (0, 1))/float(n*(n-1))
+            statq = muq2*(n/float(n-1)) - np.sum(Xiq**2, (0, 1))/float(n*(n-1))
+            # n x b
+            projp = np.sum(Xip*mup, 1)
+            projq = np.sum(Xiq*muq, 1)
+            varp = 4.0*np.mean(projp**2, 0) - 4.0*mup2**2
+            varq = 4.0*np.mean(projq**2, 0) - 4.0*muq2**2
+            varpq = 4.0*np.mean(projp*projq, 0) - 4.0*mup2*muq2
+            var_h1 = varp - 2.0*varpq + varq
+            values.append((statp - statq)/np.sqrt(var_h1 + reg))
+        return np.hstack(values)
+
+    @staticmethod
+    def power_criterion(p, q, datar, k, l, V, W, reg=1e-3, backend=None):
         """"
         Compute the power criterion of the FSSD-based model comparison test .
 
@@ -246,12 +566,16 @@ class DC_FSSD(DCTest):
         :param V: Jp x d numpy array of Jp test locations for FSSD(P, R)
         :param W: Jq x d numpy array of Jq test locations for FSSD(Q, R)
         :param reg: regularization parameter
+        :param backend: a kmod.backend.Backend or its name. None for
+            'autograd' (differentiable with autograd). With 'torch', V and W
+            can be torch tensors (requires_grad=True) and the returned
+            criterion can be differentiated with torch.autograd.
         
         Return power criterion = mean_under_H1/sqrt(var_under_H1 + reg) .
         """
-        dcfssd = DC_FSSD(p, q, k, l, V, W)
+        dcfssd = DC_FSSD(p, q, k, l, V, W, backend=backend)
         mean_h1, var_h1 = dcfssd.get_H1_mean_variance(datar)
-        ratio = mean_h1/np.sqrt(var_h1 + reg)
+        ratio = mean_h1/dcfssd.backend.sqrt(var_h1 + reg)
         return ratio
 
 # end of DC_FSSD
@@ -262,7 +586,8 @@ class DC_GaussFSSD(DC_FSSD):
     (FSSD) as the base discrepancy measure. A special case of DC_FSSD where 
     a Gaussian kernel is used.
     """
-    def __init__(self, p, q, gwidth2p, gwidth2q, V, W, alpha=0.01):
+    def __init__(self, p, q, gwidth2p, gwidth2q, V, W, alpha=0.01,
+            backend='numpy'):
         """
         :param p: a kmod.density.UnnormalizedDensity (model 1)
         :param q: a kmod.density.UnnormalizedDensity (model 2)
@@ -271,6 +596,7 @@ class DC_GaussFSSD(DC_FSSD):
         :param V: Jp x d numpy array of Jp test locations used in FSSD(p, k, V)
         :param W: Jq x d numpy array of Jq test locations used in FSSD(q, l, W)
         :param alpha: significance level of the test
+        :param backend: see DC_FSSD
         """
 
         if not util.is_real_num(gwidth2p) or gwidth2p <= 0:
@@ -280,13 +606,68 @@ class DC_GaussFSSD(DC_FSSD):
 
         k = kernel.KGauss(gwidth2p)
         l = kernel.KGauss(gwidth2q)
-        super(DC_GaussFSSD, self).__init__(p, q, k, l, V, W, alpha)
+        super(DC_GaussFSSD, self).__init__(p, q, k, l, V, W, alpha,
+                backend=backend)
+
+    @staticmethod
+    def stein_feature_tensor(X, grad_log, V, gwidth2, sq_norms=None, D2=None,
+            Diff=None, backend=None):
+        """
+        Return the n x d x J Stein feature tensor of FSSD with the Gaussian
+        kernel kernel.KGauss(gwidth2) and the test locations V (J x d), given
+        the score matrix grad_log (n x d) of the model at the rows of X
+        (n x d). Same as gof.FSSD(p, k, V).feature_tensor(X) where
+        grad_log = p.grad_log(X), but the model is not evaluated. So, the
+        score matrix can be computed once and reused for many (V, gwidth2).
+        Differentiable with autograd with respect to V and gwidth2.
+
+        :param sq_norms: length-n numpy array of the squared norms of the
+            rows of X. Computed if None.
+        :param D2: n x J numpy array of the squared distances between X and V.
+            Computed if None. Pass it (and Diff) to evaluate many widths
+            (see kmod.sweep).
+        :param Diff: n x d x J numpy array with Diff[i, :, j] = X[i] - V[j].
+            Computed if None.
+        :param backend: a kmod.backend.Backend or its name. All the arrays
+            must be of this backend. None for autograd.
+        """
+        B = kbackend.get(backend)
+        n, d = X.shape
+        J = V.shape[0]
+        if D2 is None:
+            if sq_norms is None:
+                sq_norms = B.sum(X**2, 1)
+            # n x J
+            D2 = sq_norms[:, np.newaxis] - 2.0*B.dot(X, V.T) + B.sum(V**2, 1)
+        K = B.exp(-D2/(2.0*gwidth2))
+        # n x d x J. The derivative of k(x, v) with respect to x is
+        # -(x - v)k(x, v)/gwidth2.
+        if Diff is None:
+            Diff = X[:, :, np.newaxis] - V.T[np.newaxis, :, :]
+        Xi = K[:, np.newaxis, :]*(grad_log[:, :, np.newaxis] - Diff/gwidth2)
+        return Xi/float(d*J)**0.5
 
+    @staticmethod
+    def power_criterion_scores(X, grad_logp, grad_logq, V, gwidth2, reg=1e-3,
+            sq_norms=None):
+        """
+        Same as DC_FSSD.power_criterion(p, q, data.Data(X), k, k, V, V, reg)
+        with k = kernel.KGauss(gwidth2), given the score matrices
+        grad_logp = p.grad_log(X) and grad_logq = q.grad_log(X). See
+        stein_feature_tensor().
+        """
+        Xip = DC_GaussFSSD.stein_feature_tensor(X, grad_logp, V, gwidth2,
+                sq_norms=sq_norms)
+        Xiq = DC_GaussFSSD.stein_feature_tensor(X, grad_logq, V, gwidth2,
+                sq_norms=sq_norms)
+        mean_h1, var_h1 = DC_FSSD._H1_mean_variance_tensors(Xip, Xiq)
+        return mean_h1/np.sqrt(var_h1 + reg)
 
     @staticmethod
     def optimize_power_criterion(p, q, datar, V0, gwidth0, reg=1e-3,
             max_iter=100, tol_fun=1e-6, disp=False, locs_bounds_frac=100,
-            gwidth_lb=None, gwidth_ub=None, added_obj=None):
+            gwidth_lb=None, gwidth_ub=None, added_obj=None,
+            minibatch_size=None, stoch_options=None, warm_start=None):
         """
         Optimize one set of test locations and one Gaussian kernel width by
         maximizing the test power criterion of the FSSD model comparison test
@@ -311,27 +692,55 @@ class DC_GaussFSSD(DC_FSSD):
         - added_obj: a function (gwidth2, V) |-> real number as a extra
               additive term to maximize along with the power criterion. None by
               default.
+        - minibatch_size: if not None, first optimize with minibatch Adam
+              (see kmod.stochopt.minibatch_adam()) on random minibatches
+              of this size, so that the cost does not grow with n. Then
+              polish with full-batch L-BFGS for max_iter iterations. Set
+              max_iter=0 to skip the polish.
+        - stoch_options: a dictionary of extra options for
+              kmod.stochopt.minibatch_adam() e.g., n_iters, step_size,
+              lr_decay, patience, seed.
+        - warm_start: None or a kmod.warmstart.WarmStart. If it holds
+              the parameters of a previous optimization (of the same shapes),
+              start from them instead of V0, gwidth0. The optimized
+              parameters are stored back to it.
 
         If the lb, ub bounds are None, use fraction of the median heuristics 
             to automatically set the bounds.
         
         Return (optimized V, optimized Gaussian width^2, info from the optimization)
         """
+        warm_started = False
+        if warm_start is not None:
+            prev = warm_start.load(V=V0, gwidth=gwidth0)
+            if prev is not None:
+                V0, gwidth0 = prev['V'], prev['gwidth']
+                warm_started = True
         J = V0.shape[0]
         Z = datar.data()
         n, d = Z.shape
 
+        # Z does not change during the optimization. Evaluate the score
+        # functions and the squared norms only once.
+        grad_logp = p.grad_log(Z)
+        grad_logq = q.grad_log(Z)
+        sq_norms = np.sum(Z**2, 1)
+
         # Parameterize the Gaussian width with its square root (then square later)
         # to automatically enforce the positivity.
-        def obj(sqrt_gwidth, V):
+        def obj(sqrt_gwidth, V, ind=None):
             gwidth2 = sqrt_gwidth**2
-            k = kernel.KGauss(gwidth2)
+            if ind is None:
+                power_cri = DC_GaussFSSD.power_criterion_scores(Z, grad_logp,
+                        grad_logq, V, gwidth2, reg=reg, sq_norms=sq_norms)
+            else:
+                power_cri = DC_GaussFSSD.power_criterion_scores(Z[ind],
+                        grad_logp[ind], grad_logq[ind], V, gwidth2, reg=reg,
+                        sq_norms=sq_norms[ind])
             if added_obj is None:
-                return -DC_FSSD.power_criterion(p, q, datar, k, k, V, V,
-                        reg=reg)
+                return -power_cri
             else:
-                return -(DC_FSSD.power_criterion(p, q, datar, k, k, V, V,
-                        reg=reg) + added_obj(gwidth2, V))
+                return -(power_cri + added_obj(gwidth2, V))
 
         flatten = lambda gwidth, V: np.hstack((gwidth, V.reshape(-1)))
         def unflatten(x):
@@ -339,15 +748,15 @@ class DC_GaussFSSD(DC_FSSD):
             V = np.reshape(x[1:], (J, d))
             return sqrt_gwidth, V
 
-        def flat_obj(x):
+        def flat_obj(x, ind=None):
             sqrt_gwidth, V = unflatten(x)
-            return obj(sqrt_gwidth, V)
+            return obj(sqrt_gwidth, V, ind)
 
         # Initial point
         x0 = flatten(np.sqrt(gwidth0), V0)
         
         #make sure that the optimized gwidth is not too small or too large.
-        med2 = util.meddistance(Z, subsample=1000)**2
+        med2 = median.meddistance(Z)**2
         fac_min = 1e-2 
         fac_max = 1e2
         if gwidth_lb is None:
@@ -373,24 +782,37 @@ class DC_GaussFSSD(DC_FSSD):
         # https://docs.scipy.org/doc/scipy/reference/optimize.minimize-lbfgsb.html
         grad_obj = autograd.elementwise_grad(flat_obj)
         with util.ContextTimer() as timer:
-            opt_result = scipy.optimize.minimize(
-              flat_obj, x0, method='L-BFGS-B', 
-              bounds=x0_bounds,
-              tol=tol_fun, 
-              options={
-                  'maxiter': max_iter, 'ftol': tol_fun, 'disp': disp,
-                  'gtol': 1.0e-08,
-                  },
-              jac=grad_obj,
-            )
-
-        opt_result = dict(opt_result)
+            if minibatch_size is not None:
+                batch_obj_grad = autograd.value_and_grad(flat_obj)
+                x0, stoch_info = stochopt.minibatch_adam(batch_obj_grad, x0,
+                        n, minibatch_size, bounds=x0_bounds,
+                        **(stoch_options or {}))
+            if minibatch_size is None or max_iter > 0:
+                opt_result = scipy.optimize.minimize(
+                  flat_obj, x0, method='L-BFGS-B', 
+                  bounds=x0_bounds,
+                  tol=tol_fun, 
+                  options={
+                      'maxiter': max_iter, 'ftol': tol_fun, 'disp': disp,
+                      'gtol': 1.0e-08,
+                      },
+                  jac=grad_obj,
+                )
+                opt_result = dict(opt_result)
+            else:
+                opt_result = dict(stoch_info)
+            if minibatch_size is not None:
+                opt_result['stoch_info'] = stoch_info
+
         opt_result['time_secs'] = timer.secs
+        opt_result['warm_started'] = warm_started
         x_opt = opt_result['x']
         sq_gw_opt, V_opt = unflatten(x_opt)
         gw_opt = sq_gw_opt**2
 
         assert util.is_real_num(gw_opt), 'gw_opt is not real. Was %s' % str(gw_opt)
+        if warm_start is not None:
+            warm_start.save(V=V_opt, gwidth=gw_opt)
         return V_opt, gw_opt, opt_result
 
 # end of DC_GaussFSSD
@@ -409,7 +831,8 @@ class SC_UME(SCTest):
     In constrast to DC_FSSD, the MCUME test is a three-sample test, meaning that 
     the two models P, Q are represented by two samples.
     """
-    def __init__(self, datap, dataq, k, l, V, W, alpha=0.01):
+    def __init__(self, datap, dataq, k, l, V, W, alpha=0.01, shared_locs=None,
+            backend='numpy'):
         """
         :param datap: a kmod.data.Data object representing an i.i.d. sample X
             (from model 1)
@@ -420,12 +843,25 @@ class SC_UME(SCTest):
         :param V: Jp x d numpy array of Jp test locations used in UME(q, r)
         :param W: Jq x d numpy array of Jq test locations used in UME(q, r)
         :param alpha: significance level of the test
+        :param shared_locs: True if k == l and V == W. Then k(Z, V) is
+            computed only once for both UME terms. If None, this is set to
+            True when the same kernel object and the same array (object) are
+            given for (k, l) and (V, W), as in SC_UME(.., k, k, V, V).
+        :param backend: a kmod.backend.Backend or its name ('numpy',
+            'autograd' or 'torch') for computing the feature matrices and the
+            statistic in get_H1_mean_variance() (without block_size) and
+            compute_stat(). 'numpy' (plain numpy) is the fastest when no
+            gradient is needed.
         """
         super(SC_UME, self).__init__(datap, dataq, alpha)
         self.k = k
         self.l = l
         self.V = V
         self.W = W
+        if shared_locs is None:
+            shared_locs = k is l and V is W
+        self.shared_locs = shared_locs
+        self.backend = kbackend.get(backend)
         # Constrct two UMETest objects
         self.umep = tst.UMETest(V, k)
         self.umeq = tst.UMETest(W, l)
@@ -440,83 +876,282 @@ class SC_UME(SCTest):
         """
         mean_h1 = self.get_H1_mean_variance(dat, return_variance=False)
         n = dat.sample_size()
-        return (n**0.5)*mean_h1
+        return (n**0.5)*self.backend.to_numpy(mean_h1)
 
-    def perform_test(self, dat):
+    def perform_test(self, dat, block_size=None, null='asymptotic',
+            n_bootstrap=1000, seed=1):
         """
         :param dat: an instance of kmod.data.Data
+        :param block_size: if not None, process the data in row blocks of
+            this size so that only O(J^2) statistics are kept in memory. See
+            get_H1_mean_variance().
+        :param null: 'asymptotic' to use the asymptotic normal null
+            distribution. 'bootstrap' to simulate the null distribution with
+            a multiplier bootstrap (see bootstrap_null()). The bootstrap is
+            better calibrated at small n. block_size must be None.
+        :param n_bootstrap: number of bootstrap draws
+        :param seed: random seed for the bootstrap
         """
         with util.ContextTimer() as t:
-            alpha = self.alpha
-            X = dat.data()
-            n = X.shape[0]
-            #mean and variance are not yet scaled by \sqrt{n}
-            # The variance is the same for both H0 and H1.
-            mean_h1, var = self.get_H1_mean_variance(dat)
-            stat = (n**0.5)*mean_h1
-            null_std = var**0.5
-            if null_std <= 1e-6:
-                log.l().warning('SD of the null distribution is too small. Was {}. Will not reject H0.'.format(null_std))
-                pval = np.inf
+            n = dat.sample_size()
+            if null == 'asymptotic':
+                #mean and variance are not yet scaled by \sqrt{n}
+                # The variance is the same for both H0 and H1.
+                mean_h1, var = self.get_H1_mean_variance(dat,
+                        block_size=block_size)
+                results = self._asymptotic_test_results(n,
+                        self.backend.to_numpy(mean_h1),
+                        self.backend.to_numpy(var))
+            elif null == 'bootstrap':
+                if block_size is not None:
+                    raise ValueError('block_size must be None with the bootstrap null.')
+                mean_h1, draws = self.bootstrap_null(dat, n_bootstrap, seed)
+                stat = (n**0.5)*mean_h1
+                pval = bootstrap.pvalue(stat, draws)
+                results = {'alpha': self.alpha, 'pvalue': pval,
+                        'test_stat': stat, 'h0_rejected': pval < self.alpha, }
             else:
-                # Assume the mean of the null distribution is 0
-                pval = stats.norm.sf(stat, loc=0, scale=null_std)
+                raise ValueError('null must be "asymptotic" or "bootstrap". Was {}'.format(null))
+        results['time_secs'] = t.secs
+        return results
 
+    def perform_test_many(self, list_dat):
+        """
+        Perform the test on each of the samples from R in list_dat (e.g., one
+        reference sample per day or per data slice) against the same datap
+        and dataq. The P/Q-side kernel evaluations k(X, V), l(Y, W) are
+        computed only once, and the R-side evaluations k(Z, V), l(Z, W) of all
+        the samples are computed with one call on the stacked samples.
+        Samples whose size differs from that of datap or dataq are tested
+        separately with perform_test().
+
+        :param list_dat: a list of kmod.data.Data
+        :returns: a list of results dictionaries (as returned by
+            perform_test()), one for each sample. time_secs in each is the
+            total time divided by the number of samples.
+        """
+        if not self._has_stat_of(SC_UME):
+            return SCTest.perform_test_many(self, list_dat)
+        with util.ContextTimer() as t:
+            X = self.datap.data()
+            Y = self.dataq.data()
+            nx, ny = X.shape[0], Y.shape[0]
+            Jp = self.V.shape[0]
+            Jq = self.W.shape[0]
+            list_Z = [dat.data() for dat in list_dat]
+            is_batched = [nx == ny and Z.shape[0] == nx for Z in list_Z]
+            if any(is_batched):
+                Kxv = self.k.eval(X, self.V)
+                Kyw = self.l.eval(Y, self.W)
+                Zall = np.vstack([Z for Z, b in zip(list_Z, is_batched) if b])
+                Kzv_all = self.k.eval(Zall, self.V)
+                if self.shared_locs:
+                    Kzw_all = Kzv_all
+                else:
+                    Kzw_all = self.l.eval(Zall, self.W)
+
+            list_results = []
+            s = 0
+            for dat, Z, b in zip(list_dat, list_Z, is_batched):
+                if not b:
+                    list_results.append(self.perform_test(dat))
+                    continue
+                n = Z.shape[0]
+                e = s + n
+                # same as tst.UMETest.feature_matrix()
+                fea_pr = (Kxv - Kzv_all[s:e])/np.sqrt(Jp)
+                fea_qr = (Kyw - Kzw_all[s:e])/np.sqrt(Jq)
+                ume_stats = stream.UMEStats(Jp, Jq).update(fea_pr, fea_qr)
+                mean_h1, var = ume_stats.h1_mean_variance()[:2]
+                list_results.append(self._asymptotic_test_results(n,
+                    mean_h1, var))
+                s = e
+        for results in list_results:
+            results['time_secs'] = t.secs/len(list_results)
+        return list_results
+
+    def bootstrap_null(self, dat, n_bootstrap=1000, seed=1):
+        """
+        Simulate the null distribution of the test statistic with a
+        multiplier bootstrap on the two feature matrices (see
+        kmod.bootstrap.ustat_diff_draws()). The feature matrices are computed
+        only once.
+
+        :returns: (mean, draws) where mean is the same as the mean returned
+            by get_H1_mean_variance(), and draws is a numpy array of
+            n_bootstrap draws from the null distribution of the test
+            statistic.
+        """
+        fea_pr, fea_qr = self.feature_matrices(self.datap.data(),
+                self.dataq.data(), dat.data(), backend='numpy')
+        mean_h1 = rel_ustat_h1_mean_variance(fea_pr, fea_qr,
+                return_variance=False, backend='numpy')
+        draws = bootstrap.ustat_diff_draws(fea_pr, fea_qr,
+                n_bootstrap=n_bootstrap, seed=seed)
+        return mean_h1, draws
+
+    def perform_test_blocks(self, blocks):
+        """
+        Perform the test with the data supplied as an iterable of aligned row
+        blocks. See accumulate_stats().
+
+        :param blocks: an iterable (e.g., a generator) of tuples (X_b, Y_b,
+            Z_b) of b x d arrays. Row i of the three arrays in a block are
+            paired in the statistic.
+        """
+        with util.ContextTimer() as t:
+            ume_stats = self.accumulate_stats(blocks)
+            results = self.perform_test_stats(ume_stats)
+        results['time_secs'] = t.secs
+        return results
+
+    def perform_test_stats(self, ume_stats):
+        """
+        Perform the test given the accumulated sufficient statistics. This is
+        useful when shards of the data are processed separately, e.g., by
+        worker processes or on different hosts. Each worker calls
+        accumulate_stats() on its shard and sends back the resulting
+        UMEStats (or its to_dict()). The merged statistics (see
+        UMEStats.merge_all()) give exactly the same result as the test on the
+        full data.
+
+        :param ume_stats: a kmod.stream.UMEStats
+        """
+        with util.ContextTimer() as t:
+            mean_h1, var = ume_stats.h1_mean_variance()[:2]
+            results = self._asymptotic_test_results(ume_stats.n, mean_h1, var)
+        results['time_secs'] = t.secs
+        return results
+
+    @staticmethod
+    def _asymptotic_pvalue(stat, var):
+        """
+        p-value of the test statistic stat (scaled by \sqrt{n}) under the
+        asymptotic normal null distribution with variance var. If the
+        standard deviation is too small, H0 is not rejected (p-value = inf).
+        """
+        null_std = var**0.5
+        if null_std <= 1e-6:
+            log.l().warning('SD of the null distribution is too small. Was {}. Will not reject H0.'.format(null_std))
+            return np.inf
+        # Assume the mean of the null distribution is 0
+        return stats.norm.sf(stat, loc=0, scale=null_std)
+
+    def _asymptotic_test_results(self, n, mean_h1, var):
+        """
+        Return the results dictionary of perform_test() (without time_secs)
+        given the sample size n, and the mean and variance (not yet scaled by
+        \sqrt{n}) under H1.
+        """
+        alpha = self.alpha
+        stat = (n**0.5)*mean_h1
+        pval = SC_UME._asymptotic_pvalue(stat, var)
         results = {'alpha': self.alpha, 'pvalue': pval, 'test_stat': stat,
-                'h0_rejected': pval < alpha, 'time_secs': t.secs, }
+                'h0_rejected': pval < alpha, }
         return results
 
-    def get_H1_mean_variance(self, dat, return_variance=True):
+    def feature_matrices(self, X, Y, Z, backend=None):
+        """
+        Compute the two (correlated) feature matrices of UME(P, R) and
+        UME(Q, R) from aligned samples (or row blocks) X, Y, Z, each with b
+        rows. Same as tst.UMETest.feature_matrix() for each.
+
+        :param backend: a kmod.backend.Backend or its name. The kernels are
+            evaluated with backend.kernel_eval(). None for autograd.
+        :returns: (fea_pr, fea_qr) of sizes b x Jp and b x Jq (arrays of the
+            backend)
+        """
+        B = kbackend.get(backend)
+        X, Y, Z = B.asarray(X), B.asarray(Y), B.asarray(Z)
+        V = B.asarray(self.V)
+        Jp = V.shape[0]
+        Kzv = B.kernel_eval(self.k, Z, V)
+        fea_pr = (B.kernel_eval(self.k, X, V) - Kzv)/float(Jp)**0.5
+        if self.shared_locs:
+            # k(Z, V) is shared.
+            W, Kzw = V, Kzv
+        else:
+            W = B.asarray(self.W)
+            Kzw = B.kernel_eval(self.l, Z, W)
+        Jq = W.shape[0]
+        fea_qr = (B.kernel_eval(self.l, Y, W) - Kzw)/float(Jq)**0.5
+        return fea_pr, fea_qr
+
+    def accumulate_stats(self, blocks, ume_stats=None):
+        """
+        Accumulate the sufficient statistics of the two feature matrices from
+        row blocks of the data. Only O(J^2) numbers are kept. Each block is
+        discarded after it is processed.
+
+        :param blocks: an iterable (e.g., a generator) of tuples (X_b, Y_b,
+            Z_b) of b x d arrays (b can vary across blocks).
+        :param ume_stats: a kmod.stream.UMEStats to add to. Create a new one
+            if None.
+
+        :returns: a kmod.stream.UMEStats
+        """
+        if ume_stats is None:
+            ume_stats = stream.UMEStats(self.V.shape[0], self.W.shape[0])
+        for X, Y, Z in blocks:
+            fea_pr, fea_qr = self.feature_matrices(X, Y, Z, backend='numpy')
+            ume_stats.update(fea_pr, fea_qr)
+        return ume_stats
+
+    def get_H1_mean_variance(self, dat, return_variance=True,
+            block_size=None):
         """
         Return the mean and variance under H1 of the 
         test statistic = \sqrt{n}(UME(P, R)^2 - UME(Q, R))^2.
         The estimator of the mean is unbiased (can be negative). The variance
         is also valid under H0.
 
-        :returns: (mean, variance)
+        If block_size is not None, the n x J feature matrices are never
+        formed. Instead, the data (which may be numpy memmaps) are processed
+        in row blocks of block_size rows, and only O(J^2) sufficient
+        statistics are kept (see kmod.stream.UMEStats). The result is the
+        same up to floating-point rounding.
+
+        Without block_size, the statistic is computed with the backend of
+        this test.
+
+        :returns: (mean, variance). Scalars of the backend (e.g., torch
+            tensors that can be differentiated with respect to the test
+            locations).
 
         If return_variance is False, 
         :returns: mean
         """
-        umep = self.umep
-        umeq = self.umeq
-        # form a two-sample test dataset between datap and dat (data from R)
-        Z = dat.data()
-        datapr = tstdata.TSTData(self.datap.data(), Z)
-        dataqr = tstdata.TSTData(self.dataq.data(), Z)
-
-        # get the feature matrices (correlated)
-        fea_pr = umep.feature_matrix(datapr) # n x Jp
-        fea_qr = umeq.feature_matrix(dataqr) # n x Jq
+        if block_size is not None:
+            blocks = util.iter_row_blocks(block_size, self.datap.data(),
+                    self.dataq.data(), dat.data())
+            ume_stats = self.accumulate_stats(blocks)
+            if not return_variance:
+                return ume_stats.h1_mean_variance(return_variance=False)
+            mean_h1, var_h1, var_pr, var_qr, _ = ume_stats.h1_mean_variance()
+            if var_pr <= 0:
+                log.l().warning('Non-positive var_pr detected. Was {}'.format(var_pr))
+            if var_qr <= 0:
+                log.l().warning('Non-positive var_qr detected. Was {}'.format(var_qr))
+            return mean_h1, var_h1
+
+        # get the feature matrices (correlated) between datap, dataq and dat
+        # (data from R)
+        fea_pr, fea_qr = self.feature_matrices(self.datap.data(),
+                self.dataq.data(), dat.data(), backend=self.backend) # n x Jp, n x Jq
         assert fea_pr.shape[1] == self.V.shape[0]
         assert fea_qr.shape[1] == self.W.shape[0]
 
-        # umehp = ume_hat(p, r)
-        umehp, var_pr = tst.UMETest.ustat_h1_mean_variance(fea_pr,
-                return_variance=True, use_unbiased=True)
-        umehq, var_qr = tst.UMETest.ustat_h1_mean_variance(fea_qr,
-                return_variance=True, use_unbiased=True)
-
+        if not return_variance:
+            return rel_ustat_h1_mean_variance(fea_pr, fea_qr,
+                    return_variance=False, backend=self.backend)
+        mean_h1, var_h1, var_pr, var_qr, _ = rel_ustat_h1_mean_variance(fea_pr,
+                fea_qr, backend=self.backend)
         if var_pr <= 0:
             log.l().warning('Non-positive var_pr detected. Was {}'.format(var_pr))
         if var_qr <= 0:
             log.l().warning('Non-positive var_qr detected. Was {}'.format(var_qr))
         #assert var_pr > 0, 'var_pr was {}'.format(var_pr)
         #assert var_qr > 0, 'var_qr was {}'.format(var_qr)
-        mean_h1 = umehp - umehq
-
-        if not return_variance:
-            return mean_h1
-
-        # mean features
-        mean_pr = np.mean(fea_pr, axis=0)
-        mean_qr = np.mean(fea_qr, axis=0)
-        t1 = 4.0*np.mean(np.dot(fea_pr, mean_pr)*np.dot(fea_qr, mean_qr))
-        t2 = 4.0*np.sum(mean_pr**2)*np.sum(mean_qr**2)
-
-        # compute the cross-covariance
-        var_pqr = t1-t2
-        var_h1 = var_pr -2.0*var_pqr + var_qr
         return mean_h1, var_h1
 
     @staticmethod
@@ -551,19 +1186,62 @@ class SC_UME(SCTest):
 
         """
         def power_cri(V):
-            # TODO: This is not efficient. Should be good enough for plotting
-            # purpose.
-            J = V.shape[0]
-            values = np.zeros(J)
-            for i, v in enumerate(V):
-                Vi = v.reshape([1, -1])
-                values[i] = SC_UME.power_criterion(datap, dataq, datar,
-                        k, l, Vi, Vi, reg=reg)
-            return values
+            return SC_UME.single_loc_power_criteria(datap, dataq, datar, k,
+                    l, V, reg=reg)
         return power_cri
 
     @staticmethod
-    def power_criterion(datap, dataq, datar, k, l, V, W, reg=1e-3): 
+    def single_loc_power_criteria(datap, dataq, datar, k, l, C, reg=1e-7,
+            chunk_size=None):
+        """
+        Evaluate the power criterion with one test location (J=1, V=W=c)
+        for each of the m candidate locations c in C (m x d), e.g., to rank
+        candidate locations or to draw a contour plot on a grid. Return a
+        length-m numpy array whose entry i is equal to
+        power_criterion(datap, dataq, datar, k, l, C[[i]], C[[i]], reg).
+
+        With J=1, the feature matrices of all candidates in a chunk are
+        the columns of k(X, C) - k(Z, C) and l(Y, C) - l(Z, C). The means and
+        variances of all the columns are computed with a few matrix
+        operations.
+
+        :param chunk_size: number of candidates to process at a time. If
+            None, choose it so that each n x chunk_size Gram block has about
+            10^7 entries.
+        """
+        X = datap.data()
+        Y = dataq.data()
+        Z = datar.data()
+        n = Z.shape[0]
+        m = C.shape[0]
+        if chunk_size is None:
+            chunk_size = max(1, 10**7//n)
+
+        def ustat_mean_var(F):
+            # F: n x b. Same as tst.UMETest.ustat_h1_mean_variance() applied
+            # to each column.
+            mu = np.mean(F, 0)
+            mean = (mu**2)*(n/float(n-1)) - np.sum(F**2, 0)/float(n*(n-1))
+            var = 4.0*(mu**2)*np.mean(F**2, 0) - 4.0*mu**4
+            return mu, mean, var
+
+        values = []
+        for i in range(0, m, chunk_size):
+            Cb = C[i:i+chunk_size]
+            Kzc = k.eval(Z, Cb)
+            Lzc = Kzc if l is k else l.eval(Z, Cb)
+            fea_pr = k.eval(X, Cb) - Kzc
+            fea_qr = l.eval(Y, Cb) - Lzc
+            mu_pr, mean_pr, var_pr = ustat_mean_var(fea_pr)
+            mu_qr, mean_qr, var_qr = ustat_mean_var(fea_qr)
+            var_pqr = 4.0*mu_pr*mu_qr*np.mean(fea_pr*fea_qr, 0) - 4.0*(mu_pr*mu_qr)**2
+            var_h1 = var_pr - 2.0*var_pqr + var_qr
+            values.append((mean_pr - mean_qr)/np.sqrt(var_h1 + reg))
+        return np.hstack(values)
+
+    @staticmethod
+    def power_criterion(datap, dataq, datar, k, l, V, W, reg=1e-3,
+            backend=None):
         """
         Compute the power criterion of the UME-based 3-sample test .
 
@@ -575,16 +1253,22 @@ class SC_UME(SCTest):
         :param V: Jp x d numpy array of Jp test locations for UME(P, R)
         :param W: Jq x d numpy array of Jq test locations for UME(Q, R)
         :param reg: regularization parameter
+        :param backend: a kmod.backend.Backend or its name. None for
+            'autograd' (differentiable with autograd). With 'torch', V and W
+            (and the width of a kernel.KGauss) can be torch tensors
+            (requires_grad=True) and the returned criterion can be
+            differentiated with torch.autograd.
         
         Return power criterion = mean_under_H1/sqrt(var_under_H1 + reg) .
         """
-        scume = SC_UME(datap, dataq, k, l, V, W)
+        scume = SC_UME(datap, dataq, k, l, V, W, backend=backend)
         mean_h1, var_h1 = scume.get_H1_mean_variance(datar, return_variance=True)
-        ratio = mean_h1/np.sqrt(var_h1 + reg)
+        ratio = mean_h1/scume.backend.sqrt(var_h1 + reg)
         return ratio
 
     @staticmethod
-    def ume_test(X, Y, Z, V, alpha=0.01, mode='mean'):
+    def ume_test(X, Y, Z, V, alpha=0.01, mode='mean', rff_dim=None,
+            rff_seed=1):
         """
         Perform a UME three-sample test.
         All the data are assumed to be preprocessed.
@@ -595,6 +1279,9 @@ class SC_UME(SCTest):
             - Z: n x d ndarray, a sample from R
             - V: J x d ndarray, a set of J test locations
             - alpha: a user specified significance level
+            - rff_dim: if not None, use SC_RFFUME (random Fourier feature
+              approximation) with this number of features
+            - rff_seed: random seed for drawing the random features
 
         Returns:
             - a dictionary of the form
@@ -610,15 +1297,125 @@ class SC_UME(SCTest):
             mean_medxyz2 = SC_MMD.median_heuristic_bounliphone(X, Y, Z, subsample=1000)
             gwidth = mean_medxyz2
         else:
-            XYZ = np.vstack((X, Y, Z))
-            med2 = util.meddistance(XYZ, subsample=1000)**2
+            med2 = median.meddistance(X, Y, Z)**2
             gwidth = med2
+        if rff_dim is not None:
+            scume = SC_RFFUME(data.Data(X), data.Data(Y), gwidth, V, V,
+                    alpha=alpha, rff_dim=rff_dim, seed=rff_seed)
+            return scume.perform_test(data.Data(Z))
         k = kernel.KGauss(gwidth)
         scume = SC_UME(data.Data(X), data.Data(Y), k, k, V, V, alpha)
         return scume.perform_test(data.Data(Z))
 
 # end of class SC_UME
 
+class SC_RFFUME(SC_UME):
+    """
+    An approximation of SC_UME with the same Gaussian kernel KGauss(sigma2)
+    for both UME statistics, using D random Fourier features phi (see
+    kmod.approx.GaussRFF). Since k(x, v) ~ phi(x).dot(phi(v)),
+        UME^2(P, R) ~ (mu_x - mu_z)' A_V (mu_x - mu_z),
+    where A_V = Phi_V'Phi_V/J and mu_x, mu_z are the mean features. The
+    statistic and its variance are computed from the D-dimensional feature
+    means and covariances (see kmod.approx.rel_mean_variance()).
+    """
+
+    def __init__(self, datap, dataq, sigma2, V, W, alpha=0.01, rff_dim=500,
+            seed=1):
+        """
+        :param sigma2: squared Gaussian width
+        :param V: Jp x d numpy array of Jp test locations used in UME(P, R)
+        :param W: Jq x d numpy array of Jq test locations used in UME(Q, R)
+        :param rff_dim: number of random Fourier features D (even)
+        :param seed: random seed for drawing the random features
+        """
+        k = kernel.KGauss(sigma2)
+        super(SC_RFFUME, self).__init__(datap, dataq, k, k, V, W, alpha)
+        d = datap.dim()
+        self.rff = approx.GaussRFF(sigma2, d, D=rff_dim, seed=seed)
+        Phi_V = self.rff.features(V)
+        Phi_W = self.rff.features(W)
+        self.A_p = np.dot(Phi_V.T, Phi_V)/V.shape[0]
+        self.A_q = np.dot(Phi_W.T, Phi_W)/W.shape[0]
+        self.mom_x = self.rff.moments(datap.data())
+        self.mom_y = self.rff.moments(dataq.data())
+
+    def get_H1_mean_variance(self, dat, return_variance=True,
+            block_size=None):
+        """
+        Return the (approximate) mean and variance under H1 of the test
+        statistic sqrt(n)*(UME^2(P, R) - UME^2(Q, R)).
+        block_size is the number of rows featurized at a time (None for the
+        default of FeatureMoments.compute()).
+
+        :returns: (mean, variance)
+        """
+        if block_size is None:
+            mom_z = self.rff.moments(dat.data())
+        else:
+            mom_z = self.rff.moments(dat.data(), block_size=block_size)
+        mean_h1, var_h1 = approx.rel_mean_variance(self.mom_x, self.mom_y,
+                mom_z, A_p=self.A_p, A_q=self.A_q)
+        if not return_variance:
+            return mean_h1
+        return mean_h1, var_h1
+
+    def bootstrap_null(self, dat, n_bootstrap=1000, seed=1):
+        """
+        Multiplier bootstrap of the first-order terms of the approximate
+        statistic, with the influence values given by the random features
+        (see kmod.approx.rel_influence_values()).
+
+        :returns: (mean, draws) as in SC_UME.bootstrap_null()
+        """
+        Z = dat.data()
+        mom_z = self.rff.moments(Z)
+        mean_h1, _ = approx.rel_mean_variance(self.mom_x, self.mom_y, mom_z,
+                A_p=self.A_p, A_q=self.A_q)
+        h = approx.rel_influence_values(self.rff.features, self.datap.data(),
+                self.dataq.data(), Z, self.mom_x, self.mom_y, mom_z,
+                A_p=self.A_p, A_q=self.A_q)
+        draws = bootstrap.linear_draws(list(h), Z.shape[0],
+                n_bootstrap=n_bootstrap, seed=seed)
+        return mean_h1, draws
+
+    def perform_test_blocks(self, blocks):
+        """
+        Perform the (approximate) test with the data supplied as an iterable
+        of row blocks (X_b, Y_b, Z_b). Only the sums of the random features
+        of each sample are kept (O(D^2) numbers). The rows of the three
+        arrays in a block need not be paired, and the block sizes of X, Y, Z
+        may differ.
+        """
+        with util.ContextTimer() as t:
+            sums = [None, None, None]
+            for block in blocks:
+                for i, A in enumerate(block):
+                    sums[i] = approx.FeatureMoments.accumulate(
+                            self.rff.features, A, sums[i])
+            mom_x, mom_y, mom_z = [approx.FeatureMoments.from_sums(s) for s
+                    in sums]
+            mean_h1, var = approx.rel_mean_variance(mom_x, mom_y, mom_z,
+                    A_p=self.A_p, A_q=self.A_q)
+            results = self._asymptotic_test_results(mom_z.n, mean_h1, var)
+        results['time_secs'] = t.secs
+        return results
+
+    def accumulate_stats(self, blocks, ume_stats=None):
+        """
+        Not available: a kmod.stream.UMEStats holds the statistics of the
+        exact features. Use perform_test_blocks().
+        """
+        raise ValueError('SC_RFFUME does not accumulate kmod.stream.UMEStats (exact features). Use perform_test_blocks().')
+
+    def perform_test_stats(self, ume_stats):
+        """
+        Not available. See accumulate_stats().
+        """
+        raise ValueError('SC_RFFUME does not accumulate kmod.stream.UMEStats (exact features). Use perform_test_blocks().')
+
+# end of class SC_RFFUME
+
 class SC_GaussUME(SC_UME):
     """
     A SC_UME using two Gaussian kernels.
@@ -644,10 +1441,85 @@ class SC_GaussUME(SC_UME):
         l = kernel.KGauss(gwidth2q)
         super(SC_GaussUME, self).__init__(datap, dataq, k, l, V, W, alpha)
 
+    @staticmethod
+    def power_criterion_and_grad(datap, dataq, datar, V, gwidth, reg=1e-3):
+        """
+        Compute the power criterion of the UME three-sample test with V=W and
+        one Gaussian kernel of squared width gwidth for both UME(P, R) and
+        UME(Q, R), i.e., the same value as
+            SC_UME.power_criterion(datap, dataq, datar, k, k, V, V, reg)
+        with k = kernel.KGauss(gwidth), together with its gradients with
+        respect to V and gwidth. The gradients are derived in closed form,
+        and computed in the same pass as the value from the three n x J
+        Gram matrices. No autograd tracing is involved.
+
+        Notation: F_p = (k(X, V) - k(Z, V))/sqrt(J), F_q = (k(Y, V) - k(Z,
+        V))/sqrt(J) (n x J), mu_p, mu_q their column means, a = F_p mu_p,
+        b = F_q mu_q. Then the variance under H1 simplifies to
+            4*mean((a-b)^2) - 4*(||mu_p||^2 - ||mu_q||^2)^2.
+
+        :returns: (power criterion, gradient wrt V (J x d), derivative wrt
+            gwidth)
+        """
+        X, Y, Z = datap.data(), dataq.data(), datar.data()
+        n = Z.shape[0]
+        J = V.shape[0]
+        sumv2 = np.sum(V**2, 1)
+
+        def gauss_gram(A):
+            D2 = np.sum(A**2, 1)[:, np.newaxis] - 2.0*np.dot(A, V.T) + sumv2
+            D2 = np.maximum(D2, 0)
+            return np.exp(-D2/(2.0*gwidth)), D2
+
+        Kx, D2x = gauss_gram(X)
+        Ky, D2y = gauss_gram(Y)
+        Kz, D2z = gauss_gram(Z)
+        sqrtJ = np.sqrt(J)
+        Fp = (Kx - Kz)/sqrtJ
+        Fq = (Ky - Kz)/sqrtJ
+
+        # value
+        mup = np.mean(Fp, 0)
+        muq = np.mean(Fq, 0)
+        mup2 = np.sum(mup**2)
+        muq2 = np.sum(muq**2)
+        mean_p = mup2*(n/float(n-1)) - np.sum(Fp**2)/float(n*(n-1))
+        mean_q = muq2*(n/float(n-1)) - np.sum(Fq**2)/float(n*(n-1))
+        c = np.dot(Fp, mup) - np.dot(Fq, muq)
+        Dmu = mup2 - muq2
+        var_h1 = 4.0*np.mean(c**2) - 4.0*Dmu**2
+        S = mean_p - mean_q
+        T = var_h1 + reg
+        value = S/np.sqrt(T)
+
+        # adjoints of Fp, Fq (n x J)
+        dS = 1.0/np.sqrt(T)
+        dT = -0.5*S/T**1.5
+        g = 8.0*c/n
+        dmean_p = 2.0/(n-1)*mup[np.newaxis, :] - 2.0*Fp/float(n*(n-1))
+        dmean_q = 2.0/(n-1)*muq[np.newaxis, :] - 2.0*Fq/float(n*(n-1))
+        dvar_p = np.outer(g, mup) + (np.dot(Fp.T, g) - 16.0*Dmu*mup)[np.newaxis, :]/n
+        dvar_q = -np.outer(g, muq) + (-np.dot(Fq.T, g) + 16.0*Dmu*muq)[np.newaxis, :]/n
+        Ap = dS*dmean_p + dT*dvar_p
+        Aq = -dS*dmean_q + dT*dvar_q
+
+        # backpropagate to the Gram matrices, then to V and gwidth.
+        # dK_ij/dv_j = K_ij (a_i - v_j)/gwidth,
+        # dK_ij/dgwidth = K_ij ||a_i - v_j||^2/(2 gwidth^2)
+        grad_V = 0.0
+        grad_gwidth = 0.0
+        for A, K, D2, adj in [(X, Kx, D2x, Ap), (Y, Ky, D2y, Aq),
+                (Z, Kz, D2z, -(Ap + Aq))]:
+            M = adj*K/sqrtJ
+            grad_V = grad_V + (np.dot(M.T, A) - np.sum(M, 0)[:, np.newaxis]*V)/gwidth
+            grad_gwidth = grad_gwidth + np.sum(M*D2)/(2.0*gwidth**2)
+        return value, grad_V, grad_gwidth
+
     @staticmethod
     def optimize_3sample_criterion(datap, dataq, datar, V0, gwidth0, reg=1e-3,
             max_iter=100, tol_fun=1e-6, disp=False, locs_bounds_frac=100,
-            gwidth_lb=None, gwidth_ub=None):
+            gwidth_lb=None, gwidth_ub=None, grad_method='analytic',
+            minibatch_size=None, stoch_options=None, warm_start=None):
         """
         Similar to optimize_2sets_locs_widths() but constrain V=W, and
         constrain the two Gaussian widths to be the same.
@@ -673,39 +1545,78 @@ class SC_GaussUME(SC_UME):
               coordinate (of the aggregated data) multiplied by this number.
         - gwidth_lb: absolute lower bound on both the Gaussian width^2
         - gwidth_ub: absolute upper bound on both the Gaussian width^2
+        - grad_method: 'analytic' to compute the objective and its gradient
+              together in closed form (see power_criterion_and_grad()).
+              'autograd' to differentiate SC_UME.power_criterion() with
+              autograd (slower; useful for verification).
+        - minibatch_size: if not None, first optimize with minibatch Adam
+              (see kmod.stochopt.minibatch_adam()) on random minibatches
+              of this size, so that the cost does not grow with n. Then
+              polish with full-batch L-BFGS for max_iter iterations. Set
+              max_iter=0 to skip the polish.
+        - stoch_options: a dictionary of extra options for
+              kmod.stochopt.minibatch_adam() e.g., n_iters, step_size,
+              lr_decay, patience, seed.
+        - warm_start: None or a kmod.warmstart.WarmStart. If it holds
+              the parameters of a previous optimization (of the same shapes),
+              start from them instead of V0, gwidth0. The optimized
+              parameters are stored back to it.
 
         If the lb, ub bounds are None, use fraction of the median heuristics 
             to automatically set the bounds.
         
         Return (optimized V, optimized Gaussian width^2, info from the optimization)
         """
+        warm_started = False
+        if warm_start is not None:
+            prev = warm_start.load(V=V0, gwidth=gwidth0)
+            if prev is not None:
+                V0, gwidth0 = prev['V'], prev['gwidth']
+                warm_started = True
         J = V0.shape[0]
         X, Y, Z = datap.data(), dataq.data(), datar.data()
         n, d = X.shape
 
-        # Parameterize the Gaussian width with its square root (then square later)
-        # to automatically enforce the positivity.
-        def obj(sqrt_gwidth, V):
-            k = kernel.KGauss(sqrt_gwidth**2)
-            return -SC_UME.power_criterion(datap, dataq, datar, k, k, V, V,
-                    reg=reg)
-
         flatten = lambda gwidth, V: np.hstack((gwidth, V.reshape(-1)))
         def unflatten(x):
             sqrt_gwidth = x[0]
             V = np.reshape(x[1:], (J, d))
             return sqrt_gwidth, V
 
-        def flat_obj(x):
-            sqrt_gwidth, V = unflatten(x)
-            return obj(sqrt_gwidth, V)
+        # Parameterize the Gaussian width with its square root (then square later)
+        # to automatically enforce the positivity.
+        def make_obj_grad(dp, dq, dr):
+            """
+            Return a function x |-> (objective, gradient) to minimize on the
+            data dp, dq, dr.
+            """
+            if grad_method == 'analytic':
+                def flat_obj_grad(x):
+                    sqrt_gwidth, V = unflatten(x)
+                    value, grad_V, grad_gwidth = \
+                        SC_GaussUME.power_criterion_and_grad(dp, dq, dr, V,
+                                sqrt_gwidth**2, reg=reg)
+                    # chain rule for gwidth = sqrt_gwidth**2. Negate to
+                    # minimize.
+                    grad = flatten(2.0*sqrt_gwidth*grad_gwidth, grad_V)
+                    return -value, -grad
+                return flat_obj_grad
+            elif grad_method == 'autograd':
+                def flat_obj(x):
+                    sqrt_gwidth, V = unflatten(x)
+                    k = kernel.KGauss(sqrt_gwidth**2)
+                    return -SC_UME.power_criterion(dp, dq, dr, k, k, V, V,
+                            reg=reg)
+                return autograd.value_and_grad(flat_obj)
+            else:
+                raise ValueError('grad_method must be "analytic" or "autograd". Was {}'.format(grad_method))
 
         # Initial point
         x0 = flatten(np.sqrt(gwidth0), V0)
         
         #make sure that the optimized gwidth is not too small or too large.
         XYZ = np.vstack((X, Y, Z))
-        med2 = util.meddistance(XYZ, subsample=1000)**2
+        med2 = median.meddistance(X, Y, Z)**2
         fac_min = 1e-2 
         fac_max = 1e2
         if gwidth_lb is None:
@@ -727,35 +1638,53 @@ class SC_GaussUME(SC_UME):
         x0_ub = np.hstack((np.sqrt(gwidth_ub), np.reshape(V_ub, -1)))
         x0_bounds = list(zip(x0_lb, x0_ub))
 
+        # the objective function returns both the value and the gradient
+        fun = make_obj_grad(datap, dataq, datar)
+
         # optimize. Time the optimization as well.
         # https://docs.scipy.org/doc/scipy/reference/optimize.minimize-lbfgsb.html
-        grad_obj = autograd.elementwise_grad(flat_obj)
         with util.ContextTimer() as timer:
-            opt_result = scipy.optimize.minimize(
-              flat_obj, x0, method='L-BFGS-B', 
-              bounds=x0_bounds,
-              tol=tol_fun, 
-              options={
-                  'maxiter': max_iter, 'ftol': tol_fun, 'disp': disp,
-                  'gtol': 1.0e-08,
-                  },
-              jac=grad_obj,
-            )
-
-        opt_result = dict(opt_result)
+            if minibatch_size is not None:
+                def batch_obj_grad(x, ind):
+                    return make_obj_grad(data.Data(X[ind]), data.Data(Y[ind]),
+                            data.Data(Z[ind]))(x)
+                x0, stoch_info = stochopt.minibatch_adam(batch_obj_grad, x0,
+                        n, minibatch_size, bounds=x0_bounds,
+                        **(stoch_options or {}))
+            if minibatch_size is None or max_iter > 0:
+                opt_result = scipy.optimize.minimize(
+                  fun, x0, method='L-BFGS-B', 
+                  bounds=x0_bounds,
+                  tol=tol_fun, 
+                  options={
+                      'maxiter': max_iter, 'ftol': tol_fun, 'disp': disp,
+                      'gtol': 1.0e-08,
+                      },
+                  jac=True,
+                )
+                opt_result = dict(opt_result)
+            else:
+                opt_result = dict(stoch_info)
+            if minibatch_size is not None:
+                opt_result['stoch_info'] = stoch_info
+
         opt_result['time_secs'] = timer.secs
+        opt_result['warm_started'] = warm_started
         x_opt = opt_result['x']
         sq_gw_opt, V_opt = unflatten(x_opt)
         gw_opt = sq_gw_opt**2
 
         assert util.is_real_num(gw_opt), 'gw_opt is not real. Was %s' % str(gw_opt)
+        if warm_start is not None:
+            warm_start.save(V=V_opt, gwidth=gw_opt)
         return V_opt, gw_opt, opt_result
 
 
     @staticmethod
     def optimize_2sets_locs_widths(datap, dataq, datar, V0, W0, gwidth0p,
             gwidth0q, reg=1e-3, max_iter=100,  tol_fun=1e-6, disp=False,
-            locs_bounds_frac=100, gwidth_lb=None, gwidth_ub=None):
+            locs_bounds_frac=100, gwidth_lb=None, gwidth_ub=None,
+            warm_start=None):
         """
         Optimize two sets of test locations and the Gaussian kernel widths by
         maximizing the test power criterion of the UME two-sample test (not
@@ -784,6 +1713,10 @@ class SC_GaussUME(SC_UME):
               (of the aggregated data) multiplied by this number.
         - gwidth_lb: absolute lower bound on both the Gaussian width^2
         - gwidth_ub: absolute upper bound on both the Gaussian width^2
+        - warm_start: None or a kmod.warmstart.WarmStart. If it holds
+              the parameters of a previous optimization (of the same shapes),
+              start from them instead of V0, W0, gwidth0p, gwidth0q. The
+              optimized parameters are stored back to it.
 
         If the lb, ub bounds are None, use fraction of the median heuristics 
             to automatically set the bounds.
@@ -793,6 +1726,14 @@ class SC_GaussUME(SC_UME):
             (W test_locs, gaussian width^2 for UME(Q, R), optimization info log),
                 )
         """
+        warm_started = False
+        if warm_start is not None:
+            prev = warm_start.load(V=V0, W=W0, gwidthp=gwidth0p,
+                    gwidthq=gwidth0q)
+            if prev is not None:
+                V0, W0 = prev['V'], prev['W']
+                gwidth0p, gwidth0q = prev['gwidthp'], prev['gwidthq']
+                warm_started = True
 
         Z = datar.data()
         datapr = tstdata.TSTData(datap.data(), Z)
@@ -812,6 +1753,12 @@ class SC_GaussUME(SC_UME):
                 locs_bounds_frac=locs_bounds_frac, gwidth_lb=gwidth_lb,
                 gwidth_ub=gwidth_ub)
 
+        opt_infop['warm_started'] = warm_started
+        opt_infoq['warm_started'] = warm_started
+        if warm_start is not None:
+            warm_start.save(V=V_opt, W=W_opt, gwidthp=gw2p_opt,
+                    gwidthq=gw2q_opt)
+
         return ( (V_opt, gw2p_opt, opt_infop), (W_opt, gw2q_opt, opt_infoq) )
 
 # end class SC_GaussUME
@@ -822,7 +1769,8 @@ class SC_MMD(SCTest):
     proposed by Bounliphone, et al 2016 (ICLR)
     """
 
-    def __init__(self, datap, dataq, k, alpha=0.01):
+    def __init__(self, datap, dataq, k, alpha=0.01, tile_size=512,
+            n_threads=None, backend='numpy'):
         """
         :param datap: a kmod.data.Data object representing an i.i.d. sample X
             (from model 1)
@@ -830,11 +1778,24 @@ class SC_MMD(SCTest):
             (from model 2)
         :param k: a kmod.Kernel
         :param alpha: significance level of the test
+        :param tile_size: size of the tiles of the Gram matrices used in
+            get_H1_mean_variance(). See kmod.gram.RelMMDGramStats.
+        :param n_threads: number of threads for evaluating the tiles. None to
+            use the number of CPUs.
+        :param backend: a kmod.backend.Backend or its name ('numpy',
+            'autograd' or 'torch') for computing the statistic in
+            get_H1_mean_variance(). With 'numpy', the Gram matrices are
+            summed tile by tile with plain numpy. With the other
+            (differentiable) backends, the full n x n Gram matrices are formed
+            (see kmod.gram.RelMMDGramStats.from_grams()).
         """
         super(SC_MMD, self).__init__(datap, dataq, alpha)
         self.k = k
+        self.tile_size = tile_size
+        self.n_threads = n_threads
+        self.backend = kbackend.get(backend)
 
-    def perform_test(self, dat):
+    def perform_test(self, dat, null='asymptotic', n_bootstrap=1000, seed=1):
         """perform the model comparison test and return values computed in a
         dictionary: 
         {
@@ -846,21 +1807,30 @@ class SC_MMD(SCTest):
         }
 
         :param dat: an instance of kmod.data.Data
+        :param null: 'asymptotic' to use the asymptotic normal null
+            distribution. 'bootstrap' to simulate the null distribution with
+            a multiplier bootstrap (see bootstrap_null()).
+        :param n_bootstrap: number of bootstrap draws
+        :param seed: random seed for the bootstrap
         """
         with util.ContextTimer() as t:
             alpha = self.alpha
             X = dat.data()
             n = X.shape[0]
-            # mean and variance are not yet scaled by \sqrt{n}
-            # The variance is the same for both H0 and H1.
-            mean_h1, var = self.get_H1_mean_variance(dat)
-            if not util.is_real_num(var) or var < 0:
-                log.l().warning('Invalid H0 variance. Was {}'.format(var))
-            stat = (n**0.5) * mean_h1
-            # Assume the mean of the null distribution is 0
-            pval = stats.norm.sf(stat, loc=0, scale=var**0.5)
-            if not util.is_real_num(pval):
-                log.l().warning('p-value is not a real number. Was {}'.format(pval))
+            if null == 'asymptotic':
+                # mean and variance are not yet scaled by \sqrt{n}
+                # The variance is the same for both H0 and H1.
+                mean_h1, var = self.get_H1_mean_variance(dat)
+                mean_h1 = self.backend.to_numpy(mean_h1)
+                var = self.backend.to_numpy(var)
+                stat = (n**0.5) * mean_h1
+                pval = SC_MMD._asymptotic_pvalue(stat, var)
+            elif null == 'bootstrap':
+                mean_h1, draws = self.bootstrap_null(dat, n_bootstrap, seed)
+                stat = (n**0.5) * mean_h1
+                pval = bootstrap.pvalue(stat, draws)
+            else:
+                raise ValueError('null must be "asymptotic" or "bootstrap". Was {}'.format(null))
 
 
         results = {
@@ -876,7 +1846,7 @@ class SC_MMD(SCTest):
         """
         mean_h1 = self.get_H1_mean_variance(dat, return_variance=False)
         n = dat.sample_size()
-        return (n**0.5) * mean_h1
+        return (n**0.5) * self.backend.to_numpy(mean_h1)
 
     def get_H1_mean_variance(self, dat, return_variance=True):
         """
@@ -886,13 +1856,38 @@ class SC_MMD(SCTest):
         The estimator of the mean is unbiased (can be negative). The estimator
         of the variance is also unbiased. The variance is also valid under H0.
 
-        :returns: (mean, variance)
+        If the three samples have the same size, each block of the Gram
+        matrices is evaluated only once, and all the required sums are
+        accumulated tile by tile (see kmod.gram.RelMMDGramStats). Otherwise,
+        the full Gram matrices are formed.
+
+        With the 'autograd' or 'torch' backend, the three samples must have
+        the same size.
+
+        :returns: (mean, variance). Scalars of the backend.
         """
         # form a two-sample test dataset between datap and dat (data from R)
         Z = dat.data()
         n = Z.shape[0]
         X = self.datap.data()
         Y = self.dataq.data()
+        B = self.backend
+        if B.name != 'numpy':
+            if X.shape[0] != n or Y.shape[0] != n:
+                raise ValueError('The backend {} requires samples of the same size. Were {}, {}, {}'.format(
+                    B.name, X.shape[0], Y.shape[0], n))
+            X, Y, Z = B.asarray(X), B.asarray(Y), B.asarray(Z)
+            k = self.k
+            gs = gram.RelMMDGramStats.from_grams(B.kernel_eval(k, X, X),
+                    B.kernel_eval(k, Y, Y), B.kernel_eval(k, Z, Z),
+                    B.kernel_eval(k, X, Z), B.kernel_eval(k, Y, Z), backend=B)
+            return SC_MMD._gram_stats_H1_mean_variance(gs, return_variance)
+        if X.shape[0] == n and Y.shape[0] == n:
+            gs = gram.RelMMDGramStats.compute(X, Y, Z, self.k,
+                    tile_size=self.tile_size, n_threads=self.n_threads,
+                    backend=B)
+            return SC_MMD._gram_stats_H1_mean_variance(gs, return_variance)
+
         # This always return a variance. But will be None if is_var_computed=False
         mmd_mean_pr, var_pr = tst.QuadMMDTest.h1_mean_var(X, Z, self.k,
                 is_var_computed=return_variance)
@@ -911,6 +1906,148 @@ class SC_MMD(SCTest):
         var_h1 = var_pr - 2.0*var_pqr + var_qr
         return mean_h1, n*var_h1
 
+    @staticmethod
+    def _asymptotic_pvalue(stat, var):
+        """
+        p-value of the test statistic stat (scaled by \sqrt{n}) under the
+        asymptotic normal null distribution with variance var. An invalid
+        variance is only reported with a warning.
+        """
+        if not util.is_real_num(var) or var < 0:
+            log.l().warning('Invalid H0 variance. Was {}'.format(var))
+        # Assume the mean of the null distribution is 0
+        pval = stats.norm.sf(stat, loc=0, scale=var**0.5)
+        if not util.is_real_num(pval):
+            log.l().warning('p-value is not a real number. Was {}'.format(pval))
+        return pval
+
+    @staticmethod
+    def _gram_stats_H1_mean_variance(gs, return_variance=True):
+        """
+        Same as get_H1_mean_variance() but given the accumulated
+        kmod.gram.RelMMDGramStats gs.
+        """
+        mmd_mean_pr, var_pr = gs.h1_mean_var('x',
+                is_var_computed=return_variance)
+        mmd_mean_qr, var_qr = gs.h1_mean_var('y',
+                is_var_computed=return_variance)
+        mean_h1 = mmd_mean_pr - mmd_mean_qr
+        if not return_variance:
+            return mean_h1
+        var_pqr = gs.cross_covariance()
+        var_h1 = var_pr - 2.0*var_pqr + var_qr
+        return mean_h1, gs.n*var_h1
+
+    def perform_test_many(self, list_dat):
+        """
+        Perform the test on each of the samples from R in list_dat (e.g., one
+        reference sample per day or per data slice) against the same datap
+        and dataq. The P/Q-side Gram matrices Kxx, Kyy are computed only
+        once and kept in memory. The cross Gram matrices k(X, Z), k(Y, Z) are
+        evaluated per sample, and Kzz in the tiled engine (see
+        kmod.gram.RelMMDGramStats). So, memory usage is O(n^2) regardless of
+        the number of samples. Samples whose size differs from that of datap
+        or dataq are tested separately with perform_test().
+
+        :param list_dat: a list of kmod.data.Data
+        :returns: a list of results dictionaries (as returned by
+            perform_test()), one for each sample. time_secs in each is the
+            total time divided by the number of samples.
+        """
+        if not self._has_stat_of(SC_MMD):
+            return SCTest.perform_test_many(self, list_dat)
+        with util.ContextTimer() as t:
+            X = self.datap.data()
+            Y = self.dataq.data()
+            k = self.k
+            nx, ny = X.shape[0], Y.shape[0]
+            list_Z = [dat.data() for dat in list_dat]
+            is_batched = [nx == ny and Z.shape[0] == nx for Z in list_Z]
+            if any(is_batched):
+                Kxx = k.eval(X, X)
+                Kyy = k.eval(Y, Y)
+
+            list_results = []
+            for dat, Z, b in zip(list_dat, list_Z, is_batched):
+                if not b:
+                    list_results.append(self.perform_test(dat))
+                    continue
+                n = Z.shape[0]
+                cache = {'xx': Kxx, 'yy': Kyy, 'xz': k.eval(X, Z),
+                        'yz': k.eval(Y, Z)}
+                gs = gram.RelMMDGramStats.compute(X, Y, Z, k,
+                        tile_size=self.tile_size, n_threads=self.n_threads,
+                        cache=cache)
+                mean_h1, var = SC_MMD._gram_stats_H1_mean_variance(gs)
+                stat = (n**0.5) * mean_h1
+                pval = SC_MMD._asymptotic_pvalue(stat, var)
+                list_results.append({'alpha': self.alpha, 'pvalue': pval,
+                    'test_stat': stat, 'h0_rejected': pval < self.alpha, })
+        for results in list_results:
+            results['time_secs'] = t.secs/len(list_results)
+        return list_results
+
+    def bootstrap_null(self, dat, n_bootstrap=1000, seed=1):
+        """
+        Simulate the null distribution of the test statistic with a
+        multiplier bootstrap of its first-order (linear) terms (see
+        kmod.bootstrap.linear_draws()). The influence values of the points of
+        X, Y, Z only need the row sums of the Gram matrices, which are
+        accumulated tile by tile (see kmod.gram.RelMMDGramStats) if the three
+        samples have the same size.
+
+        :returns: (mean, draws) where mean is the same as the mean returned
+            by get_H1_mean_variance(), and draws is a numpy array of
+            n_bootstrap draws from the null distribution of the test
+            statistic.
+        """
+        X = self.datap.data()
+        Y = self.dataq.data()
+        Z = dat.data()
+        k = self.k
+        nx, ny, nz = X.shape[0], Y.shape[0], Z.shape[0]
+        if nx == nz and ny == nz:
+            gs = gram.RelMMDGramStats.compute(X, Y, Z, k,
+                    tile_size=self.tile_size, n_threads=self.n_threads)
+            mmd_mean_pr, _ = gs.h1_mean_var('x', is_var_computed=False)
+            mmd_mean_qr, _ = gs.h1_mean_var('y', is_var_computed=False)
+            rs_xx, rs_yy, rs_zz = gs.rs_xx, gs.rs_yy, gs.rs_zz
+            rs_xz, rs_yz = gs.rs_xz, gs.rs_yz
+            cs_xz, cs_yz = gs.cs_xz, gs.cs_yz
+        else:
+            mmd_mean_pr, _ = tst.QuadMMDTest.h1_mean_var(X, Z, k,
+                    is_var_computed=False)
+            mmd_mean_qr, _ = tst.QuadMMDTest.h1_mean_var(Y, Z, k,
+                    is_var_computed=False)
+            Kxx = k.eval(X, X)
+            Kyy = k.eval(Y, Y)
+            Kxz = k.eval(X, Z)
+            Kyz = k.eval(Y, Z)
+            rs_xx = np.sum(Kxx, 1) - np.diag(Kxx)
+            rs_yy = np.sum(Kyy, 1) - np.diag(Kyy)
+            rs_xz, cs_xz = np.sum(Kxz, 1), np.sum(Kxz, 0)
+            rs_yz, cs_yz = np.sum(Kyz, 1), np.sum(Kyz, 0)
+        hx, hy, hz = SC_MMD._influence_values(rs_xx, rs_yy, rs_xz, rs_yz,
+                cs_xz, cs_yz)
+        draws = bootstrap.linear_draws([hx, hy, hz], nz,
+                n_bootstrap=n_bootstrap, seed=seed)
+        return mmd_mean_pr - mmd_mean_qr, draws
+
+    @staticmethod
+    def _influence_values(rs_xx, rs_yy, rs_xz, rs_yz, cs_xz, cs_yz):
+        """
+        Return the first-order influence values (hx, hy, hz) of the points of
+        X, Y, Z on the difference of the two MMD^2 U-statistics, given the
+        row sums rs_* (diagonal removed for xx, yy) and the column sums cs_*
+        of the Gram matrices. See bootstrap_null().
+        """
+        nx, ny, nz = rs_xx.shape[0], rs_yy.shape[0], cs_xz.shape[0]
+        # The terms of Kzz cancel.
+        hx = 2.0*(rs_xx/(nx-1) - rs_xz/nz)
+        hy = -2.0*(rs_yy/(ny-1) - rs_yz/nz)
+        hz = 2.0*(cs_yz/ny - cs_xz/nx)
+        return hx, hy, hz
+
     @staticmethod
     def get_cross_covariance(X, Y, Z, k):
         """
@@ -932,6 +2069,14 @@ class SC_MMD(SCTest):
         # Kxy
         Kzy = k.eval(Z, Y)
         # Kxz
+        return SC_MMD.get_cross_covariance_gram(Kzz, Kzx, Kzy)
+
+    @staticmethod
+    def get_cross_covariance_gram(Kzz, Kzx, Kzy):
+        """
+        Same as get_cross_covariance() but given the Gram matrices
+        Kzz = k(Z, Z), Kzx = k(Z, X) and Kzy = k(Z, Y).
+        """
         Kzznd = Kzz - np.diag(np.diag(Kzz))
         # Kxxnd = Kxx-diag(diag(Kxx));
 
@@ -949,19 +2094,25 @@ class SC_MMD(SCTest):
         # u_xy=sum(sum(Kxy))/(m*n);
         # u_xz=sum(sum(Kxz))/(m*r);
 
-        ct1 = 1./(nz*(nz-1)**2) * np.sum(np.dot(Kzznd,Kzznd))
+        # The grand sums of the matrix products are computed as inner
+        # products of row sums e.g., sum(Kzznd.dot(Kzy)) = rs_zz.dot(rs_zy).
+        # This is O(n^2) instead of O(n^3).
+        rs_zz = np.sum(Kzznd, 1)
+        rs_zx = np.sum(Kzx, 1)
+        rs_zy = np.sum(Kzy, 1)
+        ct1 = 1./(nz*(nz-1)**2) * np.dot(rs_zz, rs_zz)
         # ct1 = (1/(m*(m-1)*(m-1)))   * sum(sum(Kzznd*Kzznd));
         ct2 = u_zz**2
         # ct2 =  u_xx^2;
-        ct3 = 1./(nz*(nz-1)*ny) * np.sum(np.dot(Kzznd,Kzy))
+        ct3 = 1./(nz*(nz-1)*ny) * np.dot(rs_zz, rs_zy)
         # ct3 = (1/(m*(m-1)*r))       * sum(sum(Kzznd*Kxz));
         ct4 = u_zz * u_zy
         # ct4 =  u_xx*u_xz;
-        ct5 = (1./(nz*(nz-1)*nx)) * np.sum(np.dot(Kzznd, Kzx))
+        ct5 = (1./(nz*(nz-1)*nx)) * np.dot(rs_zz, rs_zx)
         # ct5 = (1/(m*(m-1)*n))       * sum(sum(Kzznd*Kxy));
         ct6 = u_zz * u_zx
         # ct6 = u_xx*u_xy;
-        ct7 = (1./(nx*nz*ny)) * np.sum(np.dot(Kzx.T, Kzy))
+        ct7 = (1./(nx*nz*ny)) * np.dot(rs_zx, rs_zy)
         # ct7 = (1/(n*m*r))           * sum(sum(Kzx'*Kxz));
         ct8 = u_zx * u_zy
         # ct8 = u_xy*u_xz;
@@ -974,7 +2125,8 @@ class SC_MMD(SCTest):
         return cov    
 
     @staticmethod
-    def mmd_test(X, Y, Z, alpha=0.01, mode='mean'):
+    def mmd_test(X, Y, Z, alpha=0.01, mode='mean', rff_dim=None,
+            rff_seed=1):
         """
         Perform a MMD three-sample test.
         All the data are assumed to be preprocessed.
@@ -984,6 +2136,9 @@ class SC_MMD(SCTest):
             - Y: n x d ndarray, a sample from Q
             - Z: n x d ndarray, a sample from R
             - alpha: a user specified significance level
+            - rff_dim: if not None, use SC_RFFMMD (random Fourier feature
+              approximation) with this number of features
+            - rff_seed: random seed for drawing the random features
 
         Returns:
             - a dictionary of the form
@@ -999,9 +2154,12 @@ class SC_MMD(SCTest):
             mean_medxyz2 = SC_MMD.median_heuristic_bounliphone(X, Y, Z, subsample=1000)
             gwidth = mean_medxyz2
         else:
-            XYZ = np.vstack((X, Y, Z))
-            med2 = util.meddistance(XYZ, subsample=1000)**2
+            med2 = median.meddistance(X, Y, Z)**2
             gwidth = med2
+        if rff_dim is not None:
+            scmmd = SC_RFFMMD(data.Data(X), data.Data(Y), gwidth,
+                    alpha=alpha, rff_dim=rff_dim, seed=rff_seed)
+            return scmmd.perform_test(data.Data(Z))
         k = kernel.KGauss(gwidth)
         scmmd = SC_MMD(data.Data(X), data.Data(Y), k, alpha)
         return scmmd.perform_test(data.Data(Z))
@@ -1041,7 +2199,6 @@ class SC_MMD(SCTest):
         * X, Y: samples from two models.
         * Z: reference sample 
         """
-        # subsample first
         nx = X.shape[0]
         ny = Y.shape[0]
         nz = Z.shape[0]
@@ -1049,21 +2206,309 @@ class SC_MMD(SCTest):
             raise ValueError('X and Y do not have the same sample size. nx={}, ny={}'.format(nx, ny))
         if ny != nz:
             raise ValueError('Y and Z do not have the same sample size. ny={}, nz={}'.format(ny, nz))
-        n = nx
         assert subsample > 0
-        with util.NumpySeedContext(seed=seed):
-            ind = np.random.choice(n, min(subsample, n), replace=False)
-            X = X[ind, :]
-            Y = Y[ind, :]
-            Z = Z[ind, :]
-
-        sq_pdist_yz = util.dist_matrix(Y, Z)**2
-        med_yz = np.median(sq_pdist_yz)**0.5
-
-        sq_pdist_xz = util.dist_matrix(X, Z)**2
-        med_xz = np.median(sq_pdist_xz)**0.5
+        # The same subset of rows of X, Y, Z is used (same seed and sample
+        # size).
+        mh = median.MedianHeuristic(subsample=subsample, seed=seed)
+        _, (med_yz, med_xz) = mh.medians([X, Y, Z], cross=[(1, 2), (0, 2)])
         sigma2 = 0.5*np.mean([med_yz, med_xz])**2
         return sigma2
 
 
 # end of class SC_MMD
+
+class SC_LinearMMD(SC_MMD):
+    """
+    A linear-time version of SC_MMD. Each MMD^2 is estimated with the
+    linear-time estimator of Gretton et al., 2012 (JMLR, Section 6), which
+    averages the U-statistic kernel h over disjoint pairs of points
+    (2i-1, 2i). The relative statistic is then a mean of n/2 i.i.d. terms, and
+    its variance is estimated by their sample variance. Run time and memory
+    are O(n). The three samples must have the same size.
+
+    The kernel must implement pair_eval().
+    """
+
+    def __init__(self, datap, dataq, k, alpha=0.01):
+        super(SC_LinearMMD, self).__init__(datap, dataq, k, alpha)
+
+    @staticmethod
+    def linear_h_diff(X, Y, Z, k):
+        """
+        Return a length-n/2 array of h((x, z), (x', z')) - h((y, z), (y', z'))
+        on the disjoint pairs of consecutive points, where h is the kernel of
+        the MMD^2 U-statistic. The k(z, z') terms cancel.
+        """
+        n = Z.shape[0]
+        if X.shape[0] != n or Y.shape[0] != n:
+            raise ValueError('X, Y, Z must have the same sample size. Were {}, {}, {}'.format(
+                X.shape[0], Y.shape[0], n))
+        m = n//2
+        if m < 2:
+            raise ValueError('Need at least 4 points. Was {}'.format(n))
+        X1, X2 = X[0:2*m:2], X[1:2*m:2]
+        Y1, Y2 = Y[0:2*m:2], Y[1:2*m:2]
+        Z1, Z2 = Z[0:2*m:2], Z[1:2*m:2]
+        hp = k.pair_eval(X1, X2) - k.pair_eval(X1, Z2) - k.pair_eval(X2, Z1)
+        hq = k.pair_eval(Y1, Y2) - k.pair_eval(Y1, Z2) - k.pair_eval(Y2, Z1)
+        return hp - hq
+
+    def get_H1_mean_variance(self, dat, return_variance=True):
+        """
+        Return the mean and variance under H1 of the test statistic
+            sqrt(n)*(MMD_l(Z, X)^2 - MMD_l(Z, Y)^2)
+        where MMD_l^2 is the linear-time estimator.
+
+        :returns: (mean, variance)
+        """
+        Z = dat.data()
+        n = Z.shape[0]
+        hdiff = SC_LinearMMD.linear_h_diff(self.datap.data(),
+                self.dataq.data(), Z, self.k)
+        mean_h1 = np.mean(hdiff)
+        if not return_variance:
+            return mean_h1
+        m = hdiff.shape[0]
+        # variance of the mean of m i.i.d. terms, multiplied by n
+        var_h1 = float(n)/m*np.var(hdiff, ddof=1)
+        return mean_h1, var_h1
+
+    def bootstrap_null(self, dat, n_bootstrap=1000, seed=1):
+        """
+        Multiplier bootstrap of the mean of the i.i.d. terms. See
+        SC_MMD.bootstrap_null().
+        """
+        Z = dat.data()
+        hdiff = SC_LinearMMD.linear_h_diff(self.datap.data(),
+                self.dataq.data(), Z, self.k)
+        draws = bootstrap.linear_draws([hdiff], Z.shape[0],
+                n_bootstrap=n_bootstrap, seed=seed)
+        return np.mean(hdiff), draws
+
+# end of class SC_LinearMMD
+
+class SC_BlockMMD(SC_MMD):
+    """
+    A block version of SC_MMD in the spirit of the B-test of Zaremba et al.,
+    2013 (NIPS). The data are split into disjoint blocks of B points. In each
+    block, the relative statistic MMD_u^2(Z_b, X_b) - MMD_u^2(Z_b, Y_b) is
+    computed with the quadratic-time U-statistic (as in SC_MMD). The block
+    statistics are i.i.d. The test statistic is their mean, and the variance
+    is estimated by their sample variance. Run time is O(n*B) and memory is
+    O(B^2). The three samples must have the same size. Points left over after
+    forming the blocks are not used.
+    """
+
+    def __init__(self, datap, dataq, k, alpha=0.01, block_size=None):
+        """
+        :param block_size: number of points B in each block. If None, use
+            B = sqrt(n) (rounded down) where n is the sample size of the data
+            given to perform_test().
+        """
+        super(SC_BlockMMD, self).__init__(datap, dataq, k, alpha)
+        if block_size is not None and block_size < 2:
+            raise ValueError('block_size must be at least 2. Was {}'.format(block_size))
+        self.block_size = block_size
+
+    @staticmethod
+    def block_stats(X, Y, Z, k, block_size):
+        """
+        Return an array of MMD_u^2(Z_b, X_b) - MMD_u^2(Z_b, Y_b), one for each
+        block b of block_size consecutive points. The k(Z_b, Z_b) terms
+        cancel and are not evaluated.
+        """
+        n = Z.shape[0]
+        if X.shape[0] != n or Y.shape[0] != n:
+            raise ValueError('X, Y, Z must have the same sample size. Were {}, {}, {}'.format(
+                X.shape[0], Y.shape[0], n))
+        B = block_size
+        n_blocks = n//B
+        if n_blocks < 2:
+            raise ValueError('Need at least 2 blocks. n={}, block_size={}'.format(n, B))
+        stats = np.zeros(n_blocks)
+        for b in range(n_blocks):
+            sl = slice(b*B, (b+1)*B)
+            Xb, Yb, Zb = X[sl], Y[sl], Z[sl]
+            Kxx = k.eval(Xb, Xb)
+            Kyy = k.eval(Yb, Yb)
+            Kxz = k.eval(Xb, Zb)
+            Kyz = k.eval(Yb, Zb)
+            xx = np.sum(Kxx) - np.trace(Kxx)
+            yy = np.sum(Kyy) - np.trace(Kyy)
+            xz = np.sum(Kxz) - np.trace(Kxz)
+            yz = np.sum(Kyz) - np.trace(Kyz)
+            stats[b] = (xx - yy - 2.0*(xz - yz))/(B*(B-1))
+        return stats
+
+    def get_H1_mean_variance(self, dat, return_variance=True):
+        """
+        Return the mean and variance under H1 of the test statistic
+            sqrt(n)*mean_b (MMD_u^2(Z_b, X_b) - MMD_u^2(Z_b, Y_b))
+
+        :returns: (mean, variance)
+        """
+        Z = dat.data()
+        n = Z.shape[0]
+        B = self.block_size
+        if B is None:
+            B = max(2, int(np.sqrt(n)))
+        bstats = SC_BlockMMD.block_stats(self.datap.data(), self.dataq.data(),
+                Z, self.k, B)
+        mean_h1 = np.mean(bstats)
+        if not return_variance:
+            return mean_h1
+        n_blocks = bstats.shape[0]
+        # variance of the mean of n_blocks i.i.d. terms, multiplied by n
+        var_h1 = float(n)/n_blocks*np.var(bstats, ddof=1)
+        return mean_h1, var_h1
+
+    def bootstrap_null(self, dat, n_bootstrap=1000, seed=1):
+        """
+        Multiplier bootstrap of the mean of the i.i.d. block statistics. See
+        SC_MMD.bootstrap_null().
+        """
+        Z = dat.data()
+        n = Z.shape[0]
+        B = self.block_size
+        if B is None:
+            B = max(2, int(np.sqrt(n)))
+        bstats = SC_BlockMMD.block_stats(self.datap.data(), self.dataq.data(),
+                Z, self.k, B)
+        draws = bootstrap.linear_draws([bstats], n, n_bootstrap=n_bootstrap,
+                seed=seed)
+        return np.mean(bstats), draws
+
+# end of class SC_BlockMMD
+
+class SC_RFFMMD(SC_MMD):
+    """
+    An approximation of SC_MMD with the Gaussian kernel KGauss(sigma2), using
+    D random Fourier features (see kmod.approx.GaussRFF). X, Y, Z are mapped
+    to D-dimensional features, and the statistic and its variance are
+    computed from the feature means and covariances (see
+    kmod.approx.rel_mean_variance()). The cost is O(n*D^2) instead of O(n^2),
+    and the sample sizes can differ.
+
+    The feature moments of each sample are cached in the object. So,
+    comparing P and Q against many samples from R, or screening many model
+    pairs with precomputed moments (see kmod.approx), is cheap.
+    """
+
+    def __init__(self, datap, dataq, sigma2, alpha=0.01, rff_dim=500, seed=1):
+        """
+        :param sigma2: squared Gaussian width
+        :param rff_dim: number of random Fourier features D (even)
+        :param seed: random seed for drawing the random features
+        """
+        d = datap.dim()
+        super(SC_RFFMMD, self).__init__(datap, dataq, kernel.KGauss(sigma2),
+                alpha)
+        self.rff = approx.GaussRFF(sigma2, d, D=rff_dim, seed=seed)
+        self.mom_x = self.rff.moments(datap.data())
+        self.mom_y = self.rff.moments(dataq.data())
+
+    def get_H1_mean_variance(self, dat, return_variance=True):
+        """
+        Return the (approximate) mean and variance under H1 of the test
+        statistic sqrt(n)*(MMD^2(P, R) - MMD^2(Q, R)).
+
+        :returns: (mean, variance)
+        """
+        mom_z = self.rff.moments(dat.data())
+        mean_h1, var_h1 = approx.rel_mean_variance(self.mom_x, self.mom_y,
+                mom_z)
+        if not return_variance:
+            return mean_h1
+        return mean_h1, var_h1
+
+    def bootstrap_null(self, dat, n_bootstrap=1000, seed=1):
+        """
+        Multiplier bootstrap of the first-order terms of the approximate
+        statistic, with the influence values given by the random features
+        (see kmod.approx.rel_influence_values()). See
+        SC_MMD.bootstrap_null().
+        """
+        Z = dat.data()
+        mom_z = self.rff.moments(Z)
+        mean_h1, _ = approx.rel_mean_variance(self.mom_x, self.mom_y, mom_z)
+        h = approx.rel_influence_values(self.rff.features, self.datap.data(),
+                self.dataq.data(), Z, self.mom_x, self.mom_y, mom_z)
+        draws = bootstrap.linear_draws(list(h), Z.shape[0],
+                n_bootstrap=n_bootstrap, seed=seed)
+        return mean_h1, draws
+
+# end of class SC_RFFMMD
+
+class SC_NystromMMD(SC_MMD):
+    """
+    An approximation of SC_MMD using Nystrom features (see
+    kmod.approx.NystromFeatures) built on m landmarks selected from the pooled
+    sample (X, Y, Z). Kzz, Kzx, Kzy (and Kxx, Kyy) are thus approximated by
+    low-rank factorizations, and the statistic and its variance are computed
+    from the means and covariances of the m-dimensional features (see
+    kmod.approx.rel_mean_variance()). The cost is O(n*m^2 + n*m*d).
+    Unlike SC_RFFMMD, any kernel can be used, e.g., kmod.kernel.KKID,
+    kmod.kernel.KHoPoly.
+    """
+
+    def __init__(self, datap, dataq, k, alpha=0.01, n_landmarks=500,
+            landmark_method='uniform', seed=1):
+        """
+        :param k: a kernel object
+        :param n_landmarks: number of landmarks m
+        :param landmark_method: 'uniform' or 'kmeans++'. See
+            kmod.approx.NystromFeatures.select_landmarks().
+        :param seed: random seed for selecting the landmarks
+        """
+        super(SC_NystromMMD, self).__init__(datap, dataq, k, alpha)
+        self.n_landmarks = n_landmarks
+        self.landmark_method = landmark_method
+        self.seed = seed
+
+    def get_H1_mean_variance(self, dat, return_variance=True):
+        """
+        Return the (approximate) mean and variance under H1 of the test
+        statistic sqrt(n)*(MMD^2(P, R) - MMD^2(Q, R)).
+
+        :returns: (mean, variance)
+        """
+        X = self.datap.data()
+        Y = self.dataq.data()
+        Z = dat.data()
+        nys = self.nystrom_features(X, Y, Z)
+        mom_x, mom_y, mom_z = [nys.moments(A) for A in [X, Y, Z]]
+        mean_h1, var_h1 = approx.rel_mean_variance(mom_x, mom_y, mom_z)
+        if not return_variance:
+            return mean_h1
+        return mean_h1, var_h1
+
+    def nystrom_features(self, X, Y, Z):
+        """
+        Return the kmod.approx.NystromFeatures with the landmarks selected
+        from the pooled sample (X, Y, Z).
+        """
+        XYZ = np.vstack((X, Y, Z))
+        L = approx.NystromFeatures.select_landmarks(XYZ, self.n_landmarks,
+                method=self.landmark_method, k=self.k, seed=self.seed)
+        return approx.NystromFeatures(self.k, L)
+
+    def bootstrap_null(self, dat, n_bootstrap=1000, seed=1):
+        """
+        Multiplier bootstrap of the first-order terms of the approximate
+        statistic, with the influence values given by the Nystrom features
+        (see kmod.approx.rel_influence_values()). See
+        SC_MMD.bootstrap_null().
+        """
+        X = self.datap.data()
+        Y = self.dataq.data()
+        Z = dat.data()
+        nys = self.nystrom_features(X, Y, Z)
+        mom_x, mom_y, mom_z = [nys.moments(A) for A in [X, Y, Z]]
+        mean_h1, _ = approx.rel_mean_variance(mom_x, mom_y, mom_z)
+        h = approx.rel_influence_values(nys.features, X, Y, Z, mom_x, mom_y,
+                mom_z)
+        draws = bootstrap.linear_draws(list(h), Z.shape[0],
+                n_bootstrap=n_bootstrap, seed=seed)
+        return mean_h1, draws
+
+# end of class SC_NystromMMD
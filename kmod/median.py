@@ -0,0 +1,277 @@
+"""
+Module containing a median heuristic service for choosing Gaussian widths.
+Many methods need the median pairwise distance of several pools of the same
+samples, e.g., of (X, Z), (Y, Z) and (X, Y, Z). Here, the requested
+medians are computed with selection (numpy.partition) instead of sorting,
+and the pools that need no subsampling share the blocks of pairwise
+distances between the samples (each block is computed once). The results are memoized
+(in this process) by a fingerprint of the data and the settings, so that
+computing the same medians again (e.g., for another method in the same
+trial) costs only the fingerprinting.
+"""
+
+__author__ = 'wittawat'
+
+from builtins import object
+from builtins import range
+
+import collections
+import hashlib
+
+import autograd.numpy as np
+from kmod import util
+
+
+def _median(values):
+    """
+    Median of a 1d array with selection instead of a full sort.
+    """
+    m = values.shape[0]
+    if m == 0:
+        raise ValueError('Cannot take the median of an empty array.')
+    k = m//2
+    if m % 2 == 1:
+        return np.partition(values, k)[k]
+    part = np.partition(values, (k-1, k))
+    return 0.5*(part[k-1] + part[k])
+
+
+def _median_or_mean(dist):
+    """
+    Median of the distances. Return the mean if the median is not positive
+    (as in util.meddistance()).
+    """
+    med = _median(dist)
+    if med <= 0:
+        return np.mean(dist)
+    return med
+
+
+def _sq_norms(A):
+    return np.sum(A**2, 1)
+
+
+def _sq_dist_block(A, B, sqa, sqb):
+    D2 = sqa[:, np.newaxis] + sqb[np.newaxis, :] - 2.0*np.dot(A, B.T)
+    return np.maximum(D2, 0)
+
+
+def fingerprint(A):
+    """
+    Return a hashable fingerprint of a numpy array, computed from its shape,
+    dtype and the bytes of its contents.
+    """
+    A = np.ascontiguousarray(A)
+    h = hashlib.sha1(A.view(np.uint8)).hexdigest()
+    return (A.shape, A.dtype.str, h)
+
+
+# memoized results of MedianHeuristic.medians(), shared by all instances
+_memo = collections.OrderedDict()
+# maximum number of memoized results. The least recently used ones are
+# discarded.
+max_memo = 128
+
+def clear():
+    """
+    Discard all the memoized results (e.g., at the end of a trial).
+    """
+    _memo.clear()
+
+
+class MedianHeuristic(object):
+    """
+    A median heuristic service. See the module docstring.
+
+    Two methods are available.
+    - 'exact': take the median over all the pairs of a random subset of the
+      rows. A pool of more than subsample points is subsampled to subsample
+      rows of its stacked samples, drawn exactly as in
+      util.meddistance(np.vstack(...), subsample) with the same seed. So,
+      the median of a pool does not depend on the other pools requested
+      with it. For a cross pair, each of the two samples with more than
+      subsample rows is subsampled in the same way. The pools and cross
+      pairs that need no subsampling share the blocks of distances between
+      the samples.
+    - 'random_pairs': take the median over n_pairs pairs of rows drawn at
+      random (with replacement) from the full samples. The cost is O(n_pairs)
+      distance evaluations, independent of the sample sizes. This is an
+      approximation of the median over all the pairs.
+    """
+
+    def __init__(self, subsample=1000, method='exact', n_pairs=20000,
+            seed=9827):
+        """
+        :param subsample: for method 'exact', the maximum number of points in
+            each pool (or in each sample of a cross pair). None to use all
+            the points.
+        :param method: 'exact' or 'random_pairs'
+        :param n_pairs: for method 'random_pairs', the number of pairs per
+            median
+        :param seed: random seed for the subsampling
+        """
+        if method not in ['exact', 'random_pairs']:
+            raise ValueError('method must be "exact" or "random_pairs". Was {}'.format(method))
+        self.subsample = subsample
+        self.method = method
+        self.n_pairs = n_pairs
+        self.seed = seed
+
+    def medians(self, samples, pools=(), cross=()):
+        """
+        Compute the median pairwise Euclidean distances of pools of samples.
+
+        :param samples: a list of numpy arrays, each n_i x d
+        :param pools: a list of tuples of indices into samples. For a pool
+            (i, j, ...), the median is taken over all the distinct pairs of
+            points of the samples i, j, ... stacked in this order (as in
+            util.meddistance(np.vstack(...), subsample)). The order matters
+            only for the rows drawn by the subsampling.
+        :param cross: a list of pairs (i, j) of indices into samples. The
+            median is taken over the distances between the points of sample
+            i and the points of sample j (as in the median of
+            util.dist_matrix(samples[i], samples[j])).
+
+        :returns: (a list of the medians of the pools, a list of the medians
+            of the cross pairs)
+        """
+        pools = [tuple(p) for p in pools]
+        cross = [tuple(c) for c in cross]
+        for c in cross:
+            if len(c) != 2:
+                raise ValueError('Each element of cross must be a pair. Was {}'.format(c))
+        key = (tuple(fingerprint(A) for A in samples), tuple(pools),
+                tuple(cross), self.method, self.subsample, self.n_pairs,
+                self.seed)
+        if key in _memo:
+            _memo.move_to_end(key)
+            return _memo[key]
+
+        if self.method == 'exact':
+            result = self._exact_medians(samples, pools, cross)
+        else:
+            result = self._random_pairs_medians(samples, pools, cross)
+
+        _memo[key] = result
+        while len(_memo) > max_memo:
+            _memo.popitem(last=False)
+        return result
+
+    def meddistance(self, *samples):
+        """
+        Median pairwise distance of the points of the stacked samples. Same as
+        util.meddistance(np.vstack(samples)) up to the subsampling.
+        """
+        meds, _ = self.medians(samples, pools=[tuple(range(len(samples)))])
+        return meds[0]
+
+    def _exact_medians(self, samples, pools, cross):
+        m = self.subsample
+        sq_norms = {}
+        # blocks (i, j), i <= j, of squared distances between all the rows of
+        # samples i and j. Shared by the pools and cross pairs that are not
+        # subsampled.
+        blocks = {}
+
+        def full_block(i, j):
+            if (i, j) not in blocks:
+                for t in (i, j):
+                    if t not in sq_norms:
+                        sq_norms[t] = _sq_norms(samples[t])
+                blocks[(i, j)] = _sq_dist_block(samples[i], samples[j],
+                        sq_norms[i], sq_norms[j])
+            return blocks[(i, j)]
+
+        def subsample_rows(A):
+            # same rows as util.meddistance(A, subsample)
+            with util.NumpySeedContext(seed=self.seed):
+                ind = np.random.choice(A.shape[0], m, replace=False)
+            return A[ind, :]
+
+        pool_meds = []
+        for p in pools:
+            # distinct sample indices in the given order. Repeating a sample
+            # is not meaningful.
+            p = [i for t, i in enumerate(p) if i not in p[:t]]
+            N = sum(samples[i].shape[0] for i in p)
+            if m is None or N <= m:
+                parts = []
+                for a in range(len(p)):
+                    for b in range(a, len(p)):
+                        i, j = min(p[a], p[b]), max(p[a], p[b])
+                        D2 = full_block(i, j)
+                        if i == j:
+                            D2 = D2[np.triu_indices(D2.shape[0], 1)]
+                        parts.append(D2.reshape(-1))
+                D2 = np.hstack(parts)
+            else:
+                A = subsample_rows(np.vstack([samples[i] for i in p]))
+                sqa = _sq_norms(A)
+                D2 = _sq_dist_block(A, A, sqa, sqa)
+                D2 = D2[np.triu_indices(D2.shape[0], 1)]
+            pool_meds.append(_median_or_mean(np.sqrt(D2)))
+
+        cross_meds = []
+        for (i, j) in cross:
+            A, B = samples[i], samples[j]
+            if m is None or (A.shape[0] <= m and B.shape[0] <= m):
+                D2 = full_block(min(i, j), max(i, j))
+            else:
+                if A.shape[0] > m:
+                    A = subsample_rows(A)
+                if B.shape[0] > m:
+                    B = subsample_rows(B)
+                D2 = _sq_dist_block(A, B, _sq_norms(A), _sq_norms(B))
+            cross_meds.append(_median_or_mean(np.sqrt(D2.reshape(-1))))
+        return pool_meds, cross_meds
+
+    def _random_pairs_medians(self, samples, pools, cross):
+        def dist_pairs(A, ia, B, ib):
+            return np.sqrt(np.sum((A[ia, :] - B[ib, :])**2, 1))
+
+        m = self.n_pairs
+        pool_meds = []
+        cross_meds = []
+        with util.NumpySeedContext(seed=self.seed):
+            for p in pools:
+                p = sorted(set(p))
+                sizes = np.array([samples[i].shape[0] for i in p])
+                offsets = np.hstack((0, np.cumsum(sizes)))
+                N = offsets[-1]
+                # distinct pairs of the pooled points
+                g1 = np.random.randint(0, N, size=m)
+                g2 = (g1 + np.random.randint(1, N, size=m)) % N
+                # map the global indices to (sample, row)
+                s1 = np.searchsorted(offsets, g1, side='right') - 1
+                s2 = np.searchsorted(offsets, g2, side='right') - 1
+                dist = np.zeros(m)
+                for a in range(len(p)):
+                    for b in range(len(p)):
+                        sel = (s1 == a) & (s2 == b)
+                        if np.any(sel):
+                            dist[sel] = dist_pairs(samples[p[a]],
+                                    g1[sel] - offsets[a], samples[p[b]],
+                                    g2[sel] - offsets[b])
+                pool_meds.append(_median_or_mean(dist))
+            for (i, j) in cross:
+                A, B = samples[i], samples[j]
+                ia = np.random.randint(0, A.shape[0], size=m)
+                ib = np.random.randint(0, B.shape[0], size=m)
+                cross_meds.append(_median_or_mean(dist_pairs(A, ia, B, ib)))
+        return pool_meds, cross_meds
+
+# end of class MedianHeuristic
+
+
+def medians(samples, pools=(), cross=()):
+    """
+    MedianHeuristic.medians() with the default settings (method 'exact', at
+    most about 1000 points per pool).
+    """
+    return MedianHeuristic().medians(samples, pools=pools, cross=cross)
+
+def meddistance(*samples):
+    """
+    MedianHeuristic.meddistance() with the default settings.
+    """
+    return MedianHeuristic().meddistance(*samples)
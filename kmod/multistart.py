@@ -0,0 +1,246 @@
+"""
+Module containing a multi-start driver for the (non-convex) optimization of
+the test locations and the Gaussian width of the UME three-sample test
+(kmod.mctest.SC_GaussUME.optimize_3sample_criterion()). The starts run on a
+process pool. The read-only data are placed in shared memory once and are not
+copied to each worker.
+"""
+
+__author__ = 'wittawat'
+
+from builtins import object
+from builtins import range
+
+import concurrent.futures
+import multiprocessing
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
+import os
+
+import autograd.numpy as np
+from kmod import data, kernel, median, util
+import kmod.mctest as mct
+
+
+def init_locs(X, Y, Z, J, method='random', gwidth=None, seed=1,
+        n_candidates=2000):
+    """
+    Return a J x d numpy array of initial test locations.
+
+    :param method:
+        - 'random': J rows drawn at random from the pooled sample (X, Y, Z).
+        - 'kmeans++': J rows of the pooled sample chosen by the k-means++
+          seeding (D^2 sampling) on a random subset of n_candidates rows.
+        - 'witness': the J rows (among n_candidates random rows of the pooled
+          sample) with the highest J=1 power criterion (see
+          kmod.mctest.SC_UME.single_loc_power_criteria()). Requires gwidth.
+    :param gwidth: squared Gaussian width. Used only for 'witness'.
+    :param seed: random seed
+    """
+    XYZ = np.vstack((X, Y, Z))
+    if method == 'random':
+        return util.subsample_rows(XYZ, J, seed=seed)
+    C = util.subsample_rows(XYZ, min(n_candidates, XYZ.shape[0]), seed=seed)
+    if method == 'kmeans++':
+        with util.NumpySeedContext(seed=seed+1):
+            ind = [np.random.randint(C.shape[0])]
+            dist2 = np.sum((C - C[ind[0]])**2, 1)
+            for _ in range(1, J):
+                i = np.random.choice(C.shape[0], p=dist2/np.sum(dist2))
+                ind.append(i)
+                dist2 = np.minimum(dist2, np.sum((C - C[i])**2, 1))
+        return C[ind, :]
+    elif method == 'witness':
+        if gwidth is None:
+            raise ValueError('gwidth must be specified for method witness.')
+        k = kernel.KGauss(gwidth)
+        values = mct.SC_UME.single_loc_power_criteria(data.Data(X),
+                data.Data(Y), data.Data(Z), k, k, C)
+        return C[np.argsort(-values)[:J], :]
+    else:
+        raise ValueError('Unknown initialization method: {}'.format(method))
+
+
+class SharedArrays(object):
+    """
+    A set of named numpy arrays copied into multiprocessing shared memory.
+    Pass spec() to other processes, and call attach(spec) there to get the
+    arrays without copying. The creator must call close() (which also unlinks
+    the shared memory) when done.
+    """
+
+    def __init__(self, arrays):
+        """
+        :param arrays: a dictionary of name |-> numpy array
+        """
+        self.shms = []
+        self._spec = {}
+        for name, A in arrays.items():
+            A = np.asarray(A, dtype=float)
+            shm = multiprocessing.shared_memory.SharedMemory(create=True,
+                    size=max(A.nbytes, 1))
+            view = np.ndarray(A.shape, dtype=A.dtype, buffer=shm.buf)
+            view[:] = A
+            self.shms.append(shm)
+            self._spec[name] = (shm.name, A.shape, A.dtype.str)
+
+    def spec(self):
+        return self._spec
+
+    @staticmethod
+    def attach(spec):
+        """
+        Return (a dictionary of name |-> numpy array, list of the attached
+        SharedMemory objects). The SharedMemory objects must be kept alive as
+        long as the arrays are used.
+        """
+        arrays = {}
+        shms = []
+        for name, (shm_name, shape, dtype) in spec.items():
+            shm = multiprocessing.shared_memory.SharedMemory(name=shm_name)
+            # Only the creator should unlink the memory. Stop the resource
+            # tracker from unlinking it when this process exits. The tracker
+            # is used only on POSIX, where it registers the name with a
+            # leading '/' (which SharedMemory.name strips).
+            if os.name == 'posix':
+                multiprocessing.resource_tracker.unregister(
+                        '/' + shm_name.lstrip('/'), 'shared_memory')
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            shms.append(shm)
+        return arrays, shms
+
+    def close(self):
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms = []
+
+# end of class SharedArrays
+
+
+# Per-process state of the workers. Set by _init_worker().
+_worker_data = {}
+
+def _init_worker(spec):
+    arrays, shms = SharedArrays.attach(spec)
+    _worker_data['arrays'] = arrays
+    _worker_data['shms'] = shms
+
+
+def _run_start(V0, gwidth0, opt_kwargs):
+    arrays = _worker_data['arrays']
+    return _optimize_one(arrays['X'], arrays['Y'], arrays['Z'], V0, gwidth0,
+            opt_kwargs)
+
+
+def _optimize_one(X, Y, Z, V0, gwidth0, opt_kwargs):
+    datap, dataq, datar = data.Data(X), data.Data(Y), data.Data(Z)
+    with util.ContextTimer() as t:
+        V, gwidth, info = mct.SC_GaussUME.optimize_3sample_criterion(datap,
+                dataq, datar, V0, gwidth0, **opt_kwargs)
+    # objects such as the inverse Hessian operator are not needed
+    info.pop('hess_inv', None)
+    info['wall_secs'] = t.secs
+    return V, gwidth, info
+
+
+def optimize_3sample_criterion(datap, dataq, datar, J, gwidth0=None,
+        n_starts=8, init_methods=('random', 'kmeans++', 'witness'),
+        n_workers=None, seed=1, **opt_kwargs):
+    """
+    Run SC_GaussUME.optimize_3sample_criterion() from n_starts
+    initializations, and return the best solution (the highest power
+    criterion on the given data). The initialization methods (see
+    init_locs()) are cycled through init_methods, each start with a
+    different seed. The starts run on a pool of n_workers processes. Each
+    worker uses one BLAS thread so that the workers do not compete for the
+    cores.
+
+    :param J: number of test locations
+    :param gwidth0: initial squared Gaussian width. If None, use the squared
+        median distance of the pooled sample.
+    :param n_workers: number of worker processes. None to use
+        min(n_starts, number of CPUs). 1 to run the starts sequentially in
+        this process.
+    :param seed: random seed for the initializations
+    :param opt_kwargs: keyword arguments for
+        SC_GaussUME.optimize_3sample_criterion()
+
+    :returns: (V, gwidth, info) where info contains
+        - 'starts': a list of per-start dictionaries with keys 'init_method',
+          'seed', 'V0', 'init_criterion', 'criterion', 'gwidth', 'nit',
+          'wall_secs'
+        - 'best_index': the index of the best start
+        - 'opt_result': the optimization info of the best start
+        - 'time_secs': the total wall-clock time
+    """
+    X, Y, Z = datap.data(), dataq.data(), datar.data()
+    with util.ContextTimer() as timer:
+        if gwidth0 is None:
+            gwidth0 = median.meddistance(X, Y, Z)**2
+        reg = opt_kwargs.get('reg', 1e-3)
+        k0 = kernel.KGauss(gwidth0)
+
+        starts = []
+        for i in range(n_starts):
+            method = init_methods[i % len(init_methods)]
+            seed_i = seed + 31*i
+            V0 = init_locs(X, Y, Z, J, method=method, gwidth=gwidth0,
+                    seed=seed_i)
+            init_cri = mct.SC_UME.power_criterion(datap, dataq, datar, k0, k0,
+                    V0, V0, reg=reg, backend='numpy')
+            starts.append({'init_method': method, 'seed': seed_i, 'V0': V0,
+                'init_criterion': init_cri})
+
+        if n_workers is None:
+            n_workers = min(n_starts, os.cpu_count() or 1)
+        if n_workers <= 1:
+            results = [_optimize_one(X, Y, Z, st['V0'], gwidth0, opt_kwargs)
+                    for st in starts]
+        else:
+            results = _run_pool(X, Y, Z, starts, gwidth0, opt_kwargs,
+                    n_workers)
+
+        for st, (V, gwidth, info) in zip(starts, results):
+            st['V'] = V
+            st['gwidth'] = gwidth
+            # Recompute on the full data. With the minibatch mode, info['fun']
+            # is only evaluated on a subset.
+            k = kernel.KGauss(gwidth)
+            st['criterion'] = mct.SC_UME.power_criterion(datap, dataq, datar,
+                    k, k, V, V, reg=reg, backend='numpy')
+            st['nit'] = info.get('nit')
+            st['wall_secs'] = info['wall_secs']
+            st['opt_result'] = info
+        best = int(np.argmax([st['criterion'] for st in starts]))
+    best_start = starts[best]
+    info = {'starts': starts, 'best_index': best,
+            'opt_result': best_start['opt_result'], 'time_secs': timer.secs}
+    return best_start['V'], best_start['gwidth'], info
+
+
+_BLAS_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+def _run_pool(X, Y, Z, starts, gwidth0, opt_kwargs, n_workers):
+    shared = SharedArrays({'X': X, 'Y': Y, 'Z': Z})
+    # The spawned workers inherit the environment at start-up. Limit each to
+    # one BLAS thread.
+    old_env = {v: os.environ.get(v) for v in _BLAS_ENV_VARS}
+    try:
+        for v in _BLAS_ENV_VARS:
+            os.environ[v] = '1'
+        ctx = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                mp_context=ctx, initializer=_init_worker,
+                initargs=(shared.spec(), )) as pool:
+            futures = [pool.submit(_run_start, st['V0'], gwidth0, opt_kwargs)
+                    for st in starts]
+            results = [f.result() for f in futures]
+    finally:
+        for v, val in old_env.items():
+            if val is None:
+                os.environ.pop(v, None)
+            else:
+                os.environ[v] = val
+        shared.close()
+    return results
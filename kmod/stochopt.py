@@ -0,0 +1,91 @@
+"""
+Module containing a minibatch stochastic optimizer for the kernel parameters
+(test locations and Gaussian width) of the tests in kmod.mctest. The cost of
+each iteration depends on the minibatch size, not on the sample size n.
+"""
+
+__author__ = 'wittawat'
+
+from builtins import range
+
+import autograd.numpy as np
+from kmod import util, log
+
+
+def minibatch_adam(obj_grad, x0, n, batch_size, bounds=None, n_iters=500,
+        step_size=0.05, lr_decay=1e-2, beta1=0.9, beta2=0.999, eps=1e-8,
+        eval_every=20, eval_size=None, patience=5, tol=1e-6, seed=1):
+    """
+    Minimize an objective defined on a sample of size n with Adam (Kingma &
+    Ba, 2015) using minibatch estimates of the objective and its gradient.
+
+    - The learning rate at iteration t is step_size/(1 + lr_decay*t).
+    - Every eval_every iterations, the objective is evaluated on a fixed
+      random subset of eval_size points. The best point so far (on this
+      subset) is kept. Stop early if the objective does not decrease by more
+      than tol in patience consecutive evaluations.
+    - After each step, x is clipped to the box bounds.
+
+    :param obj_grad: a function (x, ind) |-> (objective, gradient) evaluated
+        on the points indexed by the integer array ind
+    :param x0: initial point (1d numpy array)
+    :param n: sample size. Indices are drawn from range(n).
+    :param batch_size: minibatch size
+    :param bounds: None or a list of (lower, upper) bounds as in
+        scipy.optimize.minimize
+    :param n_iters: maximum number of iterations
+    :param eval_size: size of the evaluation subset. If None, use
+        min(n, 4*batch_size).
+    :param seed: random seed for drawing the minibatches
+
+    :returns: (best x, info dictionary)
+    """
+    if batch_size <= 0:
+        raise ValueError('batch_size must be positive. Was {}'.format(batch_size))
+    if eval_size is None:
+        eval_size = min(n, 4*batch_size)
+    x = np.array(x0, dtype=float)
+    if bounds is not None:
+        lb = np.array([b[0] for b in bounds], dtype=float)
+        ub = np.array([b[1] for b in bounds], dtype=float)
+
+    m = np.zeros(x.shape[0])
+    v = np.zeros(x.shape[0])
+    with util.NumpySeedContext(seed=seed):
+        ind_eval = util.subsample_ind(n, eval_size, seed=seed+1)
+        best_f, _ = obj_grad(x, ind_eval)
+        best_x = x
+        n_no_improve = 0
+        stopped_early = False
+        t = 0
+        for t in range(1, n_iters+1):
+            # Sample with replacement. This does not cost O(n).
+            ind = np.random.randint(0, n, size=batch_size)
+            _, g = obj_grad(x, ind)
+            if not np.all(np.isfinite(g)):
+                log.l().warning('Non-finite gradient at iteration {}. Stop.'.format(t))
+                break
+            m = beta1*m + (1.0 - beta1)*g
+            v = beta2*v + (1.0 - beta2)*g**2
+            m_hat = m/(1.0 - beta1**t)
+            v_hat = v/(1.0 - beta2**t)
+            lr = step_size/(1.0 + lr_decay*t)
+            x = x - lr*m_hat/(np.sqrt(v_hat) + eps)
+            if bounds is not None:
+                x = np.minimum(np.maximum(x, lb), ub)
+
+            if t % eval_every == 0:
+                f, _ = obj_grad(x, ind_eval)
+                if f < best_f - tol:
+                    best_f = f
+                    best_x = x
+                    n_no_improve = 0
+                else:
+                    n_no_improve += 1
+                    if n_no_improve >= patience:
+                        stopped_early = True
+                        break
+
+    info = {'x': best_x, 'fun': best_f, 'nit': t,
+            'stopped_early': stopped_early, 'batch_size': batch_size, }
+    return best_x, info
@@ -0,0 +1,173 @@
+"""
+Module containing accumulators of sufficient statistics for computing the
+statistics of the tests in kmod.mctest from row blocks of the data. With
+these, the data never need to be held in memory at once.
+"""
+
+__author__ = 'wittawat'
+
+from builtins import object
+
+import autograd.numpy as np
+
+
+class UMEStats(object):
+    """
+    Sufficient statistics of the two (correlated) UME feature matrices
+    fea_pr (n x Jp) and fea_qr (n x Jq) used in SC_UME. The state consists of
+    the number of rows n, the column sums of both feature matrices, and the
+    second-moment matrices fea_pr'fea_pr, fea_qr'fea_qr, fea_pr'fea_qr.
+    The memory requirement is O((Jp+Jq)^2), independent of n.
+    """
+
+    def __init__(self, Jp, Jq):
+        """
+        :param Jp: number of test locations in UME(P, R)
+        :param Jq: number of test locations in UME(Q, R)
+        """
+        self.n = 0
+        # column sums
+        self.sum_p = np.zeros(Jp)
+        self.sum_q = np.zeros(Jq)
+        # second-moment (uncentered) matrices
+        self.M_pp = np.zeros((Jp, Jp))
+        self.M_qq = np.zeros((Jq, Jq))
+        self.M_pq = np.zeros((Jp, Jq))
+
+    def update(self, fea_pr, fea_qr):
+        """
+        Add a row block of the two feature matrices to the statistics.
+
+        :param fea_pr: b x Jp block of the feature matrix of UME(P, R)
+        :param fea_qr: b x Jq block of the feature matrix of UME(Q, R). Row i
+            must correspond to the same point of R as row i of fea_pr.
+        """
+        if fea_pr.shape[0] != fea_qr.shape[0]:
+            raise ValueError('The two feature blocks must have the same number of rows. Were {} and {}'.format(
+                fea_pr.shape[0], fea_qr.shape[0]))
+        self.n += fea_pr.shape[0]
+        self.sum_p = self.sum_p + np.sum(fea_pr, axis=0)
+        self.sum_q = self.sum_q + np.sum(fea_qr, axis=0)
+        self.M_pp = self.M_pp + np.dot(fea_pr.T, fea_pr)
+        self.M_qq = self.M_qq + np.dot(fea_qr.T, fea_qr)
+        self.M_pq = self.M_pq + np.dot(fea_pr.T, fea_qr)
+        return self
+
+    def merge(self, other):
+        """
+        Add the statistics of another UMEStats (e.g., computed on a different
+        shard of the data by another process) to this one in place. The two
+        must be computed with the same test locations and kernels.
+
+        Return self.
+        """
+        if self.M_pq.shape != other.M_pq.shape:
+            raise ValueError('Cannot merge UMEStats of (Jp, Jq) = {} and {}'.format(
+                self.M_pq.shape, other.M_pq.shape))
+        self.n += other.n
+        self.sum_p = self.sum_p + other.sum_p
+        self.sum_q = self.sum_q + other.sum_q
+        self.M_pp = self.M_pp + other.M_pp
+        self.M_qq = self.M_qq + other.M_qq
+        self.M_pq = self.M_pq + other.M_pq
+        return self
+
+    def __add__(self, other):
+        merged = UMEStats(*self.M_pq.shape)
+        merged.merge(self)
+        merged.merge(other)
+        return merged
+
+    @staticmethod
+    def merge_all(list_stats):
+        """
+        Merge a list of UMEStats into a new UMEStats. The inputs are not
+        modified.
+        """
+        if len(list_stats) == 0:
+            raise ValueError('list_stats cannot be empty.')
+        merged = UMEStats(*list_stats[0].M_pq.shape)
+        for st in list_stats:
+            merged.merge(st)
+        return merged
+
+    def to_dict(self):
+        """
+        Return a dictionary of numpy arrays representing the statistics. The
+        dictionary can be sent to another process or host, and converted back
+        with from_dict().
+        """
+        return {'n': np.array(self.n), 'sum_p': self.sum_p,
+                'sum_q': self.sum_q, 'M_pp': self.M_pp, 'M_qq': self.M_qq,
+                'M_pq': self.M_pq, }
+
+    @staticmethod
+    def from_dict(d):
+        """Inverse of to_dict()."""
+        Jp, Jq = d['M_pq'].shape
+        ume_stats = UMEStats(Jp, Jq)
+        ume_stats.n = int(d['n'])
+        for key in ['sum_p', 'sum_q', 'M_pp', 'M_qq', 'M_pq']:
+            setattr(ume_stats, key, np.array(d[key], dtype=float))
+        return ume_stats
+
+    def save(self, file_path):
+        """Save the statistics to a .npz file."""
+        np.savez(file_path, **self.to_dict())
+
+    @staticmethod
+    def load(file_path):
+        """Load the statistics saved with save()."""
+        with np.load(file_path) as npz:
+            return UMEStats.from_dict(npz)
+
+    @staticmethod
+    def _ustat_h1_mean_variance(n, s, M, return_variance=True):
+        """
+        Same as freqopttest.tst.UMETest.ustat_h1_mean_variance(...,
+        use_unbiased=True) but computed from the sufficient statistics
+        (n, column sums s, second moment M) of the feature matrix.
+        """
+        mu = s/float(n)
+        t1 = np.sum(mu**2)*(n/float(n-1))
+        t2 = np.trace(M)/float(n)/float(n-1)
+        mean_h1 = t1 - t2
+        if not return_variance:
+            return mean_h1
+        variance = 4.0*np.dot(mu, np.dot(M, mu))/n - 4.0*np.sum(mu**2)**2
+        return mean_h1, variance
+
+    def h1_mean_variance(self, return_variance=True):
+        """
+        Return (mean, variance, var_pr, var_qr, var_pqr) computed exactly as
+        in SC_UME.get_H1_mean_variance(). The mean is the unbiased estimate
+        of UME^2(P, R) - UME^2(Q, R). The variance is that of the test
+        statistic divided by sqrt(n), i.e., var_pr - 2*var_pqr + var_qr.
+
+        If return_variance is False, return only the mean.
+        """
+        n = self.n
+        if n <= 1:
+            raise ValueError('Need at least 2 points. Accumulated {}'.format(n))
+        if not return_variance:
+            umehp = UMEStats._ustat_h1_mean_variance(n, self.sum_p,
+                    self.M_pp, return_variance=False)
+            umehq = UMEStats._ustat_h1_mean_variance(n, self.sum_q,
+                    self.M_qq, return_variance=False)
+            return umehp - umehq
+
+        umehp, var_pr = UMEStats._ustat_h1_mean_variance(n, self.sum_p,
+                self.M_pp, return_variance=True)
+        umehq, var_qr = UMEStats._ustat_h1_mean_variance(n, self.sum_q,
+                self.M_qq, return_variance=True)
+        mean_h1 = umehp - umehq
+
+        mean_pr = self.sum_p/float(n)
+        mean_qr = self.sum_q/float(n)
+        t1 = 4.0*np.dot(mean_pr, np.dot(self.M_pq, mean_qr))/n
+        t2 = 4.0*np.sum(mean_pr**2)*np.sum(mean_qr**2)
+        var_pqr = t1 - t2
+        var_h1 = var_pr - 2.0*var_pqr + var_qr
+        return mean_h1, var_h1, var_pr, var_qr, var_pqr
+
+# end of class UMEStats
@@ -0,0 +1,257 @@
+"""
+Module containing Gaussian width sweeps of the relative tests in kmod.mctest
+(SC_MMD, SC_UME, DC_FSSD with Gaussian kernels). The squared distances (between
+the samples, or between the samples and the test locations) are computed only
+once. The statistics, variances and p-values for all the widths are then
+obtained by exponentiating the same distances. A sweep can be used for
+bandwidth sensitivity reports, or for a test aggregated over all the widths
+(see aggregate_test()).
+"""
+
+__author__ = 'wittawat'
+
+from builtins import range
+
+import autograd.numpy as np
+from kmod import bootstrap, gram, log, stream, util
+import kmod.mctest as mct
+
+
+def _sweep_results(n, means, variances, alpha, gwidths, draws, pvalue):
+    """
+    Return the results dictionary of a sweep given the means and variances
+    (not yet scaled by sqrt(n)) under H1 of all the widths.
+
+    :param pvalue: the function (stat, var) |-> asymptotic p-value of the
+        test in kmod.mctest (e.g., SC_MMD._asymptotic_pvalue), so that an
+        invalid variance is treated as in perform_test() of the test
+    """
+    means = np.array(means)
+    variances = np.array(variances, dtype=float)
+    test_stats = (n**0.5)*means
+    pvalues = np.array([pvalue(stat, var) for stat, var in zip(test_stats,
+        variances)], dtype=float)
+    # Widths whose null distribution is degenerate (SD <= 1e-6, as in
+    # SC_UME) or invalid cannot be standardized.
+    valid = np.isfinite(variances) & (variances > 1e-12)
+    for gw, v in zip(gwidths, valid):
+        if not v:
+            log.l().warning('Invalid H0 variance at gwidth {}. Excluded from aggregate_test().'.format(gw))
+    return {'alpha': alpha, 'gwidths': np.array(gwidths), 'test_stats':
+            test_stats, 'variances': variances, 'pvalues': pvalues,
+            'h0_rejected': pvalues < alpha, 'valid': valid, 'draws': draws,
+            'n': n}
+
+
+def mmd_sweep(datap, dataq, datar, gwidths, alpha=0.01, n_bootstrap=None,
+        seed=1, tile_size=512):
+    """
+    SC_MMD(datap, dataq, kernel.KGauss(gw), alpha).perform_test(datar) for
+    each squared Gaussian width gw in gwidths. The five n x n matrices of
+    squared distances are computed once. X, Y, Z must have the same sample
+    size n. Memory usage is O(n^2).
+
+    :param gwidths: a list or array of squared Gaussian widths
+    :param n_bootstrap: if not None, also draw this many bootstrap samples of
+        the null distribution of the statistic of each width (as in
+        SC_MMD.bootstrap_null()). The same bootstrap weights are used for all
+        the widths so that the draws of different widths are jointly
+        distributed as the statistics. Needed for aggregate_test(..,
+        method='max').
+    :param seed: random seed for the bootstrap
+    :param tile_size: tile size for summing the Gram matrices (see
+        kmod.gram.RelMMDGramStats.compute())
+
+    :returns: a dictionary with keys
+        - alpha, gwidths, n
+        - test_stats: array of the test statistics of the widths
+        - variances: array of the variances of the null distributions
+        - pvalues: array of the p-values (asymptotic normal null). An
+          invalid variance gives the same p-value as
+          SC_MMD.perform_test().
+        - h0_rejected: boolean array (pvalues < alpha)
+        - valid: boolean array. False for the widths whose variance is not
+          a real number, or too small (SD <= 1e-6).
+        - draws: len(gwidths) x n_bootstrap array, or None
+        - time_secs
+    """
+    X, Y, Z = datap.data(), dataq.data(), datar.data()
+    n = Z.shape[0]
+    if X.shape[0] != n or Y.shape[0] != n:
+        raise ValueError('X, Y, Z must have the same sample size. Were {}, {}, {}'.format(
+            X.shape[0], Y.shape[0], n))
+    with util.ContextTimer() as t:
+        sq = {'x': np.sum(X**2, 1), 'y': np.sum(Y**2, 1), 'z': np.sum(Z**2, 1)}
+        samples = {'x': X, 'y': Y, 'z': Z}
+        D2 = {}
+        for name in ['xx', 'yy', 'zz', 'xz', 'yz']:
+            A, B = samples[name[0]], samples[name[1]]
+            D2[name] = np.maximum(sq[name[0]][:, np.newaxis] - 2.0*np.dot(A, B.T)
+                    + sq[name[1]][np.newaxis, :], 0)
+
+        # Gram matrices of the current width. Reused across the widths.
+        cache = {name: np.empty((n, n)) for name in D2}
+        means = []
+        variances = []
+        draws = [] if n_bootstrap is not None else None
+        for gw in gwidths:
+            for name, D in D2.items():
+                np.multiply(D, -1.0/(2.0*gw), out=cache[name])
+                np.exp(cache[name], out=cache[name])
+            # All the Gram matrices are in the cache. No kernel is evaluated.
+            gs = gram.RelMMDGramStats.compute(X, Y, Z, None,
+                    tile_size=tile_size, n_threads=1, cache=cache)
+            mean_h1, var = mct.SC_MMD._gram_stats_H1_mean_variance(gs)
+            means.append(mean_h1)
+            variances.append(var)
+            if draws is not None:
+                h = mct.SC_MMD._influence_values(gs.rs_xx, gs.rs_yy, gs.rs_xz,
+                        gs.rs_yz, gs.cs_xz, gs.cs_yz)
+                draws.append(bootstrap.linear_draws(list(h), n,
+                    n_bootstrap=n_bootstrap, seed=seed))
+        if draws is not None:
+            draws = np.vstack(draws)
+        results = _sweep_results(n, means, variances, alpha, gwidths, draws,
+                mct.SC_MMD._asymptotic_pvalue)
+    results['time_secs'] = t.secs
+    return results
+
+
+def ume_sweep(datap, dataq, datar, V, gwidths, alpha=0.01, n_bootstrap=None,
+        seed=1):
+    """
+    SC_UME(datap, dataq, k, k, V, V, alpha).perform_test(datar) with
+    k = kernel.KGauss(gw) for each squared Gaussian width gw in gwidths. The
+    squared distances between X, Y, Z and the J test locations V are
+    computed once, and exponentiated for all the widths together. See
+    mmd_sweep() for the other arguments and the returned dictionary. The
+    bootstrap is as in SC_UME.bootstrap_null().
+    """
+    X, Y, Z = datap.data(), dataq.data(), datar.data()
+    n = Z.shape[0]
+    J = V.shape[0]
+    gwidths = np.array(gwidths, dtype=float)
+    with util.ContextTimer() as t:
+        sq_v = np.sum(V**2, 1)
+        def dist2(A):
+            return np.maximum(np.sum(A**2, 1)[:, np.newaxis] - 2.0*np.dot(A, V.T)
+                    + sq_v, 0)
+        # G x n x J for G widths
+        scales = 1.0/(2.0*gwidths[:, np.newaxis, np.newaxis])
+        Kxv = np.exp(-dist2(X)[np.newaxis, :, :]*scales)
+        Kyv = np.exp(-dist2(Y)[np.newaxis, :, :]*scales)
+        Kzv = np.exp(-dist2(Z)[np.newaxis, :, :]*scales)
+
+        means = []
+        variances = []
+        draws = [] if n_bootstrap is not None else None
+        for i in range(len(gwidths)):
+            # same as SC_UME.feature_matrices() with shared locations
+            fea_pr = (Kxv[i] - Kzv[i])/np.sqrt(J)
+            fea_qr = (Kyv[i] - Kzv[i])/np.sqrt(J)
+            ume_stats = stream.UMEStats(J, J).update(fea_pr, fea_qr)
+            mean_h1, var = ume_stats.h1_mean_variance()[:2]
+            means.append(mean_h1)
+            variances.append(var)
+            if draws is not None:
+                draws.append(bootstrap.ustat_diff_draws(fea_pr, fea_qr,
+                    n_bootstrap=n_bootstrap, seed=seed))
+        if draws is not None:
+            draws = np.vstack(draws)
+        results = _sweep_results(n, means, variances, alpha, gwidths, draws,
+                mct.SC_UME._asymptotic_pvalue)
+    results['time_secs'] = t.secs
+    return results
+
+
+def fssd_sweep(p, q, datar, V, gwidths, alpha=0.01, n_bootstrap=None,
+        seed=1):
+    """
+    DC_GaussFSSD(p, q, gw, gw, V, V, alpha).perform_test(datar) for each
+    squared Gaussian width gw in gwidths. The score functions of p, q, the
+    squared distances and the differences between Z and the test locations V
+    are computed once (see DC_GaussFSSD.stein_feature_tensor()). See
+    mmd_sweep() for the other arguments and the returned dictionary. The
+    bootstrap is as in DC_FSSD.bootstrap_null().
+    """
+    Z = datar.data()
+    n, d = Z.shape
+    J = V.shape[0]
+    with util.ContextTimer() as t:
+        grad_logp = p.grad_log(Z)
+        grad_logq = q.grad_log(Z)
+        D2 = np.maximum(np.sum(Z**2, 1)[:, np.newaxis] - 2.0*np.dot(Z, V.T)
+                + np.sum(V**2, 1), 0)
+        Diff = Z[:, :, np.newaxis] - np.transpose(V)[np.newaxis, :, :]
+
+        means = []
+        variances = []
+        draws = [] if n_bootstrap is not None else None
+        for gw in gwidths:
+            Xip = mct.DC_GaussFSSD.stein_feature_tensor(Z, grad_logp, V, gw,
+                    D2=D2, Diff=Diff, backend='numpy')
+            Xiq = mct.DC_GaussFSSD.stein_feature_tensor(Z, grad_logq, V, gw,
+                    D2=D2, Diff=Diff, backend='numpy')
+            mean_h1, var = mct.DC_FSSD._H1_mean_variance_tensors(Xip, Xiq,
+                    backend='numpy')
+            means.append(mean_h1)
+            variances.append(var)
+            if draws is not None:
+                draws.append(bootstrap.ustat_diff_draws(np.reshape(Xip,
+                    [n, -1]), np.reshape(Xiq, [n, -1]),
+                    n_bootstrap=n_bootstrap, seed=seed))
+        if draws is not None:
+            draws = np.vstack(draws)
+        results = _sweep_results(n, means, variances, alpha, gwidths, draws,
+                mct.DC_FSSD._asymptotic_pvalue)
+    results['time_secs'] = t.secs
+    return results
+
+
+def aggregate_test(sweep_results, alpha=None, method='max'):
+    """
+    A test aggregated over all the widths of a sweep. H0 is rejected if the
+    aggregated p-value is less than alpha.
+
+    :param sweep_results: a dictionary returned by mmd_sweep(), ume_sweep()
+        or fssd_sweep()
+    :param alpha: significance level. If None, use the alpha of the sweep.
+    :param method:
+        - 'max': the test statistic is the maximum over the widths of the
+          standardized statistics stat/sd. Its null distribution is
+          simulated with the bootstrap draws, which are jointly distributed
+          across the widths. Requires a sweep with n_bootstrap.
+        - 'bonferroni': p-value = min(1, G*min(pvalues)) for G widths. Valid
+          for any dependence between the widths, but conservative.
+        Only the valid widths (see sweep_results['valid']) are aggregated.
+        G is still the number of all the widths.
+
+    :returns: a dictionary with keys alpha, pvalue, test_stat, h0_rejected,
+        and best_index (the index of the width with the largest standardized
+        statistic or the smallest p-value)
+    """
+    if alpha is None:
+        alpha = sweep_results['alpha']
+    pvalues = sweep_results['pvalues']
+    G = len(pvalues)
+    ind = np.flatnonzero(sweep_results['valid'])
+    if method not in ['max', 'bonferroni']:
+        raise ValueError('method must be "max" or "bonferroni". Was {}'.format(method))
+    if len(ind) == 0:
+        raise ValueError('No width has a valid H0 variance.')
+    if method == 'max':
+        draws = sweep_results['draws']
+        if draws is None:
+            raise ValueError('method max needs a sweep with n_bootstrap.')
+        sds = sweep_results['variances'][ind]**0.5
+        zstats = sweep_results['test_stats'][ind]/sds
+        best = int(ind[np.argmax(zstats)])
+        stat = np.max(zstats)
+        max_draws = np.max(draws[ind]/sds[:, np.newaxis], 0)
+        pval = bootstrap.pvalue(stat, max_draws)
+    else:
+        best = int(ind[np.argmin(pvalues[ind])])
+        stat = sweep_results['test_stats'][best]
+        pval = min(1.0, G*pvalues[best])
+    return {'alpha': alpha, 'pvalue': pval, 'test_stat': stat,
+            'h0_rejected': pval < alpha, 'best_index': best}
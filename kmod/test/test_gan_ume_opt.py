@@ -0,0 +1,260 @@
+"""
+Module for testing kmod.gan_ume_opt .
+"""
+
+__author__ = 'wittawat'
+
+import autograd
+import numpy as np
+import numpy.testing as testing
+
+import kmod
+import kmod.gan_ume_opt as go
+from kmod import data, kernel, util
+from kmod.mctest import SC_UME
+import torch
+import torch.nn as nn
+
+import unittest
+
+
+class TestExtractFeats(unittest.TestCase):
+    def setUp(self):
+        self.settings = (go.gpu_mode, go.model_input_size, go.batch_size)
+        go.set_gpu_mode(False)
+        go.set_model_input_size(12)
+        torch.manual_seed(2)
+        # a tiny CPU featurizer
+        self.model = nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU(),
+                nn.AdaptiveAvgPool2d(2), nn.Flatten())
+        with util.NumpySeedContext(seed=3):
+            # 23 images of 3 x 6 x 6, flattened
+            self.X = np.random.rand(23, 3*6*6)
+
+    def tearDown(self):
+        go.gpu_mode, go.model_input_size, go.batch_size = self.settings
+
+    def plain_feats(self, X, upsample, b):
+        # a plain batched forward pass
+        feats = []
+        for i in range(0, X.shape[0], b):
+            V = torch.from_numpy(X[i:i+b].reshape(-1, 3, 6, 6)).float()
+            if upsample:
+                V = nn.Upsample((12, 12), mode='bilinear')(V)
+            feats.append(self.model(V).detach().numpy().reshape(V.shape[0], -1))
+        return np.vstack(feats)
+
+    def test_extract_feats(self):
+        # 5 does not divide 23
+        go.set_batch_size(5)
+        for upsample in [False, True]:
+            expected = self.plain_feats(self.X, upsample, 5)
+            F = go.extract_feats(self.X, self.model, upsample=upsample)
+            self.assertEqual(F.shape, (23, 16))
+            testing.assert_allclose(F, expected, rtol=1e-6)
+
+            out = np.zeros((23, 16), dtype=np.float32)
+            F2 = go.extract_feats(self.X, self.model, upsample=upsample,
+                    out=out)
+            self.assertIs(F2, out)
+            testing.assert_allclose(out, expected, rtol=1e-6)
+
+        # automatic batch size
+        go.set_batch_size(None)
+        F = go.extract_feats(self.X, self.model, upsample=True)
+        testing.assert_allclose(F, self.plain_feats(self.X, True, 23),
+                rtol=1e-6)
+
+    def test_extract_feats_empty(self):
+        X0 = self.X[:0]
+        F = go.extract_feats(X0, self.model, upsample=True)
+        self.assertEqual(F.shape, (0, 16))
+        out = np.zeros((0, 16), dtype=np.float32)
+        self.assertIs(go.extract_feats(X0, self.model, out=out), out)
+
+
+class LinearGenerator(nn.Module):
+    """
+    A tiny linear generator of 3 x 4 x 4 images from noise vectors of
+    dimension dn. Counts its forward passes.
+    """
+    def __init__(self, dn):
+        super(LinearGenerator, self).__init__()
+        self.linear = nn.Linear(dn, 3*4*4)
+        self.n_calls = 0
+
+    def forward(self, z):
+        self.n_calls += 1
+        return self.linear(z.view(z.shape[0], -1)).view(-1, 3, 4, 4)
+
+
+class TestNoiseSpaceObjective(unittest.TestCase):
+    def setUp(self):
+        self.settings = (go.gpu_mode, go.model_input_size)
+        go.set_gpu_mode(False)
+        go.set_model_input_size(8)
+        torch.manual_seed(4)
+        self.dn = 3
+        self.J = 2
+        self.gen_p = LinearGenerator(self.dn)
+        self.gen_q = LinearGenerator(self.dn)
+        # a linear featurizer
+        self.model = nn.Sequential(nn.Flatten(), nn.Linear(3*8*8, 5))
+        with util.NumpySeedContext(seed=5):
+            self.datap = data.Data(np.random.randn(30, 5) + 0.3)
+            self.dataq = data.Data(np.random.randn(30, 5))
+            self.datar = data.Data(np.random.randn(30, 5))
+            z = np.random.uniform(-1, 1, (2*self.J, self.dn))
+        self.x = np.hstack((np.sqrt(2.0), z.reshape(-1)))
+
+    def tearDown(self):
+        go.gpu_mode, go.model_input_size = self.settings
+
+    def features(self, gen, z):
+        up = nn.Upsample((8, 8), mode='bilinear')
+        if isinstance(z, np.ndarray):
+            z = torch.from_numpy(z).float()
+        V = z.view(-1, self.dn, 1, 1)
+        return self.model(up(gen(V))).view(z.shape[0], -1)
+
+    def objective(self, x):
+        # the negative power criterion evaluated directly
+        J = self.J
+        z = x[1:].reshape(2*J, -1)
+        with torch.no_grad():
+            F = np.vstack([self.features(self.gen_p, z[:J]).numpy(),
+                self.features(self.gen_q, z[J:]).numpy()])
+        k = kernel.KGauss(x[0]**2)
+        return -SC_UME.power_criterion(self.datap, self.dataq, self.datar,
+                k, k, F, F)
+
+    def central_differences(self, x, h=1e-2):
+        # The features are float32. So, the step is large.
+        grad = np.zeros(len(x))
+        for i in range(len(x)):
+            e = np.zeros(len(x))
+            e[i] = h
+            grad[i] = (self.objective(x + e) - self.objective(x - e))/(2*h)
+        return grad
+
+    def test_value_grad_memo(self):
+        f = go.noise_space_obj_grad(self.datap, self.dataq, self.datar,
+                self.gen_p, self.gen_q, self.model, self.J)
+        value, grad = f(self.x)
+        self.assertAlmostEqual(value, self.objective(self.x), places=6)
+        testing.assert_allclose(grad, self.central_differences(self.x),
+                rtol=1e-2, atol=1e-5)
+
+        # The same x (e.g., a copy from scipy) hits the memo.
+        n_calls = self.gen_p.n_calls
+        value2, grad2 = f(np.copy(self.x))
+        self.assertEqual(self.gen_p.n_calls, n_calls)
+        self.assertEqual(value2, value)
+        self.assertIs(grad2, grad)
+        # Another x does not.
+        f(self.x + 0.01)
+        self.assertEqual(self.gen_p.n_calls, n_calls + 1)
+
+    def test_grad_matches_jacobian_chain(self):
+        """
+        The gradient from one backward pass is the same as chaining the
+        dense Jacobians of the features with respect to the noise vectors
+        with the gradient with respect to the features (the computation it
+        replaced).
+        """
+        J, dn = self.J, self.dn
+        f = go.noise_space_obj_grad(self.datap, self.dataq, self.datar,
+                self.gen_p, self.gen_q, self.model, J)
+        _, grad = f(self.x)
+        # Only the noise gradients are computed. No gradient is accumulated
+        # in the parameters of the networks.
+        for net in [self.gen_p, self.gen_q, self.model]:
+            for param in net.parameters():
+                self.assertIsNone(param.grad)
+
+        z = self.x[1:].reshape(2*J, dn)
+        F = np.vstack([self.features(self.gen_p, z[:J]).detach().numpy(),
+            self.features(self.gen_q, z[J:]).detach().numpy()])
+
+        def obj_feat(w, F):
+            k = kernel.KGauss(w**2)
+            return -SC_UME.power_criterion(self.datap, self.dataq,
+                    self.datar, k, k, F, F)
+        grad_w = autograd.grad(obj_feat, 0)(self.x[0], F)
+        grad_F = autograd.grad(obj_feat, 1)(self.x[0], F)  # 2J x d_nn
+
+        grads_z = []
+        for i, gen in enumerate([self.gen_p, self.gen_q]):
+            zi = torch.from_numpy(z[i*J:(i+1)*J]).float()
+            # J x d_nn x J x dn
+            jac = torch.autograd.functional.jacobian(
+                    lambda v: self.features(gen, v), zi).numpy()
+            grads_z.append(np.einsum('ja,jakl->kl', grad_F[i*J:(i+1)*J], jac))
+        expected = np.hstack((grad_w, np.vstack(grads_z).reshape(-1)))
+        testing.assert_allclose(grad, expected, rtol=1e-5, atol=1e-8)
+
+
+class TestGreedyLocations(unittest.TestCase):
+    def test_greedy_search_ume(self):
+        n, d, n_c, J = 80, 3, 25, 5
+        with util.NumpySeedContext(seed=14):
+            X = np.random.randn(n, d) + 0.4
+            Y = np.random.randn(n, d) - 0.2
+            Z = np.random.randn(n, d)
+            locs = 1.5*np.random.randn(n_c, d)
+        datap, dataq, datar = data.Data(X), data.Data(Y), data.Data(Z)
+        k = kernel.KGauss(3.0)
+        for maximize in [True, False]:
+            # greedy selection evaluating the power criterion from scratch
+            expected = []
+            for _ in range(J):
+                scores = []
+                for c in range(n_c):
+                    V = locs[[c] + expected]
+                    score = SC_UME.power_criterion(datap, dataq, datar,
+                            k, k, V, V, reg=1e-3)
+                    scores.append(score if maximize else -score)
+                scores = np.array(scores)
+                scores[expected] = -np.inf
+                expected.append(int(np.argmax(scores)))
+
+            chosen = go.opt_greedy_3sample_criterion(datap, dataq,
+                    datar, locs, k, J, reg=1e-3, maximize=maximize)
+            self.assertEqual(chosen, expected)
+
+    def test_lazy_stochastic_greedy(self):
+        n, d, n_c, J = 80, 3, 100, 8
+        with util.NumpySeedContext(seed=15):
+            X = np.random.randn(n, d) + 0.4
+            Y = np.random.randn(n, d) - 0.2
+            Z = np.random.randn(n, d)
+            locs = 1.5*np.random.randn(n_c, d)
+        k = kernel.KGauss(3.0)
+        greedy, greedy_info = go.greedy_search_ume(X, Y, Z, locs, k,
+                J, return_info=True)
+        self.assertEqual(greedy_info['n_evals'], sum(n_c - i for i in range(J)))
+        for method in ['lazy', 'stochastic']:
+            chosen, info = go.greedy_search_ume(X, Y, Z, locs, k, J,
+                    method=method, return_info=True)
+            self.assertEqual(len(set(chosen)), J)
+            self.assertLess(info['n_evals'], greedy_info['n_evals'])
+        # The first choice of the lazy greedy is that of the greedy.
+        lazy = go.greedy_search_ume(X, Y, Z, locs, k, J,
+                method='lazy')
+        self.assertEqual(lazy[0], greedy[0])
+        # With a subset as large as the pool, stochastic greedy is greedy.
+        stoch = go.greedy_search_ume(X, Y, Z, locs, k, J,
+                method='stochastic', eps=1e-10)
+        self.assertEqual(stoch, greedy)
+        # eps close to 1 scores one candidate per round
+        stoch, info = go.greedy_search_ume(X, Y, Z, locs, k, J,
+                method='stochastic', eps=1 - 1e-6, return_info=True)
+        self.assertEqual(len(set(stoch)), J)
+        self.assertEqual(info['n_evals'], J)
+        for eps in [0, 1.0, 2.0]:
+            self.assertRaises(ValueError, go.greedy_search_ume, X,
+                    Y, Z, locs, k, J, method='stochastic', eps=eps)
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -13,9 +13,16 @@ import matplotlib.pyplot as plt
 import kmod
 import kmod.config
 import kmod.mctest as mct
-from kmod import data, density, util, kernel
+import kmod.backend as kbackend
+from kmod import data, density, util, kernel, stream
+import kmod.median as median
+import kmod.multistart as multistart
+import kmod.sweep as sweep
+import kmod.warmstart as warmstart
 import scipy.stats as stats
+import freqopttest.tst as tst
 
+import tempfile
 import unittest
 
 
@@ -64,6 +71,36 @@ class TestDC_FSSD(unittest.TestCase):
                 self.assertLessEqual(tresult['pvalue'], 1)
                 testing.assert_approx_equal(s, (n**0.5)*s2)
 
+                # block-wise computation should give the same results
+                for block_size in [1, 10, 500]:
+                    s3, var3 = mcfssd.get_H1_mean_variance(dat,
+                            block_size=block_size)
+                    testing.assert_almost_equal(s3, s2)
+                    testing.assert_almost_equal(var3, var)
+
+                # bootstrap null
+                s4, draws = mcfssd.bootstrap_null(dat, n_bootstrap=300)
+                testing.assert_almost_equal(s4, s2)
+                self.assertEqual(draws.shape, (300,))
+                bresult = mcfssd.perform_test(dat, null='bootstrap')
+                testing.assert_almost_equal(bresult['test_stat'], s)
+                self.assertGreaterEqual(bresult['pvalue'], 0)
+                self.assertLessEqual(bresult['pvalue'], 1)
+
+                # batched tests
+                list_dat = [dat, data.Data(X[:50]), data.Data(X[::-1])]
+                many = mcfssd.perform_test_many(list_dat)
+                for dat_i, res_i in zip(list_dat, many):
+                    res = mcfssd.perform_test(dat_i)
+                    testing.assert_almost_equal(res_i['test_stat'], res['test_stat'])
+                    testing.assert_almost_equal(res_i['pvalue'], res['pvalue'])
+
+                # power criterion from precomputed scores
+                pc = mct.DC_FSSD.power_criterion(p, q, dat, k, k, V, V)
+                pc2 = mct.DC_GaussFSSD.power_criterion_scores(X,
+                        p.grad_log(X), q.grad_log(X), V, sig2)
+                testing.assert_almost_equal(pc2, pc)
+
     def tearDown(self):
         pass
 
@@ -113,7 +150,400 @@ class TestSC_UME(unittest.TestCase):
         #print(test_result)
         assert test_result['h0_rejected']
 
+    def test_block_size(self):
+        """
+        Processing the data in row blocks should give the same mean and
+        variance as the in-memory computation.
+        """
+        n, d = 203, 2
+        seed = 18
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 1
+            Y = np.random.randn(n, d)*2
+            Z = np.random.randn(n, d)
+        k = kernel.KGauss(2.0)
+        l = kernel.KGauss(1.5)
+        V = util.fit_gaussian_draw(X, 3, seed=seed+1)
+        W = util.fit_gaussian_draw(Y, 2, seed=seed+2)
+        scume = mct.SC_UME(data.Data(X), data.Data(Y), k, l, V, W, alpha=0.01)
+        datr = data.Data(Z)
+
+        mean, var = scume.get_H1_mean_variance(datr)
+        for block_size in [1, 50, 1000]:
+            mean_b, var_b = scume.get_H1_mean_variance(datr,
+                    block_size=block_size)
+            testing.assert_almost_equal(mean_b, mean)
+            testing.assert_almost_equal(var_b, var)
+
+        # shared k(Z, V) when k == l and V == W
+        scume_s = mct.SC_UME(data.Data(X), data.Data(Y), k, k, V, V)
+        self.assertTrue(scume_s.shared_locs)
+        scume_ns = mct.SC_UME(data.Data(X), data.Data(Y), k, k, V, V,
+                shared_locs=False)
+        testing.assert_almost_equal(scume_s.get_H1_mean_variance(datr),
+                scume_ns.get_H1_mean_variance(datr))
+
+        blocks = util.iter_row_blocks(64, X, Y, Z)
+        res_b = scume.perform_test_blocks(blocks)
+        res = scume.perform_test(datr)
+        testing.assert_almost_equal(res_b['test_stat'], res['test_stat'])
+        testing.assert_almost_equal(res_b['pvalue'], res['pvalue'])
+
+    def test_merge_stats(self):
+        """
+        Statistics accumulated on separate shards and merged should give the
+        same test result as the full data.
+        """
+        n, d = 150, 2
+        seed = 28
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 1
+            Y = np.random.randn(n, d)
+            Z = np.random.randn(n, d)
+        k = kernel.KGauss(2.0)
+        V = util.fit_gaussian_draw(Z, 2, seed=seed+1)
+        scume = mct.SC_UME(data.Data(X), data.Data(Y), k, k, V, V, alpha=0.01)
+
+        shards = [slice(0, 40), slice(40, 41), slice(41, n)]
+        list_stats = [scume.accumulate_stats([(X[s], Y[s], Z[s])])
+                for s in shards]
+        # simulate sending to another process
+        list_stats = [stream.UMEStats.from_dict(st.to_dict()) for st in
+                list_stats]
+        merged = stream.UMEStats.merge_all(list_stats)
+        self.assertEqual(merged.n, n)
+
+        res_m = scume.perform_test_stats(merged)
+        res = scume.perform_test(data.Data(Z))
+        testing.assert_almost_equal(res_m['test_stat'], res['test_stat'])
+        testing.assert_almost_equal(res_m['pvalue'], res['pvalue'])
+        testing.assert_almost_equal((list_stats[0] + list_stats[2] +
+            list_stats[1]).h1_mean_variance(), merged.h1_mean_variance())
+
+    def test_perform_test_many(self):
+        """
+        perform_test_many() should give the same results as calling
+        perform_test() on each sample.
+        """
+        n, d = 80, 2
+        seed = 38
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 1
+            Y = np.random.randn(n, d)
+            list_dat = [data.Data(np.random.randn(n, d) + 0.2*i) for i in
+                    range(4)]
+        k = kernel.KGauss(2.0)
+        l = kernel.KGauss(1.5)
+        V = util.fit_gaussian_draw(X, 3, seed=seed+1)
+        W = util.fit_gaussian_draw(Y, 2, seed=seed+2)
+        datap, dataq = data.Data(X), data.Data(Y)
+        # the approximate subclasses test each sample separately
+        for test in [mct.SC_UME(datap, dataq, k, l, V, W),
+                mct.SC_MMD(datap, dataq, k, tile_size=32),
+                mct.SC_RFFUME(datap, dataq, 2.0, V, V, rff_dim=20),
+                mct.SC_LinearMMD(datap, dataq, k),
+                mct.SC_RFFMMD(datap, dataq, 2.0, rff_dim=20)]:
+            many = test.perform_test_many(list_dat)
+            self.assertEqual(len(many), len(list_dat))
+            for dat, res_m in zip(list_dat, many):
+                res = test.perform_test(dat)
+                testing.assert_almost_equal(res_m['test_stat'], res['test_stat'])
+                testing.assert_almost_equal(res_m['pvalue'], res['pvalue'])
+
+        # A sample of a different size is tested with perform_test(), and
+        # fails as perform_test() does.
+        with util.NumpySeedContext(seed=seed+3):
+            dat_small = data.Data(np.random.randn(n//2, d))
+        mixed = [list_dat[0], dat_small, list_dat[1]]
+        for test in [mct.SC_UME(datap, dataq, k, l, V, W),
+                mct.SC_MMD(datap, dataq, k, tile_size=32)]:
+            self.assertRaises(ValueError, test.perform_test, dat_small)
+            self.assertRaises(ValueError, test.perform_test_many, mixed)
+
+    def test_single_loc_power_criteria(self):
+        """
+        The vectorized J=1 power criteria should be the same as
+        power_criterion() evaluated at each candidate location.
+        """
+        n, d = 100, 2
+        seed = 39
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 0.5
+            Y = np.random.randn(n, d)*1.5
+            Z = np.random.randn(n, d)
+            C = np.random.randn(7, d)*2
+        datap, dataq, datar = [data.Data(A) for A in [X, Y, Z]]
+        k = kernel.KGauss(2.0)
+        l = kernel.KGauss(1.2)
+        p = density.IsotropicNormal(np.zeros(d), 1)
+        q = density.IsotropicNormal(np.zeros(d) + 0.3, 2)
+
+        values = mct.SC_UME.single_loc_power_criteria(datap, dataq, datar, k,
+                l, C, reg=1e-5, chunk_size=3)
+        values_f = mct.DC_FSSD.single_loc_power_criteria(p, q, datar, k, l,
+                C, reg=1e-5, chunk_size=3)
+        for i in range(C.shape[0]):
+            Ci = C[[i]]
+            testing.assert_almost_equal(values[i],
+                    mct.SC_UME.power_criterion(datap, dataq, datar, k, l, Ci,
+                        Ci, reg=1e-5))
+            testing.assert_almost_equal(values_f[i],
+                    mct.DC_FSSD.power_criterion(p, q, datar, k, l, Ci, Ci,
+                        reg=1e-5))
+
+class TestSC_MMD(unittest.TestCase):
+    def test_tiled_gram(self):
+        """
+        The tiled Gram engine should give the same mean and variance as
+        evaluating the full Gram matrices.
+        """
+        n, d = 61, 3
+        seed = 37
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 0.5
+            Y = np.random.randn(n, d)*1.2
+            Z = np.random.randn(n, d)
+        k = kernel.KGauss(2.0)
+
+        mmd_pr, var_pr = tst.QuadMMDTest.h1_mean_var(X, Z, k, is_var_computed=True)
+        mmd_qr, var_qr = tst.QuadMMDTest.h1_mean_var(Y, Z, k, is_var_computed=True)
+        var_pqr = mct.SC_MMD.get_cross_covariance(X, Y, Z, k)
+        mean = mmd_pr - mmd_qr
+        var = n*(var_pr - 2.0*var_pqr + var_qr)
+
+        for tile_size, n_threads in [(7, 1), (20, 3), (100, None)]:
+            scmmd = mct.SC_MMD(data.Data(X), data.Data(Y), k, alpha=0.01,
+                    tile_size=tile_size, n_threads=n_threads)
+            mean_t, var_t = scmmd.get_H1_mean_variance(data.Data(Z))
+            testing.assert_almost_equal(mean_t, mean)
+            testing.assert_almost_equal(var_t, var)
+
+    def test_linear_block(self):
+        """
+        Test SC_LinearMMD and SC_BlockMMD.
+        """
+        n, d = 400, 2
+        seed = 39
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 2
+            Y = np.random.randn(n, d) + 0.2
+            Z = np.random.randn(n, d)
+        k = kernel.KGauss(1.0)
+        datap, dataq, datar = [data.Data(A) for A in [X, Y, Z]]
+
+        # each block statistic is a difference of two quadratic U-statistics
+        B = 40
+        bstats = mct.SC_BlockMMD.block_stats(X, Y, Z, k, B)
+        self.assertEqual(len(bstats), n//B)
+        mmd_pr, _ = tst.QuadMMDTest.h1_mean_var(X[:B], Z[:B], k, is_var_computed=False)
+        mmd_qr, _ = tst.QuadMMDTest.h1_mean_var(Y[:B], Z[:B], k, is_var_computed=False)
+        testing.assert_almost_equal(bstats[0], mmd_pr - mmd_qr)
+
+        for sc in [mct.SC_LinearMMD(datap, dataq, k, alpha=0.01),
+                mct.SC_BlockMMD(datap, dataq, k, alpha=0.01),
+                mct.SC_BlockMMD(datap, dataq, k, alpha=0.01, block_size=B)]:
+            result = sc.perform_test(datar)
+            # Q is much closer to R
+            self.assertTrue(result['h0_rejected'])
+            testing.assert_almost_equal(sc.compute_stat(datar), result['test_stat'])
+
+class TestBootstrap(unittest.TestCase):
+    def test_bootstrap_variance(self):
+        """
+        The variance of the bootstrap draws should be close to the asymptotic
+        variance, and the mean should be the same as in get_H1_mean_variance().
+        """
+        n, d = 400, 2
+        seed = 51
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 0.5
+            Y = np.random.randn(n, d)
+            Z = np.random.randn(n, d)
+        datap, dataq, datar = [data.Data(A) for A in [X, Y, Z]]
+        k = kernel.KGauss(2.0)
+        V = util.fit_gaussian_draw(X, 3, seed=seed+1)
+        for test in [mct.SC_UME(datap, dataq, k, k, V, V),
+                mct.SC_MMD(datap, dataq, k)]:
+            mean, var = test.get_H1_mean_variance(datar)
+            mean_b, draws = test.bootstrap_null(datar, n_bootstrap=2000,
+                    seed=seed)
+            testing.assert_almost_equal(mean_b, mean)
+            self.assertLess(abs(np.mean(draws)), 3*(var/2000)**0.5)
+            self.assertLess(abs(np.var(draws) - var), 0.2*var)
+            result = test.perform_test(datar, null='bootstrap')
+            self.assertGreaterEqual(result['pvalue'], 0)
+            self.assertLessEqual(result['pvalue'], 1)
+
+class TestRFF(unittest.TestCase):
+    def test_rff_approximation(self):
+        """
+        With many random features, SC_RFFMMD and SC_RFFUME should be close to
+        SC_MMD and SC_UME.
+        """
+        n, d = 500, 2
+        seed = 49
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 1
+            Y = np.random.randn(n, d) + 0.2
+            Z = np.random.randn(n, d)
+        datap, dataq, datar = [data.Data(A) for A in [X, Y, Z]]
+        sigma2 = 2.0
+        k = kernel.KGauss(sigma2)
+        V = util.fit_gaussian_draw(X, 3, seed=seed+1)
+        D = 4000
+
+        pairs = [
+            (mct.SC_MMD(datap, dataq, k, alpha=0.01),
+                mct.SC_RFFMMD(datap, dataq, sigma2, alpha=0.01, rff_dim=D,
+                    seed=seed)),
+            (mct.SC_UME(datap, dataq, k, k, V, V, alpha=0.01),
+                mct.SC_RFFUME(datap, dataq, sigma2, V, V, alpha=0.01,
+                    rff_dim=D, seed=seed)),
+            ]
+        for exact, rff in pairs:
+            mean, var = exact.get_H1_mean_variance(datar)
+            mean_a, var_a = rff.get_H1_mean_variance(datar)
+            self.assertLess(abs(mean_a - mean), 0.1*abs(mean))
+            self.assertLess(abs(var_a - var), 0.2*var)
+
+    def test_nystrom_approximation(self):
+        """
+        SC_NystromMMD should be close to SC_MMD for kernels without random
+        feature expansions.
+        """
+        n, d = 500, 3
+        seed = 50
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 0.5
+            Y = np.random.randn(n, d)*1.2
+            Z = np.random.randn(n, d)
+        datap, dataq, datar = [data.Data(A) for A in [X, Y, Z]]
+        for k in [kernel.KKID(), kernel.KHoPoly(2)]:
+            mean, var = mct.SC_MMD(datap, dataq, k).get_H1_mean_variance(datar)
+            for method in ['uniform', 'kmeans++']:
+                scmmd = mct.SC_NystromMMD(datap, dataq, k, n_landmarks=200,
+                        landmark_method=method, seed=seed)
+                mean_a, var_a = scmmd.get_H1_mean_variance(datar)
+                self.assertLess(abs(mean_a - mean), 0.05*abs(mean))
+                self.assertLess(abs(var_a - var), 0.2*var)
+
+    def test_approx_mmd_bootstrap(self):
+        """
+        The bootstrap of SC_RFFMMD and SC_NystromMMD should match their own
+        (approximate) mean and asymptotic variance.
+        """
+        n, d = 400, 2
+        seed = 52
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 0.5
+            Y = np.random.randn(n, d)
+            Z = np.random.randn(n, d)
+        datap, dataq, datar = [data.Data(A) for A in [X, Y, Z]]
+        for test in [mct.SC_RFFMMD(datap, dataq, 2.0, rff_dim=300, seed=seed),
+                mct.SC_NystromMMD(datap, dataq, kernel.KGauss(2.0),
+                    n_landmarks=100, seed=seed)]:
+            mean, var = test.get_H1_mean_variance(datar)
+            mean_b, draws = test.bootstrap_null(datar, n_bootstrap=2000,
+                    seed=seed)
+            testing.assert_almost_equal(mean_b, mean)
+            self.assertLess(abs(np.mean(draws)), 3*(var/2000)**0.5)
+            self.assertLess(abs(np.var(draws) - var), 0.2*var)
+            result = test.perform_test(datar, null='bootstrap')
+            self.assertGreaterEqual(result['pvalue'], 0)
+            self.assertLessEqual(result['pvalue'], 1)
+
+    def test_rffume_bootstrap_blocks(self):
+        """
+        The bootstrap and the block test of SC_RFFUME should use the random
+        features, i.e., agree with its own asymptotic test rather than with
+        SC_UME.
+        """
+        n, d = 400, 2
+        seed = 53
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 0.3
+            Y = np.random.randn(n, d) + 0.1
+            Z = np.random.randn(n, d)
+        datap, dataq, datar = [data.Data(A) for A in [X, Y, Z]]
+        V = util.fit_gaussian_draw(X, 3, seed=seed+1)
+        sigma2 = 2.0
+        # Few features so that the approximate test differs from the exact
+        # test.
+        rff = mct.SC_RFFUME(datap, dataq, sigma2, V, V, rff_dim=4, seed=2)
+        exact = mct.SC_UME(datap, dataq, kernel.KGauss(sigma2),
+                kernel.KGauss(sigma2), V, V)
+        mean, var = rff.get_H1_mean_variance(datar)
+        mean_b, draws = rff.bootstrap_null(datar, n_bootstrap=3000, seed=seed)
+        testing.assert_almost_equal(mean_b, mean)
+        self.assertLess(abs(np.var(draws) - var), 0.2*var)
+
+        res_a = rff.perform_test(datar)
+        res_b = rff.perform_test(datar, null='bootstrap', n_bootstrap=3000)
+        res_e = exact.perform_test(datar)
+        self.assertGreater(abs(res_a['pvalue'] - res_e['pvalue']), 0.5)
+        self.assertAlmostEqual(res_b['test_stat'], res_a['test_stat'])
+        self.assertLess(abs(res_b['pvalue'] - res_a['pvalue']), 0.03)
+
+        blocks = util.iter_row_blocks(150, X, Y, Z)
+        res_blocks = rff.perform_test_blocks(blocks)
+        self.assertAlmostEqual(res_blocks['test_stat'], res_a['test_stat'])
+        self.assertAlmostEqual(res_blocks['pvalue'], res_a['pvalue'])
+        with self.assertRaises(ValueError):
+            rff.accumulate_stats(util.iter_row_blocks(150, X, Y, Z))
+
 class TestSC_GaussUME(unittest.TestCase):
+    def test_optimize_3sample_criterion_minibatch(self):
+        """
+        Minibatch Adam (without the full-batch polish) should reach a power
+        criterion close to that of the full-batch L-BFGS.
+        """
+        n, d, J = 1000, 2, 2
+        seed = 9
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 1
+            Y = np.random.randn(n, d) + 0.2
+            Z = np.random.randn(n, d)
+            V0 = np.random.randn(J, d)
+        datap, dataq, datar = [data.Data(A) for A in [X, Y, Z]]
+
+        def pc(V, gwidth):
+            k = kernel.KGauss(gwidth)
+            return mct.SC_UME.power_criterion(datap, dataq, datar, k, k, V, V)
+
+        V_f, gw_f, info_f = mct.SC_GaussUME.optimize_3sample_criterion(datap,
+                dataq, datar, V0, 1.0)
+        V_s, gw_s, info_s = mct.SC_GaussUME.optimize_3sample_criterion(datap,
+                dataq, datar, V0, 1.0, max_iter=0, minibatch_size=200,
+                stoch_options={'n_iters': 300, 'seed': seed})
+        self.assertIn('stoch_info', info_s)
+        self.assertGreater(pc(V_s, gw_s), 0.9*pc(V_f, gw_f))
+
+    def test_power_criterion_and_grad(self):
+        """
+        The closed-form gradients should agree with autograd.
+        """
+        n, d, J = 150, 3, 4
+        seed = 7
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 0.5
+            Y = np.random.randn(n, d)*1.3
+            Z = np.random.randn(n, d)
+            V = np.random.randn(J, d)
+        datap, dataq, datar = [data.Data(A) for A in [X, Y, Z]]
+        gwidth = 2.5
+        reg = 1e-3
+
+        def pc(V, gwidth):
+            k = kernel.KGauss(gwidth)
+            return mct.SC_UME.power_criterion(datap, dataq, datar, k, k, V, V,
+                    reg=reg)
+
+        value, grad_V, grad_gwidth = mct.SC_GaussUME.power_criterion_and_grad(
+                datap, dataq, datar, V, gwidth, reg=reg)
+        testing.assert_almost_equal(value, pc(V, gwidth))
+        testing.assert_almost_equal(grad_V, autograd.grad(pc, 0)(V, gwidth))
+        testing.assert_almost_equal(grad_gwidth, autograd.grad(pc, 1)(V, gwidth))
+
     def test_optimize_2sets_locs_widths(self):
         mp, varp = 2, 1
         # q cannot be the true model. 
@@ -178,6 +608,289 @@ class TestSC_GaussUME(unittest.TestCase):
         scume_opt2 = mct.SC_UME(datpte, datqte, k_opt, l_opt, V_opt, W_opt, alpha=alpha)
         scume_opt2.perform_test(datrte)
 
+class TestMultiStart(unittest.TestCase):
+    def test_optimize_3sample_criterion(self):
+        n, d, J = 300, 2, 2
+        seed = 12
+        with util.NumpySeedContext(seed=seed):
+            X = np.random.randn(n, d) + 1
+            Y = np.random.randn(n, d) + 0.3
+            Z = np.random.randn(n, d)
+        datap, dataq, datar = [data.Data(A) for A in [X, Y, Z]]
+        opt_options = {'max_iter': 30, 'reg': 1e-3}
+
+        for method in ['random', 'kmeans++', 'witness']:
+            V0 = multistart.init_locs(X, Y, Z, J, method=method, gwidth=1.0,
+                    seed=seed)
+            self.assertEqual(V0.shape, (J, d))
+
+        V, gwidth, info = multistart.optimize_3sample_criterion(datap, dataq,
+                datar, J, n_starts=3, n_workers=1, seed=seed, **opt_options)
+        starts = info['starts']
+        self.assertEqual(len(starts), 3)
+        best = info['best_index']
+        cris = [st['criterion'] for st in starts]
+        self.assertEqual(cris[best], max(cris))
+        testing.assert_almost_equal(V, starts[best]['V'])
+        for st in starts:
+            self.assertGreaterEqual(st['criterion'], st['init_criterion'] - 1e-6)
+
+        # The process pool should give the same solutions.
+        V2, gwidth2, info2 = multistart.optimize_3sample_criterion(datap, dataq,
+                datar, J, n_starts=3, n_workers=2, seed=seed, **opt_options)
+        self.assertEqual(info2['best_index'], best)
+        testing.assert_almost_equal(V2, V)
+        testing.assert_almost_equal(gwidth2, gwidth)
+
+
+class TestWarmStart(unittest.TestCase):
+    def test_cache(self):
+        with util.NumpySeedContext(seed=3):
+            A = np.random.randn(200, 2)
+            B = np.random.randn(200, 2)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = warmstart.WarmStartCache(cache_dir, max_entries=2)
+            handles = [cache.handle('prob', 'met', J, A) for J in range(3)]
+            for i, ws in enumerate(handles):
+                self.assertIsNone(ws.load(V=np.zeros((1, 2))))
+                ws.save(V=np.ones((1, 2))*i, gwidth=1.0)
+            # the least recently used entry is evicted
+            self.assertEqual(len(cache), 2)
+            self.assertIsNone(handles[0].load(V=np.zeros((1, 2))))
+
+            # a sample from the same distribution matches approximately
+            ws = cache.handle('prob', 'met', 2, B)
+            params = ws.load(V=np.zeros((1, 2)), gwidth=2.0)
+            testing.assert_almost_equal(params['V'], 2*np.ones((1, 2)))
+            # incompatible shapes
+            self.assertIsNone(ws.load(V=np.zeros((3, 2)), gwidth=2.0))
+            # a sample from a different distribution does not match
+            ws = cache.handle('prob', 'met', 2, B + 3)
+            self.assertIsNone(ws.load(V=np.zeros((1, 2))))
+
+            # lookup_for() keys the problem by its label
+            ws = cache.lookup_for('ex1', 'prob', 'met', 2, A)
+            self.assertEqual(ws.key, cache.handle('ex1_prob', 'met', 2,
+                A).key)
+            self.assertNotEqual(ws.key, cache.lookup_for('ex1', 'prob2',
+                'met', 2, A).key)
+
+    def test_optimize_3sample_criterion(self):
+        """
+        A second trial should start from the optimum of the first one and need
+        fewer iterations.
+        """
+        n, d, J = 500, 2, 2
+        list_dat = []
+        for r in range(2):
+            with util.NumpySeedContext(seed=30+r):
+                list_dat.append([data.Data(np.random.randn(n, d) + m) for m in
+                    [1, 0.3, 0]])
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = warmstart.WarmStartCache(cache_dir)
+            infos = []
+            for r, (datap, dataq, datar) in enumerate(list_dat):
+                V0 = util.subsample_rows(datar.data(), J, seed=r+2)
+                ws = cache.handle('test', 'gume', J, *[D.data() for D in
+                    (datap, dataq, datar)])
+                _, _, info = mct.SC_GaussUME.optimize_3sample_criterion(datap,
+                        dataq, datar, V0, 1.0, warm_start=ws)
+                infos.append(info)
+        self.assertFalse(infos[0]['warm_started'])
+        self.assertTrue(infos[1]['warm_started'])
+        self.assertLess(infos[1]['nit'], infos[0]['nit'])
+
+
+class TestMedian(unittest.TestCase):
+    def test_medians(self):
+        n, d = 200, 3
+        with util.NumpySeedContext(seed=5):
+            X = np.random.randn(n, d) + 1
+            Y = np.random.randn(n, d)
+            Z = np.random.randn(n, d)*2
+
+        median.clear()
+        mh = median.MedianHeuristic(subsample=None)
+        pools = [(0, 2), (1, 2), (0, 1, 2)]
+        pool_meds, cross_meds = mh.medians([X, Y, Z], pools=pools,
+                cross=[(0, 2)])
+        for p, med in zip(pools, pool_meds):
+            expected = util.meddistance(np.vstack([[X, Y, Z][i] for i in p]))
+            self.assertAlmostEqual(med, expected)
+        self.assertAlmostEqual(cross_meds[0], np.median(util.dist_matrix(X, Z)))
+        # memoized
+        self.assertIs(mh.medians([X, Y, Z], pools=pools, cross=[(0, 2)])[0],
+                pool_meds)
+
+        # A pool larger than subsample is subsampled as in util.meddistance(),
+        # independently of the other requested pools.
+        with util.NumpySeedContext(seed=6):
+            C = np.random.standard_cauchy(size=(3000, d))
+        mh = median.MedianHeuristic(subsample=1000)
+        alone = mh.medians([C, X, Y], pools=[(0,)])[0][0]
+        with_others = mh.medians([C, X, Y], pools=[(0,), (0, 1, 2)],
+                cross=[(0, 1)])[0]
+        self.assertEqual(with_others[0], alone)
+        self.assertAlmostEqual(alone, util.meddistance(C, subsample=1000))
+        self.assertAlmostEqual(with_others[1],
+                util.meddistance(np.vstack((C, X, Y)), subsample=1000))
+
+        # the random pairs should be close
+        rp = median.MedianHeuristic(method='random_pairs', n_pairs=20000)
+        rp_meds, rp_cross = rp.medians([X, Y, Z], pools=pools, cross=[(0, 2)])
+        testing.assert_allclose(rp_meds, pool_meds, rtol=0.05)
+        testing.assert_allclose(rp_cross, cross_meds, rtol=0.05)
+
+    def test_baseline_values(self):
+        """
+        The call sites of the median heuristic give the same values as the
+        util.meddistance() calls they replaced.
+        """
+        d = 3
+        median.clear()
+        for n in [300, 700, 1200]:
+            with util.NumpySeedContext(seed=7):
+                X = np.random.randn(n, d) + 1
+                Y = np.random.randn(n, d)
+                Z = np.random.randn(n, d)*2
+            self.assertAlmostEqual(median.meddistance(X, Y, Z),
+                    util.meddistance(np.vstack((X, Y, Z)), subsample=1000))
+            self.assertAlmostEqual(median.meddistance(Z),
+                    util.meddistance(Z, subsample=1000))
+            (medxz, medzy), _ = median.medians([X, Y, Z], pools=[(0, 2),
+                (2, 1)])
+            self.assertAlmostEqual(medxz,
+                    util.meddistance(np.vstack((X, Z)), subsample=1000))
+            self.assertAlmostEqual(medzy,
+                    util.meddistance(np.vstack((Z, Y)), subsample=1000))
+
+            # the previous implementation of median_heuristic_bounliphone
+            with util.NumpySeedContext(seed=287):
+                ind = np.random.choice(n, min(1000, n), replace=False)
+            med_yz = np.median(util.dist_matrix(Y[ind], Z[ind])**2)**0.5
+            med_xz = np.median(util.dist_matrix(X[ind], Z[ind])**2)**0.5
+            self.assertAlmostEqual(mct.SC_MMD.median_heuristic_bounliphone(X,
+                Y, Z, subsample=1000), 0.5*np.mean([med_yz, med_xz])**2)
+
+
+class TestBackend(unittest.TestCase):
+    def test_torch_backend(self):
+        import torch
+        n, d, J = 100, 2, 3
+        with util.NumpySeedContext(seed=21):
+            X = np.random.randn(n, d) + 0.5
+            Y = np.random.randn(n, d)
+            Z = np.random.randn(n, d)
+            V = np.random.randn(J, d)
+            W = np.random.randn(J+1, d)
+        datap, dataq, datar = data.Data(X), data.Data(Y), data.Data(Z)
+        k = kernel.KGauss(1.5)
+        l = kernel.KGauss(0.8)
+        p = density.IsotropicNormal(np.zeros(d) + 0.5, 1.0)
+        q = density.IsotropicNormal(np.zeros(d), 1.0)
+        torch_backend = kbackend.get('torch')
+        self.assertIs(kbackend.get(torch_backend), torch_backend)
+
+        make_tests = [
+            lambda b: mct.SC_UME(datap, dataq, k, l, V, W, backend=b),
+            lambda b: mct.SC_MMD(datap, dataq, k, backend=b),
+            lambda b: mct.DC_GaussFSSD(p, q, 1.5, 0.8, V, W, backend=b),
+            ]
+        for make_test in make_tests:
+            res_np = make_test(None).perform_test(datar)
+            res_torch = make_test('torch').perform_test(datar)
+            self.assertAlmostEqual(res_np['test_stat'], res_torch['test_stat'])
+            self.assertAlmostEqual(res_np['pvalue'], res_torch['pvalue'])
+
+        # gradients of the power criterion with torch.autograd and autograd
+        Vt = torch.tensor(V, requires_grad=True)
+        cri = mct.SC_UME.power_criterion(datap, dataq, datar, k, k, Vt, Vt,
+                backend='torch')
+        cri.backward()
+        grad_np = autograd.grad(lambda V: mct.SC_UME.power_criterion(datap,
+            dataq, datar, k, k, V, V))(V)
+        testing.assert_allclose(Vt.grad.numpy(), grad_np, atol=1e-10)
+
+
+class TestSweep(unittest.TestCase):
+    def test_sweeps(self):
+        n, d, J = 150, 2, 3
+        with util.NumpySeedContext(seed=12):
+            X = np.random.randn(n, d) + 0.5
+            Y = np.random.randn(n, d)
+            Z = np.random.randn(n, d)
+            V = np.random.randn(J, d)
+        datap, dataq, datar = data.Data(X), data.Data(Y), data.Data(Z)
+        gwidths = [0.5, 2.0, 8.0]
+        p = density.IsotropicNormal(np.zeros(d) + 0.5, 1.0)
+        q = density.IsotropicNormal(np.zeros(d), 1.0)
+
+        sweeps = [
+            (sweep.mmd_sweep(datap, dataq, datar, gwidths, n_bootstrap=50),
+                lambda gw: mct.SC_MMD(datap, dataq, kernel.KGauss(gw))),
+            (sweep.ume_sweep(datap, dataq, datar, V, gwidths, n_bootstrap=50),
+                lambda gw: mct.SC_UME(datap, dataq, kernel.KGauss(gw),
+                    kernel.KGauss(gw), V, V)),
+            (sweep.fssd_sweep(p, q, datar, V, gwidths, n_bootstrap=50),
+                lambda gw: mct.DC_GaussFSSD(p, q, gw, gw, V, V)),
+            ]
+        for results, make_test in sweeps:
+            for i, gw in enumerate(gwidths):
+                test = make_test(gw)
+                test_result = test.perform_test(datar)
+                self.assertAlmostEqual(results['test_stats'][i],
+                        test_result['test_stat'])
+                self.assertAlmostEqual(results['pvalues'][i],
+                        test_result['pvalue'])
+                _, draws = test.bootstrap_null(datar, n_bootstrap=50)
+                testing.assert_allclose(results['draws'][i], draws, atol=1e-10)
+
+            for method in ['max', 'bonferroni']:
+                agg = sweep.aggregate_test(results, method=method)
+                self.assertGreaterEqual(agg['pvalue'], 0)
+                self.assertLessEqual(agg['pvalue'], 1)
+                self.assertIn(agg['best_index'], range(len(gwidths)))
+
+    def test_invalid_width(self):
+        """
+        A width with a degenerate null distribution should get the same
+        p-value as perform_test(), and be excluded from the aggregation.
+        """
+        n, d, J = 100, 2, 2
+        with util.NumpySeedContext(seed=13):
+            X = np.random.randn(n, d) + 0.5
+            Y = np.random.randn(n, d)
+            Z = np.random.randn(n, d)
+            V = np.random.randn(J, d)
+        datap, dataq, datar = data.Data(X), data.Data(Y), data.Data(Z)
+        # All the kernel values between distinct points underflow to 0 with
+        # the first width. The variances are 0.
+        gwidths = [1e-8, 2.0]
+        p = density.IsotropicNormal(np.zeros(d) + 0.5, 1.0)
+        q = density.IsotropicNormal(np.zeros(d), 1.0)
+        sweeps = [
+            (sweep.mmd_sweep(datap, dataq, datar, gwidths, n_bootstrap=50),
+                mct.SC_MMD(datap, dataq, kernel.KGauss(gwidths[0]))),
+            (sweep.ume_sweep(datap, dataq, datar, V, gwidths, n_bootstrap=50),
+                mct.SC_UME(datap, dataq, kernel.KGauss(gwidths[0]),
+                    kernel.KGauss(gwidths[0]), V, V)),
+            (sweep.fssd_sweep(p, q, datar, V, gwidths, n_bootstrap=50),
+                mct.DC_GaussFSSD(p, q, gwidths[0], gwidths[0], V, V)),
+            ]
+        for results, test in sweeps:
+            testing.assert_equal(results['valid'], [False, True])
+            testing.assert_equal(results['pvalues'][0],
+                    test.perform_test(datar)['pvalue'])
+            for method in ['max', 'bonferroni']:
+                agg = sweep.aggregate_test(results, method=method)
+                self.assertEqual(agg['best_index'], 1)
+                self.assertTrue(np.isfinite(agg['test_stat']))
+
+            results['valid'][:] = False
+            self.assertRaises(ValueError, sweep.aggregate_test, results)
+
+
 if __name__ == '__main__':
    unittest.main()
 
@@ -56,3 +56,27 @@ def download_to(url, file_path):
     with urllib.request.urlopen(url) as response, \
             open(file_path, 'wb') as out_file:
         shutil.copyfileobj(response, out_file)
+
+
+def iter_row_blocks(block_size, *arrays):
+    """
+    Iterate over consecutive row blocks of the given arrays. All the arrays
+    must have the same number of rows. The arrays can be numpy arrays or
+    numpy memmaps. With a memmap, only the rows of the current block are read
+    into memory.
+
+    * block_size: maximum number of rows in each block
+    * arrays: one or more arrays to slice
+
+    Yield a tuple (one block per array) for each block.
+    """
+    if block_size <= 0:
+        raise ValueError('block_size must be positive. Was {}'.format(block_size))
+    if len(arrays) == 0:
+        raise ValueError('Need at least one array.')
+    n = arrays[0].shape[0]
+    for a in arrays:
+        if a.shape[0] != n:
+            raise ValueError('All arrays must have the same number of rows. Found {} and {}'.format(n, a.shape[0]))
+    for i in range(0, n, block_size):
+        yield tuple(a[i:(i+block_size)] for a in arrays)
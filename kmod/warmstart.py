@@ -0,0 +1,241 @@
+"""
+Module containing an on-disk store of optimized kernel parameters (test
+locations and Gaussian widths) used to warm-start later optimizations of the
+same problem. In the experiments, neighbouring sample sizes and trials of a
+problem converge to nearly the same optimum. Starting from a previous optimum
+needs fewer iterations than starting from random locations.
+"""
+
+__author__ = 'wittawat'
+
+from builtins import object
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+import autograd.numpy as np
+from kmod import log
+
+
+def data_fingerprint(*arrays):
+    """
+    Return a fingerprint of the samples as a tuple (dims, summary) where
+    - dims is a string of the input dimensions of the arrays, and
+    - summary is a numpy array containing the coordinate-wise means and
+      standard deviations of all the arrays.
+    The fingerprint does not depend on the sample sizes. Samples of different
+    sizes (or from different trials) drawn from the same distributions have
+    the same dims, and close summaries.
+
+    :param arrays: numpy arrays, each n_i x d_i
+    """
+    dims = '_'.join('d{}'.format(np.shape(A)[1]) for A in arrays)
+    summary = np.hstack([np.hstack((np.mean(A, 0), np.std(A, 0))) for A in
+        arrays])
+    return dims, summary
+
+
+def summary_distance(s1, s2):
+    """
+    Distance between two summaries (see data_fingerprint()): the root mean
+    squared difference, relative to the root mean square of s1. Both
+    summaries must come from arrays of the same dimensions.
+    """
+    scale = max(np.sqrt(np.mean(s1**2)), 1e-8)
+    return np.sqrt(np.mean((s1 - s2)**2))/scale
+
+
+class WarmStartCache(object):
+    """
+    A store of optimized parameters keyed by (problem label, method, J, data
+    fingerprint). The data fingerprint (see data_fingerprint()) has two
+    parts: the input dimensions, which are part of the exact key, and a
+    summary of the samples, which is matched approximately. One file under
+    cache_dir holds the max_records most recent (summary, parameters) records
+    of each exact key. A lookup returns the parameters of the record whose
+    summary is nearest to the query, if the distance (see
+    summary_distance()) is at most tol.
+
+    Loading a file marks it as recently used. When there are more than
+    max_entries files, the least recently used ones are removed. Multiple
+    processes can share the same directory: files are written atomically, and
+    a missing or corrupted file is treated as absent. (With concurrent
+    writes to the same key, some records may be lost.)
+    """
+
+    def __init__(self, cache_dir=None, max_entries=1000, max_records=20,
+            tol=0.2):
+        """
+        :param cache_dir: directory to store the files. If None, use
+            warm_start/ under expr_configs['scratch_path'] of kmod.config.
+        :param max_entries: maximum number of files (exact keys) to keep
+        :param max_records: maximum number of records to keep per exact key
+        :param tol: maximum distance between the summaries of the data of a
+            stored record and of the query
+        """
+        if cache_dir is None:
+            import kmod.config as config
+            cache_dir = os.path.join(config.expr_configs['scratch_path'],
+                    'warm_start')
+        if max_entries <= 0:
+            raise ValueError('max_entries must be positive. Was {}'.format(max_entries))
+        if max_records <= 0:
+            raise ValueError('max_records must be positive. Was {}'.format(max_records))
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_records = max_records
+        self.tol = tol
+
+    @staticmethod
+    def key(label, method, J, dims):
+        """
+        Return the exact key (a string usable as a file name).
+        """
+        s = '{}|{}|{}|{}'.format(label, method, J, dims)
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.p')
+
+    def _load_records(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                records = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return []
+        try:
+            # mark as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        return records
+
+    def load(self, key, summary):
+        """
+        Return the stored dictionary of parameters of the record (under the
+        key) whose data summary is nearest to the given summary. Return None
+        if there is no record, or the nearest one is farther than tol.
+        """
+        records = self._load_records(key)
+        if not records:
+            return None
+        dists = [summary_distance(summary, s) for s, _ in records]
+        i = int(np.argmin(dists))
+        if dists[i] > self.tol:
+            return None
+        return records[i][1]
+
+    def save(self, key, summary, params):
+        """
+        Add a record of the parameters and the data summary under the key,
+        dropping the oldest records beyond max_records. Then, evict the least
+        recently used files if needed.
+        """
+        records = self._load_records(key)
+        records.append((summary, params))
+        records = records[-self.max_records:]
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(records, f)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        paths = [os.path.join(self.cache_dir, fname) for fname in
+                os.listdir(self.cache_dir) if fname.endswith('.p')]
+        if len(paths) <= self.max_entries:
+            return
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append((os.path.getmtime(path), path))
+            except OSError:
+                # removed by another process
+                pass
+        mtimes.sort()
+        for _, path in mtimes[:len(mtimes) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        """
+        Return the number of files (exact keys).
+        """
+        if not os.path.exists(self.cache_dir):
+            return 0
+        return len([fname for fname in os.listdir(self.cache_dir) if
+            fname.endswith('.p')])
+
+    def handle(self, label, method, J, *arrays):
+        """
+        Return a WarmStart for the problem with the given label, method name,
+        number of test locations J, and the fingerprint of the given samples.
+        The handle can be passed as the warm_start argument of the
+        optimization functions in kmod.mctest.
+        """
+        dims, summary = data_fingerprint(*arrays)
+        return WarmStart(self, WarmStartCache.key(label, method, J, dims),
+                summary)
+
+    def lookup_for(self, prefix, prob_label, method, J, *arrays):
+        """
+        Return a WarmStart (see handle()) for an experiment. The problem is
+        identified by the prefix (e.g., 'ex1') and the problem label, so that
+        all the trials and sample sizes of the same problem share the stored
+        optima, and different problems never do.
+
+        :param prob_label: the label of the problem in the experiment
+        :param arrays: the samples used in the optimization
+        """
+        label = '{}_{}'.format(prefix, prob_label)
+        return self.handle(label, method, J, *arrays)
+
+# end of class WarmStartCache
+
+
+class WarmStart(object):
+    """
+    A handle to the records of one problem in a WarmStartCache.
+    """
+
+    def __init__(self, cache, key, summary):
+        self.cache = cache
+        self.key = key
+        self.summary = summary
+
+    def load(self, **initial):
+        """
+        Return the stored parameters if there is a matching record whose
+        parameters have the same names and shapes as the given initial
+        values. Otherwise, return None.
+
+        :param initial: name |-> initial value (numpy array or scalar)
+        """
+        params = self.cache.load(self.key, self.summary)
+        if params is None:
+            return None
+        for name, value in initial.items():
+            if name not in params or np.shape(params[name]) != np.shape(value):
+                log.l().warning('Stored warm start has incompatible {}. Ignored.'.format(name))
+                return None
+        return params
+
+    def save(self, **params):
+        """
+        Store the (optimized) parameters.
+        """
+        self.cache.save(self.key, self.summary, params)
+
+# end of class WarmStart